@@ -1,82 +1,171 @@
 """
 This file conatains the script to run the benchmark
+The sysbench workloads are run on all the targets (standalone server and manager node of the sql cluster) at the same time:
+each target has its own ssh session and its own thread, which runs the workloads of this target one after the other so that
+they do not interfere, and the result of each workload is saved as soon as it finishes
+With --sweep, each workload is run once per thread count of the ladder, to find where each target saturates
 """
-import boto3
-import paramiko
+import argparse
 import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import paramiko
+import sysbench_results
 from constants import private_key_path, cluster_instance_file, standalone_details
 
-# retriving the stanalone server and manager node (of sql cluser) dns 
-with open(cluster_instance_file) as file:
-    cluster_instance_details = json.load(file)
-with open(standalone_details) as file:
-    standalone_details = json.load(file)
-standalone_dns = standalone_details[0]['PublicDNS']
-for detail in cluster_instance_details:
-    if detail['Name'] =='manager':
-        cluster_manager_node_dns = detail['PublicDNS']
-        break
-
-
-# defining benchmarking commands on both standalone and manager node
-# we have defined three requests: read oly, write only and read_and_write
-# the result of benchmark is saved in files
-standalone_commands = [
-    'sudo sysbench --db-driver=mysql --mysql-user=root    --mysql-db=sakila --range_size=100   --table_size=1000000 --tables=1 --threads=1 --events=0 --time=60   --rand-type=uniform /usr/share/sysbench/oltp_read_only.lua run > read_only_standalone.txt',
-    'sudo sysbench --db-driver=mysql --mysql-user=root    --mysql-db=sakila --range_size=100   --table_size=1000000 --tables=1 --threads=1 --events=0 --time=60   --rand-type=uniform /usr/share/sysbench/oltp_write_only.lua run > write_only_standalone.txt ', 
-    'sudo sysbench --db-driver=mysql --mysql-user=root    --mysql-db=sakila --range_size=100   --table_size=1000000 --tables=1 --threads=1 --events=0 --time=60   --rand-type=uniform /usr/share/sysbench/oltp_read_write.lua run > read_write_standalone.txt'
-]
-
-cluster_commands = [
-    f'sudo sysbench --db-driver=mysql --mysql-user=root    --mysql-db=sakila --range_size=100   --table_size=1000000 --tables=1 --threads=1  --mysql-host={cluster_manager_node_dns}  --events=0 --time=60   --rand-type=uniform /usr/share/sysbench/oltp_read_only.lua run > read_only_cluster.txt',
-    f'sudo sysbench --db-driver=mysql --mysql-user=root    --mysql-db=sakila --range_size=100   --table_size=1000000 --tables=1 --threads=1  --mysql-host={cluster_manager_node_dns}  --events=0 --time=60   --rand-type=uniform /usr/share/sysbench/oltp_write_only.lua run > write_only_cluster.txt',
-    f'sudo sysbench --db-driver=mysql --mysql-user=root    --mysql-db=sakila --range_size=100   --table_size=1000000 --tables=1 --threads=1  --mysql-host={cluster_manager_node_dns}  --events=0 --time=60   --rand-type=uniform /usr/share/sysbench/oltp_read_write.lua run > read_write_cluster.txt',
-
-]
-
-## seting ssh  on stand alone server 
-ssh_standalone = paramiko.SSHClient()
-ssh_standalone.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-ssh_standalone.connect(standalone_dns, username='ubuntu', key_filename=private_key_path)
-
-## seting ssh  on cluster server 
-ssh_manager = paramiko.SSHClient()
-ssh_manager.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-ssh_manager.connect(cluster_manager_node_dns, username='ubuntu', key_filename=private_key_path)
-
-# run benchmarking commands on stadlone, result files will be generated 
-for command in standalone_commands:
-    print("Running on standalone", command)
-    _,stdout, stderr = ssh_standalone.exec_command(command)
-    print(stdout.read().decode('utf-8'))
-    print(stderr.read().decode('utf-8'))
-
-# run benchmarking commands on cluster, result files will be generated   
-for command in cluster_commands: 
-    print("Running on standalone", command)
-    _,stdout, stderr = ssh_manager.exec_command(command)  
-    print(stdout.read().decode('utf-8'))
-    print(stderr.read().decode('utf-8'))
-
-
-# setting sftp on standaloen server to copy benchmark result files locally
-sftp_standalone = ssh_standalone.open_sftp()
-# copy standalone readonly benchmark results
-sftp_standalone.get("read_only_standalone.txt", "read_only_standalone.txt")
-# copy standalone write only benchmark results
-sftp_standalone.get("write_only_standalone.txt", "write_only_standalone.txt")
-# copy standalone read and wirtw benchmark results
-sftp_standalone.get("read_only_standalone.txt", "read_write_standalone.txt")
-# close teh sftp on standaloen server
-sftp_standalone.close()
-
-# setting sftp on cluster server to copy benchmark result files locally
-sftp_cluster = ssh_standalone.open_sftp()
-# copy cluster read only benchmark result file
-sftp_cluster.get("read_only_cluster.txt", "read_only_cluster.txt")
-# copy cluster write only benchmark result file
-sftp_cluster.get("write_only_cluster.txt", "write_only_cluster.txt")
-# copy cluster read write benchmark result file
-sftp_cluster.get("read_write_cluster.txt", "read_write_cluster.txt")
-# close teh sftp on cluster 
-sftp_cluster.close()
\ No newline at end of file
+# the three requests of the benchmark: read only, write only and read and write
+WORKLOADS = ['read_only', 'write_only', 'read_write']
+
+SYSBENCH_COMMAND = ('sudo sysbench --db-driver=mysql --mysql-user=root    --mysql-db=sakila --range_size=100   --table_size=1000000 '
+                    '--tables=1 --threads={threads} {host_option} --events=0 --time={time}   --rand-type=uniform '
+                    '/usr/share/sysbench/oltp_{workload}.lua run')
+
+
+def load_targets():
+    """
+    retriving the stanalone server and manager node (of sql cluser) dns
+    return {target name: (dns of the machine to ssh to, mysql host given to sysbench or None for the local server)}
+    """
+    with open(cluster_instance_file) as file:
+        cluster_instance_details = json.load(file)
+    with open(standalone_details) as file:
+        standalone_instance_details = json.load(file)
+    targets = {'standalone': (standalone_instance_details[0]['PublicDNS'], None)}
+    for detail in cluster_instance_details:
+        if detail['Name'] == 'manager':
+            targets['cluster'] = (detail['PublicDNS'], detail['PublicDNS'])
+            break
+    return targets
+
+
+def sysbench_command(workload, mysql_host=None, threads=1, duration=60):
+    host_option = f'--mysql-host={mysql_host}' if mysql_host else ''
+    return SYSBENCH_COMMAND.format(workload=workload, threads=threads, time=duration, host_option=host_option)
+
+
+class SSHSessions:
+    """
+    One ssh session per machine, opened at the first use and reused by all the commands run on it
+    """
+
+    def __init__(self, key_filename, username='ubuntu'):
+        self.key_filename = key_filename
+        self.username = username
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, dns):
+        with self._lock:
+            client = self._clients.get(dns)
+            if client is None or client.get_transport() is None or not client.get_transport().is_active():
+                client = paramiko.SSHClient()
+                client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                client.connect(dns, username=self.username, key_filename=self.key_filename)
+                self._clients[dns] = client
+            return client
+
+    def close(self):
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients.clear()
+
+
+def run_command(client, command):
+    """
+    run a command over ssh, return (exit status, stdout, stderr)
+    """
+    _, stdout, stderr = client.exec_command(command)
+    output = stdout.read().decode('utf-8')
+    errors = stderr.read().decode('utf-8')
+    return stdout.channel.recv_exit_status(), output, errors
+
+
+def run_job(sessions, target, dns, command, output_file):
+    """
+    run one workload on a target and save the sysbench output in output_file
+    """
+    start = time.time()
+    status, output, errors = run_command(sessions.get(dns), command)
+    with open(output_file, 'w') as file:
+        file.write(output)
+    return {'target': target, 'command': command, 'status': status, 'errors': errors, 'output_file': output_file,
+            'seconds': time.time() - start}
+
+
+def run_plan(targets, jobs, sessions, output_dir='.'):
+    """
+    Run the jobs [(target, name, command)] and return their results in the order they finish,
+    the output of a job is saved in output_dir/<name>_<target>.txt
+    Each target has its own single thread executor: the jobs of a target run one after the other, in the given order,
+    while the different targets run at the same time
+    """
+    executors = {target: ThreadPoolExecutor(max_workers=1, thread_name_prefix=target) for target in targets}
+    futures = {}
+    for target, name, command in jobs:
+        dns = targets[target][0]
+        output_file = os.path.join(output_dir, f'{name}_{target}.txt')
+        future = executors[target].submit(run_job, sessions, target, dns, command, output_file)
+        futures[future] = (target, name)
+    results = []
+    try:
+        for future in as_completed(futures):
+            target, name = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # a target that can not be reached fails its own jobs, the other targets go on
+                result = {'target': target, 'status': None, 'errors': repr(e), 'output_file': None}
+            result['name'] = name
+            results.append(result)
+            if result['status'] == 0:
+                print(f"{name} on {target}: done in {result['seconds']:.0f}s -> {result['output_file']}")
+            else:
+                print(f"{name} on {target}: failed {result['errors'].strip()}")
+    finally:
+        for executor in executors.values():
+            executor.shutdown(wait=True)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--targets', nargs='+', default=['standalone', 'cluster'], choices=['standalone', 'cluster']) # machines to benchmark at the same time
+    parser.add_argument('--workloads', nargs='+', default=WORKLOADS, choices=WORKLOADS) # sysbench workloads run on each target, in this order
+    parser.add_argument('--threads', default=1, type=int) # sysbench client threads
+    parser.add_argument('--sweep', nargs='+', type=int, default=None) # thread counts to run each workload with (e.g. 1 2 4 8 16 32 64), instead of --threads
+    parser.add_argument('--time', default=60, type=int) # seconds each workload runs
+    parser.add_argument('--output-dir', default='.') # where the result files (<workload>_<target>.txt) are written
+    args = parser.parse_args()
+
+    all_targets = load_targets()
+    targets = {target: all_targets[target] for target in args.targets}
+    if args.sweep:
+        # a sweep runs the steps of a workload from the fewest threads to the most, the result files are <workload>_t<threads>_<target>.txt
+        jobs = [(target, f'{workload}_t{threads}', sysbench_command(workload, mysql_host, threads, args.time))
+                for target, (_, mysql_host) in targets.items() for workload in args.workloads for threads in sorted(args.sweep)]
+    else:
+        jobs = [(target, workload, sysbench_command(workload, mysql_host, args.threads, args.time))
+                for target, (_, mysql_host) in targets.items() for workload in args.workloads]
+
+    sessions = SSHSessions(private_key_path)
+    try:
+        start = time.time()
+        results = run_plan(targets, jobs, sessions, args.output_dir)
+        print(f'{len(results)} workloads run on {len(targets)} targets in {time.time() - start:.0f}s')
+    finally:
+        sessions.close()
+
+    # numbers of the runs that succeeded, and comparison of the cluster with the standalone server
+    runs = [sysbench_results.parse_file(result['output_file']) for result in results if result['status'] == 0]
+    sysbench_results.write_json(runs, os.path.join(args.output_dir, 'sysbench_results.json'))
+    sysbench_results.write_csv(runs, os.path.join(args.output_dir, 'sysbench_results.csv'))
+    comparison = sysbench_results.compare(runs)
+    sysbench_results.write_json(comparison, os.path.join(args.output_dir, 'sysbench_comparison.json'))
+    print(sysbench_results.format_comparison(comparison))
+    if args.sweep:
+        scaling = sysbench_results.scaling(runs)
+        sysbench_results.write_json(scaling, os.path.join(args.output_dir, 'sysbench_scaling.json'))
+        print(sysbench_results.format_scaling(scaling))
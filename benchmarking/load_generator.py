@@ -0,0 +1,264 @@
+"""
+This file contains an open loop http load generator for the proxy strategies and the gatekeeper
+The requests are sent at a target rate whatever the response times (open loop), spread over the chosen strategies,
+with a mix of read and write queries, and the latency of each strategy is recorded in an HDR style histogram
+
+The latency of a request is measured from the time it was scheduled, not from the time it was sent: when the server
+(or the concurrency cap) slows down, the waiting time of the requests that could not leave on time is counted too
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import aiohttp
+
+# example of  a read and write request, the same as the send_requests.py scripts
+read_query = 'select first_name, last_name, last_update from actor where actor_id=100;'
+write_query = "insert into actor (first_name, last_name, last_update) VALUES (' Altaaf', 'Abbassi', NOW());"
+
+# route of each strategy, the gatekeeper takes its queries on its root
+STRATEGY_PATHS = {
+    'direct_hit': '/direct_hit',
+    'random': '/random',
+    'customized': '/customized',
+    'auto': '/auto',
+    'least_outstanding': '/least_outstanding',
+    'p2c': '/p2c',
+    'gatekeeper': '/',
+}
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class LatencyHistogram:
+    """
+    Histogram of latencies in microseconds with a bounded relative error, in the style of HdrHistogram:
+    the values below 2 * sub_buckets are counted exactly, the bigger ones in buckets whose width doubles with each power of two,
+    so that every value is known with an error below 1 / sub_buckets (1% with the 128 sub buckets of 2 significant digits)
+    """
+
+    def __init__(self, significant_digits=2):
+        # smallest power of two holding 2 * 10^digits values, halved: 128 for 2 digits
+        self.sub_bucket_bits = (2 * 10 ** significant_digits).bit_length() - 1
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _key(self, value):
+        shift = max(0, value.bit_length() - self.sub_bucket_bits - 1)
+        return shift, value >> shift
+
+    def record(self, seconds):
+        value = max(0, int(seconds * 1e6))
+        key = self._key(value)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, percent):
+        """
+        Highest value (in seconds) of the bucket holding the given percentile
+        """
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(percent / 100 * self.count))
+        seen = 0
+        for shift, sub_bucket in sorted(self.counts, key=lambda key: key[1] << key[0]):
+            seen += self.counts[(shift, sub_bucket)]
+            if seen >= rank:
+                return min(((sub_bucket + 1) << shift) - 1, self.max) / 1e6
+        return self.max / 1e6
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+        summary = {'count': self.count, 'min': self.min / 1e6, 'mean': self.total / self.count / 1e6, 'max': self.max / 1e6}
+        summary.update({f'p{percent:g}': self.percentile(percent) for percent in PERCENTILES})
+        return summary
+
+
+class StrategyStats:
+
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.sent = 0
+        self.ok = 0
+        self.errors = {}  # kind of error (http status, timeout, connection error) -> count
+        self.queued = 0  # requests that waited for the concurrency cap before leaving
+
+    def error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def report(self, elapsed):
+        failed = sum(self.errors.values())
+        return {
+            'sent': self.sent,
+            'ok': self.ok,
+            'errors': dict(self.errors),
+            'error_rate': failed / self.sent if self.sent else 0.0,
+            'queued': self.queued,
+            'throughput': self.ok / elapsed if elapsed else 0.0,
+            'latency': self.latency.summary(),
+        }
+
+
+def load_queries(path, default):
+    if path is None:
+        return [default]
+    with open(path) as file:
+        queries = [line.strip() for line in file if line.strip() and not line.strip().startswith(('#', '--'))]
+    if not queries:
+        raise ValueError(f'no query in {path}')
+    return queries
+
+
+def arrival_times(rate, duration, poisson=False):
+    """
+    Offsets (in seconds from the start) at which the requests are scheduled: evenly spaced, or as a poisson process
+    """
+    offset = 0.0
+    while True:
+        offset += random.expovariate(rate) if poisson else 1 / rate
+        if offset >= duration:
+            return
+        yield offset
+
+
+async def send(session, url, query, stats, limit, scheduled, loop, timeout):
+    """
+    Send one query and record its latency from its scheduled time, or its error
+    """
+    if limit.locked():
+        stats.queued += 1
+    async with limit:
+        stats.sent += 1
+        try:
+            async with session.post(url, json={'query': query}, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                await response.read()
+                if response.status == 200:
+                    stats.ok += 1
+                    stats.latency.record(loop.time() - scheduled)
+                else:
+                    stats.error(f'http_{response.status}')
+        except asyncio.TimeoutError:
+            stats.error('timeout')
+        except aiohttp.ClientError as e:
+            stats.error(type(e).__name__)
+
+
+async def run(base_url, strategies, rate, duration, concurrency, read_queries, write_queries, read_ratio, poisson=False, timeout=10):
+    """
+    Send requests to the strategies (round robin) at rate requests per second for duration seconds,
+    at most concurrency of them in flight, return the report of each strategy and the elapsed time
+    """
+    loop = asyncio.get_running_loop()
+    stats = {strategy: StrategyStats() for strategy in strategies}
+    limit = asyncio.Semaphore(concurrency)
+    pending = set()
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start = loop.time()
+        for i, offset in enumerate(arrival_times(rate, duration, poisson)):
+            delay = start + offset - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            strategy = strategies[i % len(strategies)]
+            queries = read_queries if random.random() < read_ratio else write_queries
+            url = base_url.rstrip('/') + STRATEGY_PATHS[strategy]
+            task = asyncio.ensure_future(send(session, url, random.choice(queries), stats[strategy], limit, start + offset, loop, timeout))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        if pending:
+            await asyncio.gather(*pending)
+        elapsed = loop.time() - start
+    return {strategy: strategy_stats.report(elapsed) for strategy, strategy_stats in stats.items()}, elapsed
+
+
+async def start_stand_in(port, latency, error_rate):
+    """
+    Local stand-in of the proxy and the gatekeeper: every strategy route answers after latency seconds,
+    a fraction error_rate of the requests get a 500
+    """
+    from aiohttp import web
+
+    async def handler(request):
+        data = await request.json()
+        await asyncio.sleep(random.expovariate(1 / latency) if latency > 0 else 0)
+        if random.random() < error_rate:
+            return web.json_response({'error': 'stand-in error'}, status=500)
+        return web.json_response({'result': [[data['query'][:20]]]})
+
+    app = web.Application()
+    for path in set(STRATEGY_PATHS.values()):
+        app.router.add_post(path, handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner
+
+
+def format_report(report, elapsed):
+    lines = [f'{elapsed:.1f}s']
+    for strategy, result in report.items():
+        latency = result['latency']
+        lines.append(f"{strategy}: sent {result['sent']}, ok {result['ok']} ({result['throughput']:.1f}/s), "
+                     f"errors {result['error_rate'] * 100:.2f}%{' ' + str(result['errors']) if result['errors'] else ''}, queued {result['queued']}")
+        if latency['count']:
+            percentiles = ', '.join(f'p{percent:g} {latency[f"p{percent:g}"] * 1e3:.2f}' for percent in PERCENTILES)
+            lines.append(f"    latency ms: min {latency['min'] * 1e3:.2f}, mean {latency['mean'] * 1e3:.2f}, {percentiles}, "
+                         f"max {latency['max'] * 1e3:.2f}")
+    return '\n'.join(lines)
+
+
+async def main(args):
+    runner = None
+    base_url = args.url
+    if args.stand_in:
+        runner = await start_stand_in(args.stand_in_port, args.stand_in_latency, args.stand_in_error_rate)
+        base_url = f'http://127.0.0.1:{args.stand_in_port}'
+    try:
+        return await run(base_url, args.strategies, args.rate, args.duration, args.concurrency,
+                         load_queries(args.read_queries, read_query), load_queries(args.write_queries, write_query),
+                         args.read_ratio, poisson=args.poisson, timeout=args.timeout)
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+
+
+if __name__ == '__main__':
+    """
+    Main method of the load generator
+    1- start the local stand-in server when asked
+    2- send the requests at the target rate for the duration
+    3- print (and save) the throughput, error rate and latency percentiles of each strategy
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://127.0.0.1:5000') # base url of the proxy or of the gatekeeper
+    parser.add_argument('--strategies', nargs='+', default=['direct_hit', 'random', 'customized'], choices=list(STRATEGY_PATHS)) # routes the requests are spread over ('gatekeeper' is the gatekeeper root)
+    parser.add_argument('--rate', default=50, type=float) # requests per second sent in total, whatever the response times
+    parser.add_argument('--duration', default=30, type=float) # seconds during which requests are sent
+    parser.add_argument('--concurrency', default=100, type=int) # requests in flight at most, the next ones wait (and their wait is counted)
+    parser.add_argument('--poisson', action='store_true') # poisson arrivals instead of evenly spaced requests
+    parser.add_argument('--read-ratio', default=0.9, type=float) # fraction of the requests sending a read query
+    parser.add_argument('--read-queries', default=None) # file of read queries (one per line) used instead of read_query
+    parser.add_argument('--write-queries', default=None) # file of write queries (one per line) used instead of write_query
+    parser.add_argument('--timeout', default=10, type=float) # seconds before a request counts as a timeout
+    parser.add_argument('--output', default=None) # json file where the report is written
+    parser.add_argument('--stand-in', action='store_true') # send the requests to a local stand-in server instead of --url
+    parser.add_argument('--stand-in-port', default=5055, type=int) # port of the local stand-in server
+    parser.add_argument('--stand-in-latency', default=0.005, type=float) # mean response time of the stand-in server, in seconds
+    parser.add_argument('--stand-in-error-rate', default=0.0, type=float) # fraction of the stand-in responses that are errors
+    args = parser.parse_args()
+    if args.rate <= 0:
+        parser.error('--rate must be a positive number of requests per second')
+
+    report, elapsed = asyncio.run(main(args))
+    print(format_report(report, elapsed))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'elapsed': elapsed, 'rate': args.rate, 'strategies': report}, file, indent=4)
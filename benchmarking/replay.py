@@ -0,0 +1,179 @@
+"""
+This file contains the replayer of the query logs written by the proxy and the gatekeeper (--query-log, see query_log.py)
+Each logged request is sent again with its query, params and stream flag (or its queries for a batch), to its original
+strategy or to a chosen one, keeping the time between the requests of the log (divided by --speed to replay faster),
+and the latency of the replay is compared with the latency recorded in the log for each strategy
+The recorded latency is measured inside the proxy or the gatekeeper, the replayed one by this client (network included),
+so a replay of the log against the endpoint that recorded it gives the baseline of a comparison between endpoints
+"""
+import argparse
+import asyncio
+import json
+import aiohttp
+from load_generator import LatencyHistogram, STRATEGY_PATHS, PERCENTILES
+
+# the batches of the proxy are replayed on their own route
+REPLAY_PATHS = dict(STRATEGY_PATHS, batch='/batch')
+
+
+def read_log(paths, limit=None):
+    """
+    Read the lines of the query logs {"t": time, "s": strategy, "q": query, "l": latency, "c": status, ...},
+    return them sorted by time (the logs of several workers or machines are merged)
+    """
+    entries = []
+    for path in paths:
+        with open(path) as file:
+            for line in file:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # the last line of a log still being written can be cut
+                    continue
+    entries.sort(key=lambda entry: entry['t'])
+    return entries[:limit] if limit else entries
+
+
+class Comparison:
+    """
+    Recorded and replayed latencies of a strategy, plus the requests whose status changed
+    """
+
+    def __init__(self):
+        self.recorded = LatencyHistogram()
+        self.replayed = LatencyHistogram()
+        self.sent = 0
+        self.errors = {}
+        self.status_changed = 0
+
+    def report(self):
+        recorded, replayed = self.recorded.summary(), self.replayed.summary()
+        ratios = {}
+        for key in ['mean'] + [f'p{percent:g}' for percent in PERCENTILES]:
+            if recorded.get(key) and replayed.get(key) is not None:
+                ratios[key] = replayed[key] / recorded[key]
+        return {'sent': self.sent, 'errors': dict(self.errors), 'status_changed': self.status_changed,
+                'recorded': recorded, 'replayed': replayed, 'replayed_over_recorded': ratios}
+
+
+def request_body(entry, strategy=None):
+    """
+    Json body of a logged request: its query with its params and stream flag,
+    or for a batch its queries and options (the strategy of the batch becomes the given one)
+    """
+    if entry['s'] == 'batch':
+        body = dict(entry.get('o') or {}, queries=entry['q'])
+        if strategy is not None:
+            body['strategy'] = strategy
+        return body
+    body = {'query': entry['q']}
+    if 'p' in entry:
+        body['params'] = entry['p']
+    if entry.get('x'):
+        body['stream'] = True
+    return body
+
+
+async def replay_entry(session, url, body, entry, comparison, limit, scheduled, loop, timeout):
+    async with limit:
+        comparison.sent += 1
+        status = None
+        try:
+            async with session.post(url, json=body, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                await response.read()
+                status = response.status
+        except asyncio.TimeoutError:
+            comparison.errors['timeout'] = comparison.errors.get('timeout', 0) + 1
+        except aiohttp.ClientError as e:
+            comparison.errors[type(e).__name__] = comparison.errors.get(type(e).__name__, 0) + 1
+        if status is not None and status != 200:
+            comparison.errors[f'http_{status}'] = comparison.errors.get(f'http_{status}', 0) + 1
+        if status != entry['c']:
+            comparison.status_changed += 1
+        # the latencies of the requests that succeeded both times are compared
+        if status == 200 and entry['c'] == 200:
+            comparison.recorded.record(entry['l'])
+            comparison.replayed.record(loop.time() - scheduled)
+
+
+async def replay(entries, base_url, speed=1.0, strategy=None, concurrency=100, timeout=10):
+    """
+    Send the entries again, entry i leaving (t_i - t_0) / speed seconds after the start (as fast as possible when speed is 0),
+    to the strategy of the entry or to the given strategy, at most concurrency of them in flight
+    a batch keeps its route with the given strategy as its own, and is skipped when the gatekeeper is given (it has no batches)
+    Return the comparison report of each strategy and the elapsed time
+    """
+    loop = asyncio.get_running_loop()
+    comparisons = {}
+    limit = asyncio.Semaphore(concurrency)
+    pending = set()
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        start = loop.time()
+        first = entries[0]['t'] if entries else 0
+        for entry in entries:
+            if entry['s'] == 'batch':
+                target = 'batch' if strategy != 'gatekeeper' else None
+                body = request_body(entry, strategy)
+            else:
+                target = strategy or entry['s']
+                body = request_body(entry)
+            if target not in REPLAY_PATHS:
+                continue
+            offset = (entry['t'] - first) / speed if speed > 0 else 0
+            delay = start + offset - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            comparison = comparisons.setdefault(target, Comparison())
+            url = base_url.rstrip('/') + REPLAY_PATHS[target]
+            task = asyncio.ensure_future(replay_entry(session, url, body, entry, comparison, limit, start + offset, loop, timeout))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        if pending:
+            await asyncio.gather(*pending)
+        elapsed = loop.time() - start
+    return {target: comparison.report() for target, comparison in comparisons.items()}, elapsed
+
+
+def format_report(report, elapsed, recorded_duration):
+    lines = [f'replayed {recorded_duration:.1f}s of log in {elapsed:.1f}s']
+    for strategy, result in report.items():
+        lines.append(f"{strategy}: sent {result['sent']}, errors {result['errors'] or 0}, status changed {result['status_changed']}")
+        for key in ['mean'] + [f'p{percent:g}' for percent in PERCENTILES]:
+            recorded, replayed = result['recorded'].get(key), result['replayed'].get(key)
+            if recorded is None or replayed is None:
+                continue
+            ratio = result['replayed_over_recorded'].get(key)
+            lines.append(f"    {key}: recorded {recorded * 1e3:.2f} ms, replayed {replayed * 1e3:.2f} ms"
+                         + (f' (x{ratio:.2f})' if ratio is not None else ''))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    """
+    Main method of the replayer
+    1- read and merge the query logs
+    2- send their requests again with the original timing (or faster with --speed)
+    3- print (and save) the recorded and replayed latencies of each strategy
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('logs', nargs='+') # query log files written by the proxy or the gatekeeper (--query-log)
+    parser.add_argument('--url', default='http://127.0.0.1:5000') # base url of the proxy or of the gatekeeper to replay against
+    parser.add_argument('--speed', default=1.0, type=float) # 2 replays twice as fast as recorded, 0 sends everything at once
+    parser.add_argument('--strategy', default=None, choices=list(STRATEGY_PATHS)) # send every request to this strategy instead of the logged one
+    parser.add_argument('--concurrency', default=100, type=int) # requests in flight at most
+    parser.add_argument('--timeout', default=10, type=float) # seconds before a request counts as a timeout
+    parser.add_argument('--limit', default=None, type=int) # replay only the first entries of the log
+    parser.add_argument('--output', default=None) # json file where the comparison is written
+    args = parser.parse_args()
+
+    entries = read_log(args.logs, args.limit)
+    report, elapsed = asyncio.run(replay(entries, args.url, args.speed, args.strategy, args.concurrency, args.timeout))
+    recorded_duration = entries[-1]['t'] - entries[0]['t'] if entries else 0
+    print(format_report(report, elapsed, recorded_duration))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'elapsed': elapsed, 'recorded_duration': recorded_duration, 'speed': args.speed, 'strategies': report},
+                      file, indent=4)
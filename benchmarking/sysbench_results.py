@@ -0,0 +1,237 @@
+"""
+This file contains the parsing of the sysbench results saved by benchmark.py (<workload>_<target>.txt, or
+<workload>_t<threads>_<target>.txt for a thread sweep)
+The numbers of each run (tps, qps, latency, errors, reconnects) are extracted and written as json or csv,
+the runs of the cluster are compared with the runs of the standalone server, and the runs of a sweep give the knee point
+of each target and workload: the thread count after which the throughput stops growing while the latency takes off
+"""
+import argparse
+import csv
+import glob
+import json
+import os
+import re
+
+# fields of a parsed run, in the order of the csv columns
+FIELDS = ['workload', 'target', 'threads', 'sweep', 'tps', 'qps', 'latency_min', 'latency_avg', 'latency_p95', 'latency_max',
+          'errors', 'reconnects', 'total_time', 'events']
+
+# pattern of each number in the sysbench output, the latencies are in milliseconds
+_PATTERNS = {
+    'threads': r'Number of threads:\s*(\d+)',
+    'tps': r'transactions:\s*\d+\s*\(([\d.]+) per sec\.\)',
+    'qps': r'queries:\s*\d+\s*\(([\d.]+) per sec\.\)',
+    'errors': r'ignored errors:\s*(\d+)',
+    'reconnects': r'reconnects:\s*(\d+)',
+    'total_time': r'total time:\s*([\d.]+)s',
+    'events': r'total number of events:\s*(\d+)',
+    'latency_min': r'min:\s*([\d.]+)',
+    'latency_avg': r'avg:\s*([\d.]+)',
+    'latency_max': r'max:\s*([\d.]+)',
+    'latency_p95': r'95th percentile:\s*([\d.]+)',
+}
+_PATTERNS = {field: re.compile(pattern) for field, pattern in _PATTERNS.items()}
+
+# the latencies are read in the "Latency (ms):" section only, "min:" and "max:" appear elsewhere too
+_LATENCY_SECTION_RE = re.compile(r'Latency \(ms\):(.*?)(?:\n\s*\n|\Z)', re.S)
+_LATENCY_FIELDS = ('latency_min', 'latency_avg', 'latency_max', 'latency_p95')
+
+_FILE_NAME_RE = re.compile(r'^(?P<workload>.+?)(?:_t(?P<threads>\d+))?_(?P<target>[^_]+)\.txt$')
+
+# a step of a sweep saturates when its throughput grows by less than MIN_TPS_GAIN (10%) over the previous step
+# and its p95 latency is more than MAX_P95_GROWTH times the one of the previous step (a p95 growing alone is the normal
+# cost of more threads queuing, e.g. 100 -> 190 tps with a p95 going from 5 to 8 ms still scales)
+MIN_TPS_GAIN = 0.1
+MAX_P95_GROWTH = 1.5
+
+
+def _number(text):
+    return float(text) if '.' in text else int(text)
+
+
+def parse(text):
+    """
+    Extract the numbers of a sysbench run from its output, a number missing from the output is None
+    """
+    latency_match = _LATENCY_SECTION_RE.search(text)
+    latency_text = latency_match.group(1) if latency_match else ''
+    result = {}
+    for field, pattern in _PATTERNS.items():
+        match = pattern.search(latency_text if field in _LATENCY_FIELDS else text)
+        result[field] = _number(match.group(1)) if match else None
+    return result
+
+
+def parse_file(path):
+    """
+    Parse a result file named <workload>_<target>.txt, the workload and target come from the name
+    a file named <workload>_t<threads>_<target>.txt is a step of a sweep (its 'sweep' field is True)
+    """
+    name = _FILE_NAME_RE.match(os.path.basename(path))
+    with open(path) as file:
+        result = parse(file.read())
+    result['workload'] = name.group('workload') if name else os.path.basename(path)
+    result['target'] = name.group('target') if name else None
+    result['sweep'] = bool(name and name.group('threads'))
+    if result['threads'] is None and result['sweep']:
+        result['threads'] = int(name.group('threads'))
+    return {field: result[field] for field in FIELDS}
+
+
+def parse_dir(directory):
+    """
+    Parse all the result files of a directory, the files that are not sysbench outputs are skipped
+    """
+    results = []
+    for path in sorted(glob.glob(os.path.join(directory, '*.txt'))):
+        result = parse_file(path)
+        if result['tps'] is not None:
+            results.append(result)
+    return results
+
+
+def write_json(results, path):
+    with open(path, 'w') as file:
+        json.dump(results, file, indent=4)
+
+
+def write_csv(results, path):
+    with open(path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def _ratio(numerator, denominator):
+    if numerator is None or not denominator:
+        return None
+    return numerator / denominator
+
+
+def compare(results, baseline='standalone', candidate='cluster'):
+    """
+    Compare the runs of the candidate with the runs of the baseline with the same workload (and threads)
+    - tps_speedup: candidate tps / baseline tps, above 1 when the candidate has the highest throughput
+    - p95_speedup: baseline p95 latency / candidate p95 latency, above 1 when the candidate answers faster
+    """
+    runs = {(result['workload'], result['threads'], result['target']): result for result in results}
+    rows = []
+    for (workload, threads, target), base in sorted(runs.items(), key=lambda item: (item[0][0], item[0][1] or 0)):
+        other = runs.get((workload, threads, candidate))
+        if target != baseline or other is None:
+            continue
+        rows.append({
+            'workload': workload,
+            'threads': threads,
+            f'{baseline}_tps': base['tps'],
+            f'{candidate}_tps': other['tps'],
+            'tps_speedup': _ratio(other['tps'], base['tps']),
+            f'{baseline}_p95': base['latency_p95'],
+            f'{candidate}_p95': other['latency_p95'],
+            'p95_speedup': _ratio(base['latency_p95'], other['latency_p95']),
+        })
+    return rows
+
+
+def find_knee(steps, min_tps_gain=MIN_TPS_GAIN, max_p95_growth=MAX_P95_GROWTH):
+    """
+    Knee point of a sweep, steps being the runs of one target and workload sorted by threads
+    Return (index of the knee step or None when no step saturates, reason)
+    The knee is the last step before the first saturated one (see MIN_TPS_GAIN and MAX_P95_GROWTH), the throughput
+    alone decides when a step has no p95 latency
+    """
+    for i in range(1, len(steps)):
+        previous, step = steps[i - 1], steps[i]
+        tps_gain = _ratio(step['tps'], previous['tps'])
+        p95_growth = _ratio(step['latency_p95'], previous['latency_p95'])
+        if tps_gain is None or tps_gain - 1 >= min_tps_gain:
+            continue
+        if p95_growth is None:
+            return i - 1, f"throughput grows by {(tps_gain - 1) * 100:.0f}% from {previous['threads']} to {step['threads']} threads"
+        if p95_growth > max_p95_growth:
+            return i - 1, (f"throughput grows by {(tps_gain - 1) * 100:.0f}% and p95 latency x{p95_growth:.2f} "
+                           f"from {previous['threads']} to {step['threads']} threads")
+    return None, 'no saturation up to the last step'
+
+
+def scaling(results, min_tps_gain=MIN_TPS_GAIN, max_p95_growth=MAX_P95_GROWTH):
+    """
+    Scaling of each target and workload with the threads: its steps (threads, tps, p95) and its knee point
+    only the steps of a sweep are used, not the runs of the same workload with --threads
+    """
+    sweeps = {}
+    for result in results:
+        if result['sweep'] and result['threads'] is not None:
+            sweeps.setdefault((result['target'], result['workload']), []).append(result)
+    rows = []
+    for (target, workload), steps in sorted(sweeps.items()):
+        steps.sort(key=lambda step: step['threads'])
+        knee, reason = find_knee(steps, min_tps_gain, max_p95_growth)
+        rows.append({
+            'target': target,
+            'workload': workload,
+            'steps': [{'threads': step['threads'], 'tps': step['tps'], 'latency_p95': step['latency_p95']} for step in steps],
+            'knee_threads': steps[knee]['threads'] if knee is not None else None,
+            'knee_tps': steps[knee]['tps'] if knee is not None else None,
+            'knee_p95': steps[knee]['latency_p95'] if knee is not None else None,
+            'reason': reason,
+        })
+    return rows
+
+
+def format_scaling(rows):
+    """
+    Text of the scaling rows: tps and p95 at each thread count, then the knee point
+    """
+    lines = []
+    for row in rows:
+        steps = ', '.join(f"{step['threads']}: {step['tps']} tps / {step['latency_p95']} ms" for step in row['steps'])
+        knee = f"knee at {row['knee_threads']} threads" if row['knee_threads'] is not None else 'no knee'
+        lines.append(f"{row['workload']} on {row['target']}: {knee} ({row['reason']})\n    {steps}")
+    return '\n'.join(lines) if lines else 'no sweep to report'
+
+
+def format_comparison(rows):
+    """
+    Text table of the comparison rows
+    """
+    if not rows:
+        return 'no run to compare'
+    columns = list(rows[0])
+
+    def cell(value):
+        if value is None:
+            return '-'
+        if isinstance(value, float):
+            return f'{value:.2f}'
+        return str(value)
+
+    table = [columns] + [[cell(row[column]) for column in columns] for row in rows]
+    widths = [max(len(line[i]) for line in table) for i in range(len(columns))]
+    return '\n'.join('  '.join(value.ljust(width) for value, width in zip(line, widths)).rstrip() for line in table)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', default='.') # directory of the result files (<workload>_<target>.txt)
+    parser.add_argument('--json', default='sysbench_results.json') # file where the parsed runs are written as json, empty to skip
+    parser.add_argument('--csv', default='sysbench_results.csv') # file where the parsed runs are written as csv, empty to skip
+    parser.add_argument('--comparison', default='sysbench_comparison.json') # file where the comparison is written as json, empty to skip
+    parser.add_argument('--scaling', default='') # file where the knee points of a thread sweep are written as json, empty to skip
+    parser.add_argument('--min-tps-gain', default=MIN_TPS_GAIN, type=float) # throughput gain below which a sweep step is saturated
+    parser.add_argument('--max-p95-growth', default=MAX_P95_GROWTH, type=float) # p95 latency growth above which a sweep step with a flat throughput is saturated
+    args = parser.parse_args()
+
+    results = parse_dir(args.dir)
+    if args.json:
+        write_json(results, args.json)
+    if args.csv:
+        write_csv(results, args.csv)
+    rows = compare(results)
+    if args.comparison:
+        write_json(rows, args.comparison)
+    print(format_comparison(rows))
+    if args.scaling:
+        scaling_rows = scaling(results, args.min_tps_gain, args.max_p95_growth)
+        write_json(scaling_rows, args.scaling)
+        print(format_scaling(scaling_rows))
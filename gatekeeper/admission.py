@@ -0,0 +1,138 @@
+"""
+This file contains the admission control of the gatekeeper
+Requests are admitted against token buckets (one per client ip and a global one) and a limit of requests in flight,
+a request over a limit is shed at once with 429/503 and a Retry-After header instead of queuing in front of the trusted host
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+
+# a limit set to 0 is disabled
+LIMITS = ('global_rate', 'global_burst', 'client_rate', 'client_burst', 'max_in_flight')
+
+# the limits can only be changed by requests coming from the gatekeeper machine itself
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+
+class TokenBucket:
+    """
+    Bucket of at most burst tokens refilled at rate tokens per second, a request takes one token
+    """
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, rate, burst, now):
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+    def wait(self, rate):
+        """
+        seconds before a token is available (0 when there is one now)
+        """
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / rate
+
+
+class AdmissionController:
+    """
+    Decides if a request can be forwarded to the trusted host
+    - max_in_flight: number of requests admitted and not finished yet, over it the request gets 503
+    - client_rate/client_burst: token bucket per client ip, when empty the request gets 429
+    - global_rate/global_burst: token bucket shared by all the clients, when empty the request gets 429
+    a shed request does not take any token, and the buckets of the max_clients most recent clients only are kept
+    the limits can be changed at runtime with configure()
+    """
+
+    def __init__(self, global_rate=0, global_burst=0, client_rate=0, client_burst=0, max_in_flight=0, max_clients=10000):
+        self.max_clients = max_clients
+        self.limits = {}
+        self._lock = threading.Lock()
+        self._global_bucket = None
+        self._client_buckets = OrderedDict()  # client ip -> TokenBucket
+        self._in_flight = 0
+        self._counters = {'admitted': 0, 'shed_client_rate': 0, 'shed_global_rate': 0, 'shed_in_flight': 0}
+        self.configure(global_rate=global_rate, global_burst=global_burst, client_rate=client_rate,
+                       client_burst=client_burst, max_in_flight=max_in_flight)
+
+    def configure(self, **limits):
+        """
+        Change some limits (names in LIMITS), a burst left to 0 with a rate set defaults to one second of this rate,
+        and a burst is never below 1 when its rate is set: a bucket holding less than one token would never admit a request
+        Return the limits in use
+        """
+        unknown = set(limits) - set(LIMITS)
+        if unknown:
+            raise ValueError(f'unknown limits: {", ".join(sorted(unknown))}')
+        for name, value in limits.items():
+            if value is None or float(value) < 0:
+                raise ValueError(f'{name} must be a positive number')
+        with self._lock:
+            self.limits.update({name: float(value) for name, value in limits.items()})
+            for scope in ('global', 'client'):
+                if self.limits.get(f'{scope}_rate'):
+                    # e.g. a burst of 1 shared out between 2 prefork workers is raised back to 1
+                    self.limits[f'{scope}_burst'] = max(1.0, self.limits.get(f'{scope}_burst') or self.limits[f'{scope}_rate'])
+            # buckets restart full with the new limits
+            self._global_bucket = None
+            self._client_buckets.clear()
+            return dict(self.limits)
+
+    def _bucket(self, scope, client, now):
+        if scope == 'global':
+            if self._global_bucket is None:
+                self._global_bucket = TokenBucket(self.limits['global_burst'], now)
+            return self._global_bucket
+        bucket = self._client_buckets.get(client)
+        if bucket is None:
+            bucket = self._client_buckets[client] = TokenBucket(self.limits['client_burst'], now)
+            if len(self._client_buckets) > self.max_clients:
+                self._client_buckets.popitem(last=False)
+        else:
+            self._client_buckets.move_to_end(client)
+        return bucket
+
+    def admit(self, client):
+        """
+        Admit a request of the given client, return None when it is admitted (release() must then be called once it is done)
+        or (status, reason, retry_after seconds) when it is shed
+        """
+        now = time.monotonic()
+        with self._lock:
+            limits = self.limits
+            if limits['max_in_flight'] and self._in_flight >= limits['max_in_flight']:
+                self._counters['shed_in_flight'] += 1
+                return 503, 'Too many requests in flight', 1
+
+            buckets = []
+            for scope in ('client', 'global'):
+                rate, burst = limits[f'{scope}_rate'], limits[f'{scope}_burst']
+                if not rate:
+                    continue
+                bucket = self._bucket(scope, client, now)
+                bucket.refill(rate, burst, now)
+                wait = bucket.wait(rate)
+                if wait:
+                    self._counters[f'shed_{scope}_rate'] += 1
+                    return 429, f'{scope.capitalize()} rate limit exceeded', max(1, math.ceil(wait))
+                buckets.append(bucket)
+
+            for bucket in buckets:
+                bucket.tokens -= 1
+            self._in_flight += 1
+            self._counters['admitted'] += 1
+            return None
+
+    def release(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['shed'] = stats['shed_client_rate'] + stats['shed_global_rate'] + stats['shed_in_flight']
+            stats['in_flight'] = self._in_flight
+            stats['clients'] = len(self._client_buckets)
+            stats['limits'] = dict(self.limits)
+        return stats
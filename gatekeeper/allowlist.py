@@ -0,0 +1,85 @@
+"""
+This file contains the allowlist of query templates of the gatekeeper
+The approved templates are read from a file and compiled into a set of normalized templates: a query is checked by
+normalizing it (one regex pass) and looking it up in the set, which lets the known queries skip sqlvalidator
+"""
+import re
+import threading
+from validation import EXECUTABLE_COMMENT_RE, fingerprint
+
+FALLBACK = 'fallback'  # queries not in the allowlist go through the full validation
+STRICT = 'strict'  # queries not in the allowlist are rejected
+MODES = (FALLBACK, STRICT)
+
+# results of Allowlist.check
+ALLOWED = 'allowed'
+REJECTED = 'rejected'
+VALIDATE = 'validate'
+
+# a list of placeholders, e.g. IN (?, ?, ?), matches any number of values
+_PLACEHOLDER_LIST_RE = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+
+
+def template(query):
+    """
+    Normalized template of a query or of an allowlist line: literals (and ?) become ?, lists of them become (?),
+    comments and extra spaces are removed, case and the last ; are ignored
+    e.g. "SELECT * FROM actor WHERE actor_id IN (1, 2)" -> "select * from actor where actor_id in (?)"
+    """
+    normalized = _PLACEHOLDER_LIST_RE.sub('(?)', fingerprint(query, typed=False).lower())
+    return normalized.rstrip(';').rstrip()
+
+
+def load_templates(path):
+    """
+    Read an allowlist file: one template per line, literals written as ? or as example values,
+    empty lines and lines starting with # or -- are skipped
+    """
+    templates = set()
+    with open(path) as file:
+        for line in file:
+            line = line.strip()
+            if line and not line.startswith(('#', '--')):
+                templates.add(template(line))
+    return frozenset(templates)
+
+
+class Allowlist:
+    """
+    Approved query templates of the gatekeeper
+    - check(query) returns ALLOWED for a query matching a template, otherwise VALIDATE in fallback mode and REJECTED in strict mode
+    - reload() reads the file again, the templates in use are kept when it can not be read
+    - the counters tell how many queries took each path
+    """
+
+    def __init__(self, path, mode=FALLBACK):
+        if mode not in MODES:
+            raise ValueError(f'unknown allowlist mode: {mode}')
+        self.path = path
+        self.mode = mode
+        self.templates = load_templates(path)
+        self._lock = threading.Lock()
+        self._counters = {ALLOWED: 0, VALIDATE: 0, REJECTED: 0, 'reloads': 0}
+
+    def reload(self):
+        templates = load_templates(self.path)
+        # a single assignment, the requests being checked see either the old or the new templates
+        self.templates = templates
+        with self._lock:
+            self._counters['reloads'] += 1
+        return len(templates)
+
+    def check(self, query):
+        if EXECUTABLE_COMMENT_RE.search(query) is None and template(query) in self.templates:
+            path = ALLOWED
+        else:
+            path = REJECTED if self.mode == STRICT else VALIDATE
+        with self._lock:
+            self._counters[path] += 1
+        return path
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats.update({'mode': self.mode, 'templates': len(self.templates), 'path': self.path})
+        return stats
@@ -0,0 +1,4 @@
+# templates of the queries allowed without a full validation (python gatekeeper.py --allowlist allowlist.sql)
+# one query per line, literals written as ? or as example values
+select first_name, last_name, last_update from actor where actor_id=?;
+INSERT INTO actor (first_name, last_name, last_update) VALUES (?, ?, NOW());
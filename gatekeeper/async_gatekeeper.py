@@ -0,0 +1,251 @@
+"""
+This file contains the asyncio serving mode of the gatekeeper (python gatekeeper.py --mode async)
+The forwards to the trusted host go through an aiohttp client session with a pool of keep-alive connections,
+so a slow trusted host keeps requests waiting on the event loop instead of holding gatekeeper threads
+"""
+import asyncio
+import time
+import aiohttp
+from aiohttp import web
+from admission import LOCAL_ADDRESSES
+from allowlist import ALLOWED, REJECTED
+import transport
+from coalescer import AsyncCoalescer, coalescing_key
+from metrics import aiohttp_middleware, metrics_handler
+from query_log import aiohttp_middleware as query_log_middleware
+from validation import fingerprint, is_read_only
+
+# errors of a forward that could not connect to the trusted host (aiohttp 3.10 tells connect timeouts from read timeouts)
+CONNECT_ERRORS = (aiohttp.ClientConnectorError,) + ((aiohttp.ConnectionTimeoutError,) if hasattr(aiohttp, 'ConnectionTimeoutError') else ())
+
+
+class AsyncGatekeeper:
+    """
+    asyncio version of the gatekeeper, same admission control, same checks, same balancing between the trusted hosts
+    and same retry policy as TrustedHostClient:
+    a forward that could not connect is retried, and a read only query is also retried after a connection reset
+    identical read only queries in flight are forwarded once when coalescing is true
+    """
+
+    def __init__(self, trusted_hosts, validation_cache, admission, transport_headers, allowlist=None, metrics=None, query_log=None, coalescing=True,
+                 pool_size=20, connect_timeout=2, read_timeout=30, retries=2):
+        self.trusted_hosts = trusted_hosts
+        self.transport_headers = transport_headers
+        self.validation_cache = validation_cache
+        self.admission = admission
+        self.allowlist = allowlist
+        self.metrics = metrics
+        self.query_log = query_log
+        self.coalescer = AsyncCoalescer() if coalescing else None
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.session = None
+        self._counters = {'forwarded': 0, 'retries': 0, 'errors': 0}
+
+    async def on_startup(self, app):
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.pool_size, keepalive_timeout=60)
+        timeout = aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+        # compressed bodies are kept as they are, to be relayed without decompressing them
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout, auto_decompress=False)
+
+    async def on_cleanup(self, app):
+        await self.session.close()
+
+    async def forward(self, url, data, read_only):
+        """
+        send the data to the given trusted host and return the response, its body is not read yet
+        """
+        attempt = 0
+        while True:
+            try:
+                response = await self.session.post(url, json=data, headers=self.transport_headers)
+                self._counters['forwarded'] += 1
+                return response
+            except aiohttp.ClientConnectionError as e:
+                retryable = read_only or isinstance(e, aiohttp.ClientConnectorError)
+                if attempt >= self.retries or not retryable:
+                    self._counters['errors'] += 1
+                    raise
+                attempt += 1
+                self._counters['retries'] += 1
+            except asyncio.TimeoutError:
+                self._counters['errors'] += 1
+                raise
+
+    async def gatekeeper(self, request):
+        """
+        admission control first, like the flask gatekeeper, then check_and_forward
+        """
+        shed = self.admission.admit(request.remote)
+        if shed is not None:
+            status, reason, retry_after = shed
+            return web.json_response({'error': reason}, status=status, headers={'Retry-After': str(retry_after)})
+        try:
+            return await self.check_and_forward(request)
+        finally:
+            self.admission.release()
+
+    async def check_and_forward(self, request):
+        """
+        same steps as the flask gatekeeper:
+        1- check if the body of the request contains a query
+        2- check the query against the allowlist, then validate it when needed (sqlvalidator runs in a thread,
+           its parse would block the event loop)
+        3- forward the request to the trusted host, relaying the NDJSON chunks as they arrive when the result is streamed
+        the msgpack result of the trusted host goes as it is to the clients accepting msgpack, and as json to the others
+        """
+        start = time.perf_counter()
+        data = await request.json()
+        self.observe('decode', start)
+        query = data.get('query')
+        if query is None:
+            return web.json_response({'error': 'Query not provided'}, status=400)
+        start = time.perf_counter()
+        valid, reason = await self.check_query(query)
+        self.observe('validate', start)
+        if not valid:
+            return web.json_response({'error': 'Query not valid', 'reason': reason}, status=400)
+        stream = bool(data.get('stream', False))
+        data = {'query': query, 'stream': stream}
+        read_only = is_read_only(fingerprint(query))
+        key = coalescing_key(query) if read_only and self.coalescer is not None else None
+        start = time.perf_counter()
+        try:
+            if stream:
+                url, response = await self.open_stream(data, read_only)
+            elif key is not None:
+                status, body, content_type, content_encoding = await self.coalescer.do(
+                    key, lambda: self.forward_buffered(data, read_only))
+            else:
+                status, body, content_type, content_encoding = await self.forward_buffered(data, read_only)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return web.json_response({'error': 'Trusted host unreachable', 'reason': str(e)}, status=502)
+        self.observe('forward', start)
+        if stream:
+            try:
+                return await self.relay_stream(request, response)
+            finally:
+                self.trusted_hosts.release(url)
+        start = time.perf_counter()
+        body, content_type, content_encoding = transport.relay(body, content_type, content_encoding, request.headers.get('Accept'),
+                                                               request.headers.get('Accept-Encoding'))
+        self.observe('serialize', start)
+        headers = {'Content-Encoding': content_encoding} if content_encoding is not None else None
+        return web.Response(body=body, status=status, content_type=content_type, headers=headers)
+
+    def observe(self, stage, start):
+        if self.metrics is not None:
+            self.metrics.observe(stage, time.perf_counter() - start)
+
+    async def check_query(self, query):
+        if self.allowlist is not None:
+            path = self.allowlist.check(query)
+            if path == ALLOWED:
+                return True, None
+            if path == REJECTED:
+                return False, 'Query not in the allowlist'
+        return await asyncio.get_running_loop().run_in_executor(None, self.validation_cache.validate, query)
+
+    async def forward_buffered(self, data, read_only):
+        """
+        forward a query to the trusted host picked by the balancing,
+        return its whole response as (status, body, content type, content encoding)
+        """
+        url = self.trusted_hosts.pick()
+        self.trusted_hosts.acquire(url)
+        failed = False
+        try:
+            async with await self.forward(url, data, read_only) as response:
+                return response.status, await response.read(), response.content_type, response.headers.get('Content-Encoding')
+        except CONNECT_ERRORS:
+            # only a host that could not be reached counts as failing, a slow query (read timeout) says nothing of its health
+            failed = True
+            raise
+        finally:
+            self.trusted_hosts.release(url, failed)
+
+    async def open_stream(self, data, read_only):
+        """
+        forward a streamed query to the trusted host picked by the balancing and return (url, response),
+        the query stays in flight on this host until release(url) is called once the stream is relayed
+        """
+        url = self.trusted_hosts.pick()
+        self.trusted_hosts.acquire(url)
+        try:
+            return url, await self.forward(url, data, read_only)
+        except BaseException as e:
+            self.trusted_hosts.release(url, failed=isinstance(e, CONNECT_ERRORS))
+            raise
+
+    async def relay_stream(self, request, response):
+        """
+        relay the NDJSON chunks of a streamed trusted host response as they arrive
+        """
+        async with response:
+            relayed = web.StreamResponse(status=response.status)
+            relayed.content_type = response.content_type or 'application/x-ndjson'
+            await relayed.prepare(request)
+            async for chunk in response.content.iter_any():
+                await relayed.write(chunk)
+            await relayed.write_eof()
+            return relayed
+
+    async def stats(self, request):
+        return web.json_response({
+            'validation_cache': self.validation_cache.stats(),
+            'forwarder': dict(self._counters, pool_size=self.pool_size),
+            'admission': self.admission.stats(),
+            'coalescer': self.coalescer.stats() if self.coalescer is not None else {},
+            'allowlist': self.allowlist.stats() if self.allowlist is not None else {},
+            'trusted_hosts': self.trusted_hosts.stats(),
+            'query_log': self.query_log.stats() if self.query_log is not None else {},
+        })
+
+    async def allowlist_reload(self, request):
+        """
+        read the allowlist file again, only from the gatekeeper machine
+        """
+        if request.remote not in LOCAL_ADDRESSES:
+            return web.json_response({'error': 'The allowlist can only be reloaded from the gatekeeper machine'}, status=403)
+        if self.allowlist is None:
+            return web.json_response({'error': 'No allowlist in use'}, status=400)
+        try:
+            count = self.allowlist.reload()
+        except (OSError, ValueError) as e:
+            return web.json_response({'error': str(e)}, status=400)
+        return web.json_response({'templates': count})
+
+    async def admission_limits(self, request):
+        """
+        read (GET) or change (POST from the gatekeeper machine) the admission limits at runtime
+        """
+        if request.method == 'GET':
+            return web.json_response(self.admission.stats()['limits'])
+        if request.remote not in LOCAL_ADDRESSES:
+            return web.json_response({'error': 'Limits can only be changed from the gatekeeper machine'}, status=403)
+        try:
+            limits = self.admission.configure(**(await request.json() or {}))
+        except (TypeError, ValueError) as e:
+            return web.json_response({'error': str(e)}, status=400)
+        return web.json_response(limits)
+
+    def make_app(self):
+        middlewares = [aiohttp_middleware(self.metrics)] if self.metrics is not None else []
+        if self.query_log is not None:
+            middlewares.append(query_log_middleware(self.query_log))
+        app = web.Application(middlewares=middlewares)
+        if self.metrics is not None:
+            app.router.add_get('/metrics', metrics_handler(self.metrics))
+        app.router.add_post('/', self.gatekeeper)
+        app.router.add_get('/stats', self.stats)
+        app.router.add_get('/admission', self.admission_limits)
+        app.router.add_post('/admission', self.admission_limits)
+        app.router.add_post('/allowlist/reload', self.allowlist_reload)
+        app.on_startup.append(self.on_startup)
+        app.on_cleanup.append(self.on_cleanup)
+        return app
+
+    def run(self, host='0.0.0.0', port=5000):
+        web.run_app(self.make_app(), host=host, port=port)
@@ -0,0 +1,113 @@
+"""
+This file contains the coalescing of identical reads in the gatekeeper
+While a read only query is being forwarded, the same query (same text) arriving from other clients
+waits for the forward in flight and gets its response, instead of becoming another query on the mysql manager
+"""
+import asyncio
+import threading
+from validation import EXECUTABLE_COMMENT_RE
+
+
+def coalescing_key(query):
+    """
+    Key under which a read only query is coalesced: its text as sent, only the spaces around it are dropped
+    (a normalized text would merge queries differing by a comment, whose content mysql may run)
+    None for the queries with executable comments or hints, they are never coalesced
+    """
+    if EXECUTABLE_COMMENT_RE.search(query):
+        return None
+    return query.strip()
+
+
+class _Call:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Coalescer:
+    """
+    Single flight of identical calls for the threaded gatekeeper
+    do(key, fn) runs fn once for all the callers asking for the same key at the same time, they all get its result
+    (or its exception), the key is forgotten as soon as fn returns so that later callers run it again
+    only read only queries must be given to it, a write has to be executed once per request
+    """
+
+    def __init__(self):
+        self._calls = {}  # key -> _Call in flight
+        self._lock = threading.Lock()
+        self._counters = {'forwarded': 0, 'merged': 0}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self._counters['forwarded'] += 1
+            else:
+                self._counters['merged'] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['in_flight'] = len(self._calls)
+        requests = stats['forwarded'] + stats['merged']
+        stats['merge_rate'] = stats['merged'] / requests if requests else 0.0
+        return stats
+
+
+class AsyncCoalescer:
+    """
+    Same single flight for the asyncio gatekeeper, fn is a coroutine function run in its own task, awaited by all the callers
+    """
+
+    def __init__(self):
+        self._calls = {}  # key -> task of the call in flight
+        self._counters = {'forwarded': 0, 'merged': 0}
+
+    async def do(self, key, fn):
+        task = self._calls.get(key)
+        if task is not None:
+            self._counters['merged'] += 1
+        else:
+            # the call does not run in the task of the caller starting it, so that this caller being cancelled
+            # (e.g. its client went away) does not cancel the call the others wait for
+            task = self._calls[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda done: self._forget(key, done))
+            self._counters['forwarded'] += 1
+        # a caller giving up must not cancel the call of the others
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # the exception is raised to the callers, it does not have to be retrieved from the task when nobody waits for it anymore
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self):
+        stats = dict(self._counters)
+        stats['in_flight'] = len(self._calls)
+        requests = stats['forwarded'] + stats['merged']
+        stats['merge_rate'] = stats['merged'] / requests if requests else 0.0
+        return stats
@@ -14,3 +14,5 @@ trusted_host_path = '' # the path trsuted host source code on host machine
 
 gatekeeper_source_code = ''# the path gatekeeer source code locally
 trusted_host_source_code = '' # the path trsuted host source code locally
+
+trusted_host_count = 2 # number of trusted host machines behind the gatekeeper
@@ -0,0 +1,97 @@
+"""
+This file contains the http client used by the gatekeeper to forward the queries to the trusted host
+A single requests session keeps a pool of keep-alive connections to the trusted host, so a forward does not pay
+a tcp handshake and does not leave a TIME_WAIT socket behind
+"""
+import threading
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+
+def is_connect_error(error):
+    """
+    Whether a requests error happened before the request was sent (the trusted host can not have executed the query)
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    # urllib3 wraps the socket error in MaxRetryError(reason=NewConnectionError(...))
+    reason = getattr(reason, 'reason', reason)
+    return type(reason).__name__ in ('NewConnectionError', 'ConnectTimeoutError')
+
+
+class TrustedHostClient:
+    """
+    Pooled keep-alive client to the trusted host
+    - at most pool_size connections are kept open per trusted host, a forward waits for a free one when they are all in use
+    - connect_timeout and read_timeout bound the time spent connecting and waiting for the trusted host
+    - a forward that fails before reaching the trusted host is retried, as well as a read only query whose
+      connection was reset (e.g. an idle keep-alive connection closed by the trusted host),
+      a write whose connection was reset is not retried because the trusted host may have executed it
+    """
+
+    def __init__(self, pool_size=20, connect_timeout=2, read_timeout=30, retries=2):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.session = requests.Session()
+        # retries are done here, urllib3 must not resend a write on its own
+        # one pool of pool_size connections per trusted host
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=pool_size, pool_block=True, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._lock = threading.Lock()
+        self._counters = {'forwarded': 0, 'retries': 0, 'errors': 0}
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def post(self, url, data, stream=False, read_only=False, headers=None):
+        """
+        Send the data as json to the trusted host and return its response
+        when stream is true the body is not read, the caller has to close the response
+        """
+        attempt = 0
+        while True:
+            try:
+                response = self.session.post(url, json=data, headers=headers, stream=stream,
+                                             timeout=(self.connect_timeout, self.read_timeout))
+                self._count('forwarded')
+                return response
+            except requests.exceptions.ConnectionError as e:
+                retryable = read_only or is_connect_error(e)
+                if attempt >= self.retries or not retryable:
+                    self._count('errors')
+                    raise
+                attempt += 1
+                self._count('retries')
+            except requests.exceptions.RequestException:
+                self._count('errors')
+                raise
+
+    def post_raw(self, url, data, read_only=False, headers=None):
+        """
+        Same as post, but return (status, body, content type, content encoding) with the body exactly as sent by
+        the trusted host: a compressed body is not decompressed, so that it can be relayed as it is
+        """
+        response = self.post(url, data, stream=True, read_only=read_only, headers=headers)
+        try:
+            body = response.raw.read(decode_content=False)
+        except urllib3.exceptions.HTTPError as e:
+            self._count('errors')
+            raise requests.exceptions.ConnectionError(e)
+        finally:
+            response.close()
+        return response.status_code, body, response.headers.get('Content-Type'), response.headers.get('Content-Encoding')
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats['pool_size'] = self.pool_size
+        return stats
+
+    def close(self):
+        self.session.close()
@@ -1,50 +1,360 @@
 """
 This file contains the flasp application for the gatekeeper, that will be copied to the gatekeeper ec2 machine
 """
-from flask import Flask, request, jsonify
-import sqlvalidator
+from flask import Flask, Response, request, jsonify, make_response, stream_with_context
+import argparse
 import json
+import math
 import requests
+import prefork
+import transport
+from admission import AdmissionController, LOCAL_ADDRESSES
+from allowlist import Allowlist, ALLOWED, REJECTED, MODES
+from forwarder import TrustedHostClient, is_connect_error
+from coalescer import Coalescer, coalescing_key
+from trusted_hosts import TrustedHosts, STRATEGIES as TRUSTED_STRATEGIES
+from validation import ValidationCache, fingerprint, is_read_only
+from metrics import Metrics, instrument_flask
+from query_log import QueryLog, log_flask
 
 app = Flask(__name__)
 
+# latency histograms of the stages of the requests (decode, validate, forward, serialize), exposed on /metrics
+# (added up over all the workers with the prefork mode)
+metrics = Metrics('gatekeeper')
+instrument_flask(app, metrics, gather=lambda: prefork.gather('metrics'))
+prefork.on_message('metrics', lambda payload: metrics.snapshot())
+
 
 TRUSTED_HOST_PORT = 5000 # the port on which the trusted app is running
 TRSUTED_URL_TEMPLATE = "http://{}:{}" # template of the url of the trust app
 
 
-# getting deatil of the machine where the trusted is running
+# file with the details of the machines where the trusted hosts are running (trusted_host, trusted_host_2, ...)
 gatekeepr_instances_details = 'gatekeeper_instance_details.json'
-with open(gatekeepr_instances_details) as file: 
-    gate_trusted_instance_details = json.load(file)
-for detail in gate_trusted_instance_details:
-    if detail['Name'] == 'trusted_host':
-        trusted_detail = detail
-        break
 
+# balancing between the trusted hosts, created by setup, their health is checked in the background once the gatekeeper runs
+trusted_hosts = None
+
+# verdicts of sqlvalidator memoized per query fingerprint
+validation_cache = ValidationCache()
+
+# approved query templates that skip sqlvalidator, None when no allowlist is given
+allowlist = None
+
+# pooled keep-alive http client to the trusted hosts
+trusted_client = TrustedHostClient()
+
+# results are asked to the trusted host as msgpack, compressed when they are big
+TRANSPORT_HEADERS = {'Accept': f'{transport.MSGPACK}, {transport.JSON}', 'Accept-Encoding': transport.DEFLATE}
+
+# identical read only queries in flight are forwarded once, None when coalescing is disabled
+coalescer = Coalescer()
+
+# rate limits and limit of requests in flight, requests over them are shed
+admission = AdmissionController()
+
+# limits of the whole gatekeeper (command line, then POST /admission), each worker of the prefork mode applies its share of them
+admission_limits = {}
+
+# number of serving processes, set by setup
+WORKERS = 1
+
+# append-only log of the query requests, None when no log file is given
+query_log = None
 
 
 @app.route('/', methods=['POST'])
 def gatekeeper():
+    """
+    Admission control first: a request over the rate limits of its client or of the gatekeeper gets 429,
+    and a request arriving while too many requests are in flight gets 503, both with a Retry-After header
+    The admitted requests are checked and forwarded by check_and_forward
+    """
+    shed = admission.admit(request.remote_addr)
+    if shed is not None:
+        status, reason, retry_after = shed
+        return jsonify({'error': reason}), status, {'Retry-After': str(retry_after)}
+    try:
+        response = make_response(check_and_forward(request.json))
+    except BaseException:
+        admission.release()
+        raise
+    if response.is_streamed:
+        # the request stays in flight until its stream is fully relayed
+        response.call_on_close(admission.release)
+    else:
+        admission.release()
+    return response
+
+
+def check_and_forward(data):
     """
     Our proposed gatekeeper checks the requests in two steps:
     1- check if the body of the request contains a query 
-    2- validate the query using sql validator library
-    If these two tests are passed, then forward the request to the trusted host 
+    2- validate the query: a query matching a template of the allowlist is accepted at once, the others are rejected (strict mode)
+       or validated with sql validator library (the verdict is memoized per query fingerprint)
+    If these two tests are passed, then forward the request to a healthy trusted host over a pooled keep-alive connection
+    When the request asks for a streamed result, the NDJSON rows of the trusted host are relayed as they arrive
+    Identical read only queries in flight at the same time are forwarded once and share the response of the trusted host
+    The msgpack result of the trusted host is relayed as it is to the clients accepting msgpack, and as json to the others
     """
-    data = request.json
     query = data.get('query')
     if query is None:
         return jsonify({'error': 'Query not provided'}), 400
-    if not sqlvalidator.parse(query).is_valid():
-        return jsonify({'error': 'Query not valid'}), 400
-    headers = {'Content-Type': 'application/json'}
-    data = {'query': query}
-    url = TRSUTED_URL_TEMPLATE.format(trusted_detail['PrivateIP'], TRUSTED_HOST_PORT)
-    response = requests.post(url, json=data, headers=headers)
-    print(url)
-    return jsonify(response.json()), response.status_code
+    with metrics.stage('validate'):
+        valid, reason = check_query(query)
+    if not valid:
+        return jsonify({'error': 'Query not valid', 'reason': reason}), 400
+    stream = bool(data.get('stream', False))
+    data = {'query': query, 'stream': stream}
+    read_only = is_read_only(fingerprint(query))
+    try:
+        with metrics.stage('forward'):
+            if stream:
+                return forward_stream(data, read_only)
+            key = coalescing_key(query) if read_only and coalescer is not None else None
+            if key is not None:
+                status, body, content_type, content_encoding = coalescer.do(key, lambda: forward(data, read_only))
+            else:
+                status, body, content_type, content_encoding = forward(data, read_only)
+    except requests.exceptions.RequestException as e:
+        return jsonify({'error': 'Trusted host unreachable', 'reason': str(e)}), 502
+    with metrics.stage('serialize'):
+        body, content_type, content_encoding = transport.relay(body, content_type, content_encoding, request.headers.get('Accept'),
+                                                               request.headers.get('Accept-Encoding'))
+    response = Response(body, status=status, content_type=content_type)
+    if content_encoding is not None:
+        response.headers['Content-Encoding'] = content_encoding
+    return response
+
+
+def forward(data, read_only):
+    """
+    forward a query to the trusted host picked by the balancing, return (status, body, content type, content encoding)
+    """
+    url = trusted_hosts.pick()
+    trusted_hosts.acquire(url)
+    failed = False
+    try:
+        return trusted_client.post_raw(url, data, read_only=read_only, headers=TRANSPORT_HEADERS)
+    except requests.exceptions.RequestException as e:
+        # only a host that could not be reached counts as failing, a slow query (read timeout) says nothing of its health
+        failed = is_connect_error(e)
+        raise
+    finally:
+        trusted_hosts.release(url, failed)
+
+
+def forward_stream(data, read_only):
+    """
+    forward a streamed query to the trusted host picked by the balancing, it stays in flight on this host until the stream ends
+    """
+    url = trusted_hosts.pick()
+    trusted_hosts.acquire(url)
+    try:
+        response = trusted_client.post(url, data, stream=True, read_only=read_only)
+    except requests.exceptions.RequestException as e:
+        trusted_hosts.release(url, failed=is_connect_error(e))
+        raise
+    except BaseException:
+        trusted_hosts.release(url)
+        raise
+    return relay_stream(response, on_close=lambda: trusted_hosts.release(url))
+
+
+def check_query(query):
+    """
+    return (valid, reason) for a query, going through the allowlist first when there is one
+    """
+    if allowlist is not None:
+        path = allowlist.check(query)
+        if path == ALLOWED:
+            return True, None
+        if path == REJECTED:
+            return False, 'Query not in the allowlist'
+    return validation_cache.validate(query)
+
+
+def relay_stream(response, on_close=None):
+    """
+    send the chunks of a streamed trusted host response to the client as soon as they are received, without buffering them
+    on_close is called once, when the stream ends or the client goes away
+    """
+    closed = []
+
+    def close():
+        if not closed:
+            closed.append(True)
+            response.close()
+            if on_close is not None:
+                on_close()
+
+    def generate():
+        try:
+            for chunk in response.iter_content(chunk_size=None):
+                yield chunk
+        finally:
+            close()
+
+    relayed = Response(stream_with_context(generate()), status=response.status_code,
+                       content_type=response.headers.get('Content-Type', 'application/x-ndjson'))
+    relayed.call_on_close(close)
+    return relayed
+
+
+@app.route('/stats', methods=['GET'])
+def stats_endpoint():
+    """
+    Return the statistics of the gatekeeper: hit rate of the validation cache, forwards to the trusted host,
+    shed requests, merged reads, queries taking each path of the allowlist and health of the trusted hosts
+    """
+    return jsonify({'validation_cache': validation_cache.stats(), 'forwarder': trusted_client.stats(),
+                    'admission': admission.stats(), 'coalescer': coalescer.stats() if coalescer is not None else {},
+                    'allowlist': allowlist.stats() if allowlist is not None else {}, 'trusted_hosts': trusted_hosts.stats(),
+                    'query_log': query_log.stats() if query_log is not None else {}})
+
+
+def share_limits(limits, workers):
+    """
+    share of one worker of the admission limits of the gatekeeper: the rates and bursts are divided between the workers,
+    the requests in flight are rounded up so that each worker can take one at least (a negative limit stays negative,
+    to be rejected by the admission control)
+    """
+    return {name: math.ceil(value / workers) if name == 'max_in_flight' and value > 0 else value / workers
+            for name, value in limits.items()}
+
+
+def configure_admission(limits):
+    """
+    change the limits of the gatekeeper (all or some of them), return all of them
+    """
+    global admission_limits
+    limits = dict(admission_limits, **limits)
+    admission.configure(**share_limits(limits, WORKERS))
+    admission_limits = limits
+    return limits
+
+
+# the changes of POST /admission and POST /allowlist/reload made in a worker of the prefork mode are applied by all of them
+prefork.on_message('admission', configure_admission)
+prefork.on_message('allowlist_reload', lambda payload: allowlist.reload())
+
+
+def admission_response():
+    return jsonify({'limits': admission_limits, 'workers': WORKERS, 'worker_limits': admission.stats()['limits']})
+
+
+@app.route('/admission', methods=['GET', 'POST'])
+def admission_endpoint():
+    """
+    Read (GET) or change (POST, e.g. {"client_rate": 50, "max_in_flight": 32}) the admission limits at runtime
+    the limits are the ones of the whole gatekeeper, with the prefork mode every worker applies its share of them
+    only requests coming from the gatekeeper machine itself can change them
+    """
+    if request.method == 'GET':
+        return admission_response()
+    if request.remote_addr not in LOCAL_ADDRESSES:
+        return jsonify({'error': 'Limits can only be changed from the gatekeeper machine'}), 403
+    try:
+        limits = configure_admission(request.json or {})
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    # all the limits are sent, a worker replacing one that dies gets the last message only
+    prefork.broadcast('admission', limits)
+    return admission_response()
+
+
+@app.route('/allowlist/reload', methods=['POST'])
+def allowlist_reload_endpoint():
+    """
+    Read the allowlist file again, only from the gatekeeper machine
+    """
+    if request.remote_addr not in LOCAL_ADDRESSES:
+        return jsonify({'error': 'The allowlist can only be reloaded from the gatekeeper machine'}), 403
+    if allowlist is None:
+        return jsonify({'error': 'No allowlist in use'}), 400
+    try:
+        count = allowlist.reload()
+    except (OSError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    # the file was read fine here, the other workers read it as well
+    prefork.broadcast('allowlist_reload')
+    return jsonify({'templates': count})
+
+
+def load_trusted_urls():
+    """
+    getting deatil of the machines where the trusted hosts are running, return the url of each trusted app
+    """
+    with open(gatekeepr_instances_details) as file: 
+        gate_trusted_instance_details = json.load(file)
+    trusted_details = [detail for detail in gate_trusted_instance_details if detail['Name'].startswith('trusted_host')]
+    return [TRSUTED_URL_TEMPLATE.format(detail['PrivateIP'], TRUSTED_HOST_PORT) for detail in trusted_details]
+
+
+def setup(args, workers=1):
+    """
+    set up a serving process: trusted hosts and their health checks, validation, allowlist, admission and forwarding
+    with the prefork mode it runs once in each worker, and each worker gets its share of the rate and in flight limits
+    (a worker only sees the requests it accepts, so the limits given on the command line stay the limits of the gatekeeper)
+    """
+    global trusted_hosts, trusted_client, coalescer, allowlist, query_log, TRANSPORT_HEADERS, WORKERS
+    WORKERS = workers
+    validation_cache.max_size = args.validation_cache_size
+    if args.no_coalescing:
+        coalescer = None
+    if args.allowlist is not None:
+        allowlist = Allowlist(args.allowlist, args.allowlist_mode)
+    if args.transport == 'json':
+        TRANSPORT_HEADERS = {'Accept': transport.JSON}
+    configure_admission({'client_rate': args.client_rate, 'client_burst': args.client_burst, 'global_rate': args.global_rate,
+                         'global_burst': args.global_burst, 'max_in_flight': args.max_in_flight})
+    trusted_hosts = TrustedHosts(load_trusted_urls(), strategy=args.trusted_strategy, check_interval=args.health_interval,
+                                 eject_after=args.eject_after, readmit_after=args.readmit_after)
+    trusted_hosts.start()
+    trusted_client = TrustedHostClient(pool_size=args.forward_pool_size, connect_timeout=args.connect_timeout,
+                                       read_timeout=args.read_timeout, retries=args.forward_retries)
+    if args.query_log:
+        query_log = QueryLog(args.query_log)
+        if args.mode == 'flask':
+            log_flask(app, query_log)
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', default='flask', choices=['flask', 'async']) # flask threads or asyncio (aiohttp) forwarding
+    parser.add_argument('--validation-cache-size', default=10000, type=int) # number of query fingerprints whose verdict is kept
+    parser.add_argument('--forward-pool-size', default=20, type=int) # keep-alive connections kept open to the trusted host
+    parser.add_argument('--connect-timeout', default=2, type=float) # seconds to connect to the trusted host
+    parser.add_argument('--read-timeout', default=30, type=float) # seconds to wait for the trusted host to answer
+    parser.add_argument('--forward-retries', default=2, type=int) # retries of a forward failing to connect (or reset, for reads)
+    parser.add_argument('--client-rate', default=0, type=float) # requests per second allowed per client ip, 0 for no limit
+    parser.add_argument('--client-burst', default=0, type=float) # requests a client can send at once above its rate
+    parser.add_argument('--global-rate', default=0, type=float) # requests per second allowed for all the clients, 0 for no limit
+    parser.add_argument('--global-burst', default=0, type=float) # requests all the clients can send at once above the global rate
+    parser.add_argument('--max-in-flight', default=64, type=int) # requests forwarded at the same time, 0 for no limit
+    parser.add_argument('--transport', default='msgpack', choices=['msgpack', 'json']) # encoding of the results sent by the trusted host
+    parser.add_argument('--allowlist', default=None, type=str) # file of the query templates that skip sqlvalidator
+    parser.add_argument('--allowlist-mode', default='fallback', choices=MODES) # queries not in the allowlist: validated (fallback) or rejected (strict)
+    parser.add_argument('--trusted-strategy', default='round_robin', choices=TRUSTED_STRATEGIES) # how requests are spread over the trusted hosts
+    parser.add_argument('--health-interval', default=2, type=float) # seconds between two health checks of the trusted hosts
+    parser.add_argument('--eject-after', default=2, type=int) # failed checks in a row before a trusted host stops getting requests
+    parser.add_argument('--readmit-after', default=2, type=int) # successful checks in a row before an ejected trusted host gets requests again
+    parser.add_argument('--no-coalescing', action='store_true') # forward every read, even when the same one is already in flight
+    parser.add_argument('--query-log', default=None) # file where every query request is appended (see query_log.py), none by default
+    parser.add_argument('--workers', default=0, type=int) # flask serving processes (prefork, SIGHUP reloads them), 0 for the single process server
+    args = parser.parse_args()
+    if args.mode == 'async' and args.workers:
+        parser.error('--workers is only supported by the flask mode')
+
+    if args.workers:
+        prefork.serve(app, host='0.0.0.0', port=5000, workers=args.workers, init=lambda worker_id: setup(args, args.workers))
+    elif args.mode == 'async':
+        setup(args)
+        from async_gatekeeper import AsyncGatekeeper
+        AsyncGatekeeper(trusted_hosts, validation_cache, admission, TRANSPORT_HEADERS, allowlist=allowlist, metrics=metrics, query_log=query_log, coalescing=not args.no_coalescing, pool_size=args.forward_pool_size,
+                        connect_timeout=args.connect_timeout, read_timeout=args.read_timeout, retries=args.forward_retries).run(host='0.0.0.0', port=5000)
+    else:
+        setup(args)
+        app.run(host='0.0.0.0', port=5000, threaded=True)
@@ -9,6 +9,7 @@ import json
 import base64
 from constants import security_group_name, key_pair_name, ImageId, subnet_id, arn, cluster_details, gatekeper_trusted_details
 from constants import private_key_path, gatekeeper_host_path, trusted_host_path, gatekeeper_source_code, trusted_host_source_code
+from constants import trusted_host_count
 import time
 from utils import upload_file_to_ec2, check_command_status, send_command
 
@@ -122,12 +123,12 @@ gatekeeper_instance_instance_info = {
     }
 
 
-# lanch 1 ec2 instance t2.large for trsuted host, wait until lunch and assign a name
-trusted_instance = ec2_resource.create_instances(
+# lanch trusted_host_count ec2 instances t2.large for trsuted hosts, wait until lunch and assign a name
+trusted_instances = ec2_resource.create_instances(
     ImageId=ImageId,
     InstanceType='t2.large',
-    MaxCount=1,
-    MinCount=1,
+    MaxCount=trusted_host_count,
+    MinCount=trusted_host_count,
     KeyName='my_key_pair',
     UserData=user_data_encoded,
     IamInstanceProfile={'Arn': arn},
@@ -148,30 +149,46 @@ trusted_instance = ec2_resource.create_instances(
     ],
 )
 
-# retrieve the trusted host instance details to be sabed in json file to be used to send the requests
-trusted_instance = trusted_instance[0]
-trusted_instance.wait_until_running()
-trusted_instance.load()
-instance_name = 'trusted_host'
-trusted_instance.create_tags(Tags=[{'Key': 'Name', 'Value': instance_name}])
-trusted_instance_info = {
-        'Name': instance_name,
-        'InstanceID': trusted_instance.id,
-        'PrivateIP': trusted_instance.private_ip_address,
-        'PublicDNS': trusted_instance.public_dns_name,
-        'PublicIP': trusted_instance.public_ip_address
-    }
-
-# save instances data: trsuted host and gatekeeper
+# retrieve the trusted host instances details to be sabed in json file to be used to send the requests
+# they are named trusted_host, trusted_host_2, trusted_host_3 ... the gatekeeper uses every entry starting with trusted_host
+trusted_instances_info = []
+for i, trusted_instance in enumerate(trusted_instances):
+    trusted_instance.wait_until_running()
+    trusted_instance.load()
+    instance_name = 'trusted_host' if i == 0 else f'trusted_host_{i + 1}'
+    trusted_instance.create_tags(Tags=[{'Key': 'Name', 'Value': instance_name}])
+    trusted_instances_info.append({
+            'Name': instance_name,
+            'InstanceID': trusted_instance.id,
+            'PrivateIP': trusted_instance.private_ip_address,
+            'PublicDNS': trusted_instance.public_dns_name,
+            'PublicIP': trusted_instance.public_ip_address
+        })
+
+# save instances data: trsuted hosts and gatekeeper
 with open('gatekeeper_instance_details.json', 'w') as file:
-    json.dump([trusted_instance_info, gatekeeper_instance_instance_info], file, indent=4)
+    json.dump(trusted_instances_info + [gatekeeper_instance_instance_info], file, indent=4)
+
 
+# the modules imported by trusted_host.py, they live next to it
+trusted_host_modules = ['trusted_pool.py', 'transport.py']
 
-# copy the cluster detail to trusted machine
-upload_file_to_ec2(trusted_instance, cluster_details, os.path.join(trusted_host_path, os.path,basename(cluster_details)), private_key_path)
+# the modules shared with the proxy application, they live at the root of the repository
+shared_modules = ['metrics.py', 'prefork.py', 'query_log.py']
+shared_modules_dir = os.path.dirname(os.path.dirname(os.path.abspath(gatekeeper_source_code)))
 
-# copt the trusted flak application to the trusted machine
-upload_file_to_ec2(trusted_instance, trusted_host_source_code, os.path.join(trusted_host_path, os.path,basename(trusted_host_source_code)), private_key_path)
+for trusted_instance in trusted_instances:
+    # copy the cluster detail to trusted machine
+    upload_file_to_ec2(trusted_instance, cluster_details, os.path.join(trusted_host_path, os.path.basename(cluster_details)), private_key_path)
+
+    # copt the trusted flak application to the trusted machine
+    upload_file_to_ec2(trusted_instance, trusted_host_source_code, os.path.join(trusted_host_path, os.path.basename(trusted_host_source_code)), private_key_path)
+
+    # copy the modules imported by trusted_host.py
+    for module in trusted_host_modules:
+        upload_file_to_ec2(trusted_instance, os.path.join(os.path.dirname(trusted_host_source_code), module), os.path.join(trusted_host_path, module), private_key_path)
+    for module in shared_modules:
+        upload_file_to_ec2(trusted_instance, os.path.join(shared_modules_dir, module), os.path.join(trusted_host_path, module), private_key_path)
 
 # copy the gatekeeper machine deails to the gatekeepr machine
 upload_file_to_ec2(gatekeeper_instance, gatekeper_trusted_details, os.path.join(gatekeeper_host_path, os.path.basename(gatekeper_trusted_details)), private_key_path)
@@ -179,6 +196,14 @@ upload_file_to_ec2(gatekeeper_instance, gatekeper_trusted_details, os.path.join(
 # copy the gatekeeper flask application source code to gatekeeper instance
 upload_file_to_ec2(gatekeeper_instance, gatekeeper_source_code, os.path.join(gatekeeper_host_path, os.path.basename(gatekeeper_source_code)), private_key_path)
 
+# copy the modules imported by gatekeeper.py and its allowlist, they live next to it
+gatekeeper_modules = ['validation.py', 'forwarder.py', 'async_gatekeeper.py', 'admission.py', 'coalescer.py', 'transport.py',
+                      'allowlist.py', 'allowlist.sql', 'trusted_hosts.py']
+for module in gatekeeper_modules:
+    upload_file_to_ec2(gatekeeper_instance, os.path.join(os.path.dirname(gatekeeper_source_code), module), os.path.join(gatekeeper_host_path, module), private_key_path)
+for module in shared_modules:
+    upload_file_to_ec2(gatekeeper_instance, os.path.join(shared_modules_dir, module), os.path.join(gatekeeper_host_path, module), private_key_path)
+
 
 # preparing and installing dependencies for gatekeeper and run the application 
 gatekeeper_commands = [
@@ -189,7 +214,9 @@ gatekeeper_commands = [
     'pip install Flask', # install flask 
     'pip install sqlvalidator',  # install sqlvalidator 
     'pip install requests', # install requesrs
-    'python gatekeeper.py' # run gatekeeper flask application
+    'pip install aiohttp', # install aiohttp, used by the async forwarding mode
+    'pip install msgpack', # install msgpack, encoding of the results sent by the trusted host
+    'python gatekeeper.py --workers 2' # run gatekeeper flask application, one worker process per vcpu of the t2.large
 
 ]
 
@@ -212,18 +239,20 @@ trsuted_host_commands = [
     'pip install flask', # install flask 
     'pip install mysql-connector-python',  # install mysql-connector-python 
     'pip install requests', # install requesrs
-    'python trusted_host.py'  # run trusted host flask application
+    'pip install msgpack', # install msgpack, encoding of the results sent to the gatekeeper
+    'python trusted_host.py --workers 2'  # run trusted host flask application, one worker process per vcpu of the t2.large
 ]
 
-# execute configuration commands on trsuted_host_ machine
-for i in range(len(trsuted_host_commands)):
-    command = trsuted_host_commands[i]
-    command_id = send_command([trusted_instance], command, ssm_client)
-    status = check_command_status(command_id, trusted_instance, ssm_client)
-    print(f"Status for instance {trusted_instance} on command '{command}': {status['Status']}, {status['StatusDetails']}")
-    if status['Status'] != 'Success':
-        print(f"Command execution failed on instance {trusted_instance} for command '{command}'")
-        break  
+# execute configuration commands on each trsuted_host_ machine
+for trusted_instance in trusted_instances:
+    for i in range(len(trsuted_host_commands)):
+        command = trsuted_host_commands[i]
+        command_id = send_command([trusted_instance], command, ssm_client)
+        status = check_command_status(command_id, trusted_instance, ssm_client)
+        print(f"Status for instance {trusted_instance} on command '{command}': {status['Status']}, {status['StatusDetails']}")
+        if status['Status'] != 'Success':
+            print(f"Command execution failed on instance {trusted_instance} for command '{command}'")
+            break  
 
 ## At this the infrastructure is set, configured, trusted machine and gatekeeper machine and up and running
 ## To test and send requests, we use the script: gatekeeper/send_requests.py 
\ No newline at end of file
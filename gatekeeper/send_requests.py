@@ -1,6 +1,7 @@
 import requests
 import json
 import argparse
+import msgpack
 
 
 ## Example of read and write sql queries
@@ -22,15 +23,25 @@ for detail in gate_trusted_instance_details:
 
 
 
-def send_request(query, host=gatekeeper['PublicIP']):
+def send_request(query, host=gatekeeper['PublicIP'], stream=False, use_msgpack=False):
     """
     This method servers to send a post request to the gatekeeper and puts the provided query in teh body of the request
+    with use_msgpack the result is received as msgpack (as sent by the trusted host) and decoded here
     """
     headers = {'Content-Type': 'application/json'} 
-    data = {'query': query}
+    if use_msgpack:
+        headers['Accept'] = 'application/msgpack, application/json'
+    data = {'query': query, 'stream': stream}
     url = url_template.format(host, port)
-    response = requests.post(url, json=data,headers=headers)
+    response = requests.post(url, json=data,headers=headers, stream=stream)
     print(response)
+    if stream:
+        # rows are printed as they arrive, one JSON array per line
+        for line in response.iter_lines():
+            print(line.decode('utf-8'))
+        return ''
+    if response.headers.get('Content-Type', '').startswith('application/msgpack'):
+        return msgpack.unpackb(response.content, raw=False)
     return response.text
 
 
@@ -42,6 +53,8 @@ if __name__== "__main__":
     """
     parser = argparse.ArgumentParser()
     parser.add_argument('--query', default='read', type=str) 
+    parser.add_argument('--stream', action='store_true') # receive the rows as a stream instead of a single payload
+    parser.add_argument('--msgpack', action='store_true') # receive the result as msgpack instead of json
     args = parser.parse_args()
 
     if args.query == 'read':
@@ -49,5 +62,5 @@ if __name__== "__main__":
     else:
         query = write_query
     
-    response = send_request(query)
+    response = send_request(query, stream=args.stream, use_msgpack=args.msgpack)
     print(response)
@@ -0,0 +1,61 @@
+"""
+Tests of the coalescing of identical reads (python -m pytest gatekeeper)
+"""
+import asyncio
+import pytest
+
+pytest.importorskip('sqlvalidator')
+from coalescer import AsyncCoalescer, coalescing_key
+
+
+def test_coalescing_key_is_the_text_as_sent():
+    assert coalescing_key('  select * from actor where actor_id=1 \n') == 'select * from actor where actor_id=1'
+    assert coalescing_key('select * from actor where actor_id=1 /* a */') != coalescing_key('select * from actor where actor_id=1 /* b */')
+
+
+def test_executable_comments_are_not_coalesced():
+    assert coalescing_key('select * from actor /*!50000 where 1=1 */') is None
+    assert coalescing_key('select /*+ MAX_EXECUTION_TIME(1000) */ * from actor') is None
+
+
+def test_followers_get_the_result_when_the_leader_is_cancelled():
+    async def scenario():
+        coalescer = AsyncCoalescer()
+        release = asyncio.Event()
+        calls = []
+
+        async def forward():
+            calls.append(1)
+            await release.wait()
+            return 'rows'
+
+        leader = asyncio.ensure_future(coalescer.do('select 1', forward))
+        await asyncio.sleep(0)
+        followers = [asyncio.ensure_future(coalescer.do('select 1', forward)) for _ in range(2)]
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*followers)
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return calls, results, coalescer.stats()
+
+    calls, results, stats = asyncio.run(scenario())
+    assert calls == [1]
+    assert results == ['rows', 'rows']
+    assert stats['forwarded'] == 1 and stats['merged'] == 2 and stats['in_flight'] == 0
+
+
+def test_followers_get_the_exception_of_the_call():
+    async def scenario():
+        coalescer = AsyncCoalescer()
+
+        async def forward():
+            await asyncio.sleep(0.01)
+            raise ConnectionError('trusted host down')
+
+        return await asyncio.gather(*(coalescer.do('select 1', forward) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert [type(result) for result in results] == [ConnectionError] * 3
@@ -0,0 +1,81 @@
+"""
+This file contains the encoding of the results sent by the trusted host to the gatekeeper
+Results are encoded with msgpack instead of json, and compressed with deflate above a size threshold,
+the gatekeeper relays these bytes as they are to the clients accepting msgpack, and converts them to json for the others
+"""
+import datetime
+import decimal
+import email.utils
+import json
+import zlib
+import msgpack
+
+MSGPACK = 'application/msgpack'
+JSON = 'application/json'
+DEFLATE = 'deflate'
+
+
+def _default(value):
+    """
+    encode the values returned by mysql that msgpack and json do not know, the same way flask jsonify does
+    """
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return email.utils.format_datetime(value, usegmt=True)
+    if isinstance(value, datetime.date):
+        return email.utils.format_datetime(datetime.datetime(value.year, value.month, value.day, tzinfo=datetime.timezone.utc), usegmt=True)
+    if isinstance(value, (decimal.Decimal, datetime.timedelta)):
+        return str(value)
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value).decode('utf-8', 'replace')
+    raise TypeError(f'{type(value).__name__} can not be encoded')
+
+
+def accepts(header, value):
+    """
+    whether an Accept or Accept-Encoding header lists the given value
+    """
+    return any(part.split(';')[0].strip() == value for part in (header or '').split(','))
+
+
+def encode(data, compress_threshold=0, deflate=False):
+    """
+    Encode data with msgpack, compressed with deflate when it is allowed and the payload is bigger than compress_threshold bytes
+    Return (body, content encoding or None)
+    """
+    body = msgpack.packb(data, default=_default, use_bin_type=True)
+    if deflate and compress_threshold and len(body) > compress_threshold:
+        return zlib.compress(body, 1), DEFLATE
+    return body, None
+
+
+def decode(body, content_encoding=None):
+    if content_encoding == DEFLATE:
+        body = zlib.decompress(body)
+    return msgpack.unpackb(body, raw=False)
+
+
+def to_json(data):
+    """
+    json text of data as flask jsonify writes it, used when a msgpack result goes to a json client
+    """
+    return json.dumps(data, default=_default, separators=(',', ':'), sort_keys=True) + '\n'
+
+
+def relay(body, content_type, content_encoding, accept, accept_encoding):
+    """
+    Convert a trusted host response body for a client with the given Accept and Accept-Encoding headers
+    Return (body, content type, content encoding or None):
+    - a msgpack body goes through untouched when the client accepts msgpack and its encoding
+    - it is only decompressed when the client accepts msgpack but not deflate
+    - it is decoded and written as json for the other clients
+    other bodies (json errors of the trusted host) go through untouched
+    """
+    if not content_type or not content_type.startswith(MSGPACK):
+        return body, content_type, content_encoding
+    if accepts(accept, MSGPACK):
+        if content_encoding and not accepts(accept_encoding, content_encoding):
+            return zlib.decompress(body), MSGPACK, None
+        return body, MSGPACK, content_encoding
+    return to_json(decode(body, content_encoding)).encode('utf-8'), JSON, None
@@ -1,41 +1,198 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask import json as flask_json
+from werkzeug.serving import WSGIRequestHandler
+import argparse
+import time
 import mysql.connector
 import json 
+import prefork
+import transport
+from trusted_pool import TrustedPool, PoolExhausted, is_timeout
+from metrics import Metrics, instrument_flask
 
 app = Flask(__name__)
 
-# get the details about the ec2 machine where the manager of mysql cluster is deployed
-with open('cluster_instances_details.json') as file: 
-    cluster_data = json.load(file)
-for data in cluster_data:
-    if data['Name'] == 'manager':
-        master_config = {
-            'host': data['PublicDNS'],
-            'user': 'root',
-            'password': '',
-            'database': 'sakila',
-        }
-        break
+# latency histograms of the stages of the requests (decode, connect, execute, fetch, serialize), exposed on /metrics
+# (added up over all the workers with the prefork mode)
+metrics = Metrics('trusted_host')
+instrument_flask(app, metrics, gather=lambda: prefork.gather('metrics'))
+prefork.on_message('metrics', lambda payload: metrics.snapshot())
+
+# number of rows read from mysql and written to the gatekeeper at once when a result is streamed
+STREAM_CHUNK_ROWS = 1000
+
+# pool of connections to the manager, created by setup
+trusted_pool = None
+
+# msgpack results bigger than this number of bytes are compressed with deflate, 0 to never compress
+COMPRESS_THRESHOLD = 4096
+
+
+def respond(data):
+    """
+    encode a result with msgpack when the gatekeeper accepts it (compressed when big enough), with json otherwise
+    """
+    if not transport.accepts(request.headers.get('Accept'), transport.MSGPACK):
+        return jsonify(data)
+    deflate = transport.accepts(request.headers.get('Accept-Encoding'), transport.DEFLATE)
+    body, content_encoding = transport.encode(data, COMPRESS_THRESHOLD, deflate)
+    response = Response(body, mimetype=transport.MSGPACK)
+    if content_encoding is not None:
+        response.headers['Content-Encoding'] = content_encoding
+    return response
+
+
+@app.errorhandler(PoolExhausted)
+def pool_exhausted(error):
+    return jsonify({'error': str(error)}), 503, {'Retry-After': '1'}
+
+
+@app.errorhandler(mysql.connector.Error)
+def mysql_error(error):
+    if is_timeout(error):
+        return jsonify({'error': 'Query timeout', 'reason': str(error)}), 504
+    return jsonify({'error': str(error)}), 500
 
 
 @app.route('/', methods=['POST'])
 def direct_hit_endpoint():
     """
-    initilalize a connection with the manager of mysql cluster
-    Then execute mysql query
-    Return the response
+    borrow a connection to the manager of mysql cluster from the pool
+    Then execute mysql query with the statement timeout of the pool
+    Return the response (msgpack when the gatekeeper accepts it), or stream it as NDJSON (one JSON array per row) when the request asks for it
+    The connection goes back to the pool once the query is done, even after an error
     """
-    master_connection = mysql.connector.connect(**master_config)
-    master_cursor = master_connection.cursor()
     query = request.json['query']
-    master_cursor.execute(query)
+    with metrics.stage('connect'):
+        master_connection = trusted_pool.acquire()
+    if request.json.get('stream'):
+        return stream_query(master_connection, query)
     try:
-         master_connection.commit() 
-    except Exception as e:
-        pass
-    result = master_cursor.fetchall()
-    return jsonify({'result': result})
+        result = trusted_pool.execute(master_connection, query, stage=metrics.stage)
+    finally:
+        trusted_pool.release(master_connection)
+    with metrics.stage('serialize'):
+        return respond({'result': result})
+
+def stream_query(connection, query):
+    """
+    execute the query on an unbuffered cursor and send the rows STREAM_CHUNK_ROWS at a time,
+    so the trusted host never holds the whole result in memory
+    an error happening after the first rows were sent is reported as a last {"error": ...} line
+    the statement timeout covers the whole stream
+    """
+    released = []
+
+    def release():
+        # called by the generator and when the response is closed, only the first call gives the connection back
+        if not released:
+            released.append(True)
+            if deadline is not None:
+                deadline.cancel()
+            trusted_pool.release(connection)
+
+    deadline = trusted_pool.deadline(connection)
+    try:
+        cursor = connection.cursor(buffered=False)
+        with metrics.stage('execute'):
+            cursor.execute(trusted_pool.with_hint(query))
+    except Exception:
+        release()
+        raise
+
+    def generate():
+        # fetch and serialize times are summed over the chunks, the time spent sending them to the gatekeeper is left out
+        fetch_seconds = serialize_seconds = 0.0
+        try:
+            if cursor.with_rows:
+                while True:
+                    start = time.perf_counter()
+                    rows = cursor.fetchmany(STREAM_CHUNK_ROWS)
+                    fetched = time.perf_counter()
+                    fetch_seconds += fetched - start
+                    if not rows:
+                        break
+                    chunk = ''.join(flask_json.dumps(row) + '\n' for row in rows)
+                    serialize_seconds += time.perf_counter() - fetched
+                    yield chunk
+            connection.commit()
+        except mysql.connector.Error as e:
+            yield flask_json.dumps({'error': 'Query timeout' if is_timeout(e) else str(e)}) + '\n'
+        finally:
+            metrics.observe('fetch', fetch_seconds)
+            metrics.observe('serialize', serialize_seconds)
+            cursor.close()
+            release()
+
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    # the generator does not run at all if the gatekeeper goes away before the first chunk
+    response.call_on_close(release)
+    return response
+
+
+@app.route('/health', methods=['GET'])
+def health_endpoint():
+    """
+    Health check of the gatekeeper: the trusted host answers and can reach the manager
+    the manager is checked on a dedicated connection, a check waiting behind the queries of a busy pool would time out
+    and get a healthy host ejected
+    """
+    if not trusted_pool.is_reachable():
+        return jsonify({'status': 'manager unreachable'}), 503
+    return jsonify({'status': 'ok'})
+
+
+@app.route('/stats', methods=['GET'])
+def stats_endpoint():
+    """
+    Return the statistics of the connection pool: checkouts, requests turned away, statement timeouts
+    """
+    return jsonify({'pool': trusted_pool.stats()})
+
+
+def load_master_config():
+    """
+    get the details about the ec2 machine where the manager of mysql cluster is deployed
+    """
+    with open('cluster_instances_details.json') as file: 
+        cluster_data = json.load(file)
+    for data in cluster_data:
+        if data['Name'] == 'manager':
+            return {
+                'host': data['PublicDNS'],
+                'user': 'root',
+                'password': '',
+                'database': 'sakila',
+            }
+    raise ValueError('no manager in cluster_instances_details.json')
+
+
+def setup(args, workers=1):
+    """
+    create the pool of connections to the manager, with the prefork mode it runs once in each worker
+    and the connections of --pool-size are shared out between the workers
+    """
+    global trusted_pool
+    trusted_pool = TrustedPool(load_master_config(), size=max(1, args.pool_size // workers), max_waiting=args.max_waiting,
+                               checkout_timeout=args.checkout_timeout, statement_timeout=args.statement_timeout)
+
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pool-size', default=10, type=int) # connections kept open to the manager (at most 32 with mysql.connector)
+    parser.add_argument('--max-waiting', default=50, type=int) # requests allowed to wait for a connection, the next ones get 503
+    parser.add_argument('--checkout-timeout', default=5, type=float) # seconds a request waits for a connection before getting 503
+    parser.add_argument('--compress-threshold', default=COMPRESS_THRESHOLD, type=int) # msgpack results bigger than this (bytes) are compressed, 0 to never compress
+    parser.add_argument('--statement-timeout', default=30, type=float) # seconds a statement can run before being stopped, 0 for no limit
+    parser.add_argument('--workers', default=0, type=int) # serving processes (prefork, SIGHUP reloads them), 0 for the single process server
+    args = parser.parse_args()
+
+    COMPRESS_THRESHOLD = args.compress_threshold
+    # HTTP/1.1 so that the connections of the gatekeeper are kept alive between requests (HTTP/1.0 closes them)
+    WSGIRequestHandler.protocol_version = 'HTTP/1.1'
+    if args.workers:
+        prefork.serve(app, host='0.0.0.0', port=5000, workers=args.workers, init=lambda worker_id: setup(args, args.workers))
+    else:
+        setup(args)
+        app.run(host='0.0.0.0', port=5000)
 
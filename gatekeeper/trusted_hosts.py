@@ -0,0 +1,108 @@
+"""
+This file contains the balancing of the gatekeeper between its trusted hosts
+The requests are spread over the trusted hosts (round robin or least outstanding), a background thread checks the /health
+route of each host, and a host failing its checks is ejected until it passes them again
+"""
+import itertools
+import threading
+import requests
+
+ROUND_ROBIN = 'round_robin'
+LEAST_OUTSTANDING = 'least_outstanding'
+STRATEGIES = (ROUND_ROBIN, LEAST_OUTSTANDING)
+
+
+class TrustedHosts:
+    """
+    Trusted hosts known by the gatekeeper, identified by their url
+    - pick() returns the url of the host to forward a request to, among the healthy hosts (all the hosts when none is healthy)
+    - acquire(url)/release(url, failed) count the requests in flight on a host, a forward that could not connect to the host
+      is released with failed and counts as a failed check
+    - a host is ejected after eject_after failed checks in a row, and admitted again after readmit_after successful checks in a row
+    """
+
+    def __init__(self, urls, strategy=ROUND_ROBIN, check_interval=2, check_timeout=1, eject_after=2, readmit_after=2):
+        if strategy not in STRATEGIES:
+            raise ValueError(f'unknown strategy: {strategy}')
+        self.urls = list(urls)
+        self.strategy = strategy
+        self.check_interval = check_interval
+        self.check_timeout = check_timeout
+        self.eject_after = eject_after
+        self.readmit_after = readmit_after
+        self._lock = threading.Lock()
+        self._round_robin = itertools.count()
+        self._state = {url: {'healthy': True, 'failures': 0, 'successes': 0, 'in_flight': 0, 'requests': 0, 'errors': 0,
+                             'ejections': 0} for url in self.urls}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def pick(self):
+        with self._lock:
+            healthy = [url for url in self.urls if self._state[url]['healthy']] or self.urls
+            if self.strategy == LEAST_OUTSTANDING:
+                # ties broken by round robin, so that idle hosts share the traffic
+                offset = next(self._round_robin)
+                rotated = healthy[offset % len(healthy):] + healthy[:offset % len(healthy)]
+                return min(rotated, key=lambda url: self._state[url]['in_flight'])
+            return healthy[next(self._round_robin) % len(healthy)]
+
+    def acquire(self, url):
+        with self._lock:
+            self._state[url]['in_flight'] += 1
+            self._state[url]['requests'] += 1
+
+    def release(self, url, failed=False):
+        with self._lock:
+            self._state[url]['in_flight'] -= 1
+            if failed:
+                self._state[url]['errors'] += 1
+        if failed:
+            self.record(url, False)
+
+    def record(self, url, success):
+        """
+        Record the result of a check (or of a forward) of a host, eject or admit it again when needed
+        """
+        with self._lock:
+            state = self._state[url]
+            if success:
+                state['failures'] = 0
+                state['successes'] += 1
+                if not state['healthy'] and state['successes'] >= self.readmit_after:
+                    state['healthy'] = True
+            else:
+                state['successes'] = 0
+                state['failures'] += 1
+                if state['healthy'] and state['failures'] >= self.eject_after:
+                    state['healthy'] = False
+                    state['ejections'] += 1
+
+    def check(self, url):
+        try:
+            response = requests.get(url.rstrip('/') + '/health', timeout=self.check_timeout)
+            success = response.status_code == 200
+        except requests.exceptions.RequestException:
+            success = False
+        self.record(url, success)
+
+    def _check_loop(self):
+        while not self._stop.is_set():
+            for url in self.urls:
+                self.check(url)
+            self._stop.wait(self.check_interval)
+
+    def start(self):
+        """
+        Start checking the hosts in the background
+        """
+        self._thread = threading.Thread(target=self._check_loop, name='trusted-hosts-checker', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        with self._lock:
+            hosts = {url: dict(state) for url, state in self._state.items()}
+        return {'strategy': self.strategy, 'hosts': hosts}
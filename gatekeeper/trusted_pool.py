@@ -0,0 +1,258 @@
+"""
+This file contains the connection pool of the trusted host
+The connections to the mysql manager are reused between requests, a request waiting for a connection waits in a bounded queue,
+and each statement gets a deadline: a KILL QUERY sent by the watchdog thread of the pool for the statements still running
+after it (one thread per pool waiting for the earliest deadline, not one per statement), plus a server side
+MAX_EXECUTION_TIME hint for the selects when the server knows it (mysql 5.7.8 and later, the 5.5 of the mysql cluster takes
+the hint for a plain comment)
+"""
+import contextlib
+import heapq
+import itertools
+import re
+import threading
+import time
+import mysql.connector
+import mysql.connector.pooling
+
+_SELECT_RE = re.compile(r'^(\s*)select\b', re.I)
+
+# mysql errors of a statement interrupted by MAX_EXECUTION_TIME (3024) or by KILL QUERY (1317)
+TIMEOUT_ERRNOS = (3024, 1317)
+
+# first mysql version reading the MAX_EXECUTION_TIME optimizer hint
+HINT_MIN_VERSION = (5, 7, 8)
+
+
+class PoolExhausted(Exception):
+    """
+    Raised when no connection can be given: the wait queue is full or the wait took longer than checkout_timeout
+    """
+
+
+def _timed(stage, name):
+    return stage(name) if stage is not None else contextlib.nullcontext()
+
+
+def is_timeout(error):
+    return isinstance(error, mysql.connector.Error) and error.errno in TIMEOUT_ERRNOS
+
+
+class _Deadline:
+    """
+    Entry of a statement in the watchdog of the pool, registered at its creation and unregistered by cancel()
+    """
+
+    def __init__(self, pool, connection_id, timeout):
+        self.pool = pool
+        self.connection_id = connection_id
+        self.expires = time.monotonic() + timeout
+        self.active = True  # False once cancelled, read under the kill lock
+        self.watched = False  # True while in the heap of the watchdog, read under its condition
+        pool._watch(self)
+
+    def cancel(self):
+        # once the kill lock is taken, no KILL QUERY for this connection is on its way, it can be given to someone else
+        with self.pool._kill_lock:
+            self.active = False
+        self.pool._unwatch(self)
+
+
+class TrustedPool:
+    """
+    Pool of at most size connections to the mysql manager (mysql.connector.pooling)
+    - acquire() waits at most checkout_timeout seconds for a connection, and at most max_waiting requests can wait at once,
+      otherwise it raises PoolExhausted right away
+    - release() gives the connection back after a rollback, also after an error (the pool reconnects broken connections)
+    - is_reachable() checks the manager on a dedicated connection, so that a busy pool does not fail the health checks
+    - execute() runs a statement with a deadline of statement_timeout seconds (0 for none), the version of the server
+      is read at the first deadline() to know whether the selects can also get the MAX_EXECUTION_TIME hint
+    """
+
+    def __init__(self, config, size=10, max_waiting=50, checkout_timeout=5, statement_timeout=30):
+        self.config = config
+        self.size = size
+        self.max_waiting = max_waiting
+        self.checkout_timeout = checkout_timeout
+        self.statement_timeout = statement_timeout
+        self._pool = mysql.connector.pooling.MySQLConnectionPool(pool_name='trusted', pool_size=size, pool_reset_session=True, **config)
+        self._slots = threading.BoundedSemaphore(size)
+        self._admitted = threading.BoundedSemaphore(size + max_waiting)
+        self._kill_lock = threading.Lock()
+        self._kill_connection = None
+        # heap of (expiry, sequence, _Deadline) of the running statements, the watchdog thread sleeps until the earliest one
+        self._watchdog = threading.Condition()
+        self._watchdog_thread = None
+        self._deadlines = []
+        self._deadline_ids = itertools.count()
+        self._unwatched = 0  # entries of the heap already cancelled, dropped when they reach the top or by _unwatch
+        self._health_lock = threading.Lock()
+        self._health_connection = None
+        self.hint_supported = None  # whether the server reads MAX_EXECUTION_TIME, unknown until the first deadline()
+        self._lock = threading.Lock()
+        self._counters = {'checkouts': 0, 'queue_full': 0, 'checkout_timeouts': 0, 'errors': 0, 'timeouts': 0, 'killed': 0}
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def acquire(self):
+        if not self._admitted.acquire(blocking=False):
+            self._count('queue_full')
+            raise PoolExhausted('too many requests waiting for a connection')
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            self._admitted.release()
+            self._count('checkout_timeouts')
+            raise PoolExhausted(f'no connection available after {self.checkout_timeout}s')
+        try:
+            connection = self._pool.get_connection()
+        except Exception:
+            self._slots.release()
+            self._admitted.release()
+            raise
+        self._count('checkouts')
+        return connection
+
+    def release(self, connection):
+        try:
+            connection.rollback()
+        except mysql.connector.Error:
+            pass
+        try:
+            # close() of a pooled connection resets its session and puts it back in the pool
+            connection.close()
+        except mysql.connector.Error:
+            pass
+        finally:
+            self._slots.release()
+            self._admitted.release()
+
+    def deadline(self, connection):
+        """
+        Start the watchdog of a statement about to run on the connection, cancel() it once the statement is done
+        return None when statements have no timeout
+        the watchdog kills the statement after statement_timeout, whether or not the server also stopped it with the hint
+        """
+        if not self.statement_timeout:
+            return None
+        self._check_hint_support(connection)
+        return _Deadline(self, connection.connection_id, self.statement_timeout)
+
+    def _watch(self, deadline):
+        with self._watchdog:
+            if self._watchdog_thread is None:
+                self._watchdog_thread = threading.Thread(target=self._run_watchdog, daemon=True)
+                self._watchdog_thread.start()
+            deadline.watched = True
+            heapq.heappush(self._deadlines, (deadline.expires, next(self._deadline_ids), deadline))
+            # the watchdog only needs to wake up when this deadline comes first
+            if self._deadlines[0][2] is deadline:
+                self._watchdog.notify()
+
+    def _unwatch(self, deadline):
+        with self._watchdog:
+            if not deadline.watched:
+                return
+            deadline.watched = False
+            self._unwatched += 1
+            # the cancelled entries are left in the heap, until they are half of it
+            if self._unwatched * 2 > len(self._deadlines):
+                self._deadlines = [entry for entry in self._deadlines if entry[2].watched]
+                heapq.heapify(self._deadlines)
+                self._unwatched = 0
+
+    def _run_watchdog(self):
+        """
+        Body of the watchdog thread: wait for the earliest deadline, kill its statement if it is still running
+        """
+        while True:
+            with self._watchdog:
+                while True:
+                    while self._deadlines and not self._deadlines[0][2].watched:
+                        heapq.heappop(self._deadlines)
+                        self._unwatched -= 1
+                    if not self._deadlines:
+                        self._watchdog.wait()
+                        continue
+                    wait = self._deadlines[0][0] - time.monotonic()
+                    if wait <= 0:
+                        break
+                    self._watchdog.wait(wait)
+                _, _, deadline = heapq.heappop(self._deadlines)
+                deadline.watched = False
+            # outside of the condition, the statements starting meanwhile are not held up by the KILL QUERY
+            self._kill(deadline)
+
+    def _kill(self, deadline):
+        with self._kill_lock:
+            if not deadline.active:
+                return
+            try:
+                if self._kill_connection is None or not self._kill_connection.is_connected():
+                    self._kill_connection = mysql.connector.connect(**self.config)
+                cursor = self._kill_connection.cursor()
+                cursor.execute(f'KILL QUERY {int(deadline.connection_id)}')
+                cursor.close()
+                self._count('killed')
+            except mysql.connector.Error:
+                self._kill_connection = None
+
+    def _check_hint_support(self, connection):
+        if self.hint_supported is None:
+            version = connection.get_server_version()
+            self.hint_supported = version is not None and tuple(version) >= HINT_MIN_VERSION
+
+    def is_reachable(self, timeout=1):
+        """
+        Whether the manager answers within timeout seconds, checked on a connection kept apart from the pool
+        """
+        with self._health_lock:
+            try:
+                if self._health_connection is None:
+                    self._health_connection = mysql.connector.connect(**dict(self.config, connection_timeout=timeout))
+                # a ping round trip, without reconnecting
+                if self._health_connection.is_connected():
+                    return True
+            except mysql.connector.Error:
+                pass
+            self._health_connection = None
+            return False
+
+    def with_hint(self, query):
+        """
+        Add the MAX_EXECUTION_TIME optimizer hint to a select when the server supports it,
+        mysql then stops it by itself after statement_timeout
+        """
+        if not self.statement_timeout or not self.hint_supported:
+            return query
+        return _SELECT_RE.sub(lambda match: f'{match.group(1)}SELECT /*+ MAX_EXECUTION_TIME({int(self.statement_timeout * 1000)}) */',
+                              query, count=1)
+
+    def execute(self, connection, query, stage=None):
+        """
+        Execute and commit a query, return its rows (an empty list when it returns none)
+        stage, when given, is called with 'execute' and 'fetch' and returns a context manager timing this part
+        """
+        deadline = self.deadline(connection)
+        cursor = connection.cursor()
+        try:
+            with _timed(stage, 'execute'):
+                cursor.execute(self.with_hint(query))
+            with _timed(stage, 'fetch'):
+                rows = cursor.fetchall() if cursor.with_rows else []
+            connection.commit()
+            return rows
+        except mysql.connector.Error as e:
+            self._count('timeouts' if is_timeout(e) else 'errors')
+            raise
+        finally:
+            if deadline is not None:
+                deadline.cancel()
+            cursor.close()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats.update({'size': self.size, 'max_waiting': self.max_waiting, 'checkout_timeout': self.checkout_timeout,
+                      'statement_timeout': self.statement_timeout, 'hint_supported': self.hint_supported})
+        return stats
@@ -0,0 +1,132 @@
+"""
+This file contains the memoized sql validation of the gatekeeper
+sqlvalidator parses the whole query in pure python, so its verdict is cached per query fingerprint:
+queries that only differ by their literal values or spacing are validated once
+"""
+import re
+import threading
+from collections import OrderedDict
+import sqlvalidator
+
+# one pass tokenizer: comments are dropped, literals are replaced by a placeholder keeping their type
+# (a string, an integer and a decimal do not always have the same verdict, e.g. LIMIT 'a' vs LIMIT 10), spaces are collapsed
+# as in mysql, -- starts a comment only when a space (or the end of the query) follows it: x=1--1 is x=1-(-1)
+_TOKEN_RE = re.compile(r"""
+      (?P<comment>\s*(?:/\*.*?\*/|--(?=\s|$)[^\n]*|\#[^\n]*)\s*)
+    | (?P<identifier>`(?:[^`]|``)*`)
+    | (?P<string>'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*")
+    | (?P<integer>(?<![\w.])\d+\b(?!\.))
+    | (?P<decimal>(?<![\w.])\d+\.\d*(?:e[-+]?\d+)?\b|(?<![\w.])\d+e[-+]?\d+\b)
+    | (?P<space>\s+)
+""", re.S | re.X | re.I)
+
+# mysql runs the content of /*! ... */ comments and reads optimizer hints in /*+ ... */, they are dropped by the fingerprint
+EXECUTABLE_COMMENT_RE = re.compile(r'/\*[!+]')
+
+_PLACEHOLDERS = {'string': "'?'", 'integer': '?', 'decimal': '?.?', 'space': ' ', 'comment': ' '}
+
+
+def _replace_token(match):
+    return _PLACEHOLDERS.get(match.lastgroup) or match.group()
+
+
+_UNTYPED_PLACEHOLDERS = dict(_PLACEHOLDERS, string='?', decimal='?')
+
+
+def _replace_untyped_token(match):
+    return _UNTYPED_PLACEHOLDERS.get(match.lastgroup) or match.group()
+
+
+def fingerprint(query, typed=True):
+    """
+    Normalize a query by stripping its literals, comments and extra spaces, a single regex pass much cheaper than a parse
+    e.g. "select * from actor  where actor_id=100" -> "select * from actor where actor_id=?"
+    with typed=False every literal becomes ?, whatever its type
+    """
+    return _TOKEN_RE.sub(_replace_token if typed else _replace_untyped_token, query).strip()
+
+
+_SPACES = {'space': ' ', 'comment': ' '}
+
+
+def _replace_space(match):
+    return _SPACES.get(match.lastgroup) or match.group()
+
+
+def normalize(query):
+    """
+    Same pass as fingerprint but the literals are kept: only comments and extra spaces are removed
+    two queries with the same normalized text return the same result
+    """
+    return _TOKEN_RE.sub(_replace_space, query).strip()
+
+
+_READ_ONLY_RE = re.compile(r'^[\s(]*(?:select|show|describe|desc|explain)\b', re.I)
+_LOCKING_RE = re.compile(r'\bfor\s+update\b|\bfor\s+share\b|\block\s+in\s+share\s+mode\b|\binto\b|;\s*\S', re.I)
+
+
+def is_read_only(fingerprinted):
+    """
+    Whether an already fingerprinted query only reads data: a single select/show/describe/explain that does not lock rows
+    such a query can safely be sent again (retries) or shared between clients
+    """
+    return bool(_READ_ONLY_RE.match(fingerprinted)) and not _LOCKING_RE.search(fingerprinted)
+
+
+def validate(query):
+    """
+    Full validation with sqlvalidator, returns (valid, reason)
+    """
+    sql_query = sqlvalidator.parse(query)
+    if sql_query.is_valid():
+        return True, None
+    return False, '; '.join(str(error) for error in sql_query.errors) or 'Query not valid'
+
+
+class ValidationCache:
+    """
+    Bounded LRU cache of validation verdicts keyed by query fingerprint
+    the verdict of the first query seen with a fingerprint is used for all the queries sharing this fingerprint,
+    except for the queries with executable comments or hints: their fingerprint does not show what mysql runs,
+    they are always validated
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._verdicts = OrderedDict()  # fingerprint -> (valid, reason)
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'uncached': 0}
+
+    def validate(self, query):
+        """
+        Return (valid, reason) for the query, running sqlvalidator only for fingerprints not seen recently
+        """
+        if EXECUTABLE_COMMENT_RE.search(query):
+            with self._lock:
+                self._counters['uncached'] += 1
+            return validate(query)
+        key = fingerprint(query)
+        with self._lock:
+            verdict = self._verdicts.get(key)
+            if verdict is not None:
+                self._verdicts.move_to_end(key)
+                self._counters['hits'] += 1
+                return verdict
+            self._counters['misses'] += 1
+
+        verdict = validate(query)
+        with self._lock:
+            self._verdicts[key] = verdict
+            if len(self._verdicts) > self.max_size:
+                self._verdicts.popitem(last=False)
+                self._counters['evictions'] += 1
+        return verdict
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            lookups = stats['hits'] + stats['misses']
+            stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+            stats['size'] = len(self._verdicts)
+            stats['max_size'] = self.max_size
+        return stats
@@ -0,0 +1,243 @@
+"""
+This file contains the latency metrics shared by the proxy, the gatekeeper and the trusted host (copied next to each application)
+The duration of each stage of a request (json decode, validation, forward, connect, execute, fetch, serialize) is counted
+in a fixed bucket histogram per endpoint, strategy and stage, and the histograms are exposed in the prometheus text format
+on a /metrics route
+With the prefork mode, the /metrics route of a worker adds up the histograms of all the workers (see gather in instrument_flask)
+
+Recording a duration is a bisect over the bucket bounds and a few additions under a lock, a few microseconds at most,
+run `python metrics.py` to measure it on the machine
+"""
+import bisect
+import contextvars
+import threading
+import time
+
+# upper bounds of the buckets in seconds, from half a millisecond to 10 seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# labels of the request being handled (endpoint, strategy), set once per request and read by every stage timer
+_labels = contextvars.ContextVar('metrics_labels', default=())
+
+
+class Histogram:
+    """
+    Counts of the observed values per bucket, plus their sum and count
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+
+class _Stage:
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    """
+    Stage histograms of an application, exposed as the {namespace}_stage_seconds prometheus histogram
+    - set_labels(endpoint=..., strategy=...) sets the labels of the request being handled (per thread / per asyncio task)
+    - stage(name) is a context manager timing a stage of this request, observe(name, seconds) records an already measured one
+    - render() returns the prometheus text of all the histograms, snapshot() their counts to add them up in another process
+    """
+
+    def __init__(self, namespace, buckets=BUCKETS):
+        self.namespace = namespace
+        self.buckets = buckets
+        self._histograms = {}  # (stage, labels) -> Histogram
+        self._lock = threading.Lock()
+
+    def set_labels(self, **labels):
+        """
+        Set (or update) labels of the current request
+        """
+        current = dict(_labels.get())
+        current.update(labels)
+        _labels.set(tuple(sorted(current.items())))
+
+    def reset_labels(self, **labels):
+        _labels.set(tuple(sorted(labels.items())))
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def observe(self, name, seconds, labels=None):
+        key = (name, _labels.get() if labels is None else tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram(self.buckets))
+        histogram.observe(seconds)
+
+    def snapshot(self):
+        """
+        Return [[stage, labels, bucket counts, sum, count]] of the histograms (json serializable)
+        """
+        with self._lock:
+            histograms = list(self._histograms.items())
+        return [[stage, [list(label) for label in labels], *histogram.snapshot()] for (stage, labels), histogram in histograms]
+
+    def render(self, others=()):
+        """
+        Return the prometheus text of the histograms, added up with the snapshots of the other processes given
+        """
+        name = f'{self.namespace}_stage_seconds'
+        lines = [f'# HELP {name} Duration of each stage of the requests, in seconds', f'# TYPE {name} histogram']
+        histograms = {}  # (stage, labels) -> [bucket counts, sum, count]
+        for stage, labels, counts, total, count in [entry for snapshot in (self.snapshot(), *others) for entry in snapshot]:
+            key = (stage, tuple(tuple(label) for label in labels))
+            if key not in histograms:
+                histograms[key] = [list(counts), total, count]
+                continue
+            added = histograms[key]
+            added[0] = [a + b for a, b in zip(added[0], counts)]
+            added[1] += total
+            added[2] += count
+        for (stage, labels), (counts, total, count) in sorted(histograms.items()):
+            label_text = ','.join(f'{key}="{_escape(value)}"' for key, value in labels + (('stage', stage),))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{{{label_text},le="{le}"}} {cumulative}')
+            lines.append(f'{name}_sum{{{label_text}}} {total}')
+            lines.append(f'{name}_count{{{label_text}}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def instrument_flask(app, metrics, gather=None):
+    """
+    Time every request of a flask application and add its /metrics route
+    - gather() returns the snapshots of the other processes serving the application (e.g. the prefork workers), added to this one
+    - the labels of a request are its endpoint (the url rule) and an empty strategy, that the application can set later
+    - 'decode' times the parsing of the json body, 'request' the whole handling until the response is ready
+      (the rows of a streamed response are timed by the application, in its 'fetch' stage)
+    """
+    from flask import Response, g, request
+
+    @app.before_request
+    def start_timing():
+        g.metrics_start = time.perf_counter()
+        metrics.reset_labels(endpoint=request.url_rule.rule if request.url_rule is not None else 'unknown', strategy='')
+        if request.is_json:
+            with metrics.stage('decode'):
+                request.get_json(silent=True)
+
+    @app.after_request
+    def stop_timing(response):
+        start = g.pop('metrics_start', None)
+        if start is not None:
+            metrics.observe('request', time.perf_counter() - start)
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics_endpoint():
+        return Response(metrics.render(gather() if gather is not None else ()), content_type=CONTENT_TYPE)
+
+
+def aiohttp_middleware(metrics):
+    """
+    Same timing as instrument_flask for an aiohttp application, the /metrics route is added with metrics_handler
+    """
+    from aiohttp import web
+
+    @web.middleware
+    async def middleware(request, handler):
+        start = time.perf_counter()
+        resource = request.match_info.route.resource
+        metrics.reset_labels(endpoint=resource.canonical if resource is not None else 'unknown', strategy='')
+        try:
+            return await handler(request)
+        finally:
+            metrics.observe('request', time.perf_counter() - start)
+
+    return middleware
+
+
+def metrics_handler(metrics):
+    from aiohttp import web
+
+    async def handler(request):
+        return web.Response(text=metrics.render(), headers={'Content-Type': CONTENT_TYPE})
+
+    return handler
+
+
+if __name__ == '__main__':
+    """
+    Benchmark of the recording overhead: cost of a stage() block and of an observe() call compared to an empty loop
+    """
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', default=1000000, type=int) # number of timed calls of each kind
+    parser.add_argument('--threads', default=1, type=int) # threads recording at the same time
+    args = parser.parse_args()
+
+    metrics = Metrics('benchmark')
+    metrics.set_labels(endpoint='/benchmark', strategy='none')
+
+    def empty_loop(n):
+        for _ in range(n):
+            pass
+
+    def observe_loop(n):
+        metrics.set_labels(endpoint='/benchmark', strategy='none')
+        for _ in range(n):
+            metrics.observe('observe', 0.001)
+
+    def stage_loop(n):
+        metrics.set_labels(endpoint='/benchmark', strategy='none')
+        for _ in range(n):
+            with metrics.stage('stage'):
+                pass
+
+    def run(loop):
+        per_thread = args.iterations // args.threads
+        threads = [threading.Thread(target=loop, args=(per_thread,)) for _ in range(args.threads)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return (time.perf_counter() - start) / (per_thread * args.threads)
+
+    baseline = run(empty_loop)
+    for name, loop in (('observe()', observe_loop), ('stage()', stage_loop)):
+        cost = run(loop) - baseline
+        print(f'{name}: {cost * 1e9:.0f} ns per call ({args.threads} threads)')
+    start = time.perf_counter()
+    text = metrics.render()
+    print(f'render(): {(time.perf_counter() - start) * 1e3:.2f} ms for {len(text.splitlines())} lines')
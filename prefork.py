@@ -0,0 +1,426 @@
+"""
+This file contains the prefork serving mode shared by the proxy, the gatekeeper and the trusted host (copied next to each application)
+The flask development server runs in a single process, so the cpu bound parts of a request (sql validation, json encoding)
+use one core at most because of the GIL. Here a master process opens the listening socket once and forks worker processes
+that all accept connections on it, each one running the threaded werkzeug server of the application
+
+- each worker calls init(worker_id) after the fork, before serving: the configuration, pools and background threads are
+  set up there, once per worker (threads and connections do not survive a fork)
+  the ids alternate between 0..workers-1 and workers..2*workers-1 at each reload, so that the old and the new workers
+  running at the same time never share an id (e.g. when the id picks local ports)
+- SIGHUP reloads gracefully: a new set of workers is started (running init again, so the configuration files are read again),
+  then the old workers stop accepting and finish their requests in flight (at most graceful_timeout seconds, after which
+  the master kills them)
+- SIGTERM or SIGINT stop the workers the same way, then the master exits
+- a worker that dies is replaced
+- each worker has a control socket to the master: broadcast(name, payload) sends a message to all the other workers
+  (e.g. an admin route changing a limit), and gather(name) returns the answers of the other workers (e.g. their metrics),
+  the handlers of the messages are registered with on_message(name, handler) and run in a background thread of each worker
+  the last message of each name is sent again to the workers replacing the ones that die, a reload starts from the
+  command line and the configuration files again
+
+The code itself is not reloaded by SIGHUP (the workers are forked from the master), restart the master after changing it
+"""
+import itertools
+import json
+import os
+import select
+import signal
+import socket
+import threading
+import time
+from werkzeug.serving import BaseWSGIServer, make_server
+
+# a worker dying sooner than this after its start is replaced after a pause, to avoid forking in a loop when init keeps failing
+MIN_WORKER_LIFETIME = 1
+
+# seconds the master waits for the answers of the workers to a gather(), the workers answering later are left out
+GATHER_TIMEOUT = 1
+
+# control socket of this worker to the master, None in the master and outside of the prefork mode
+_channel = None
+# name -> handler(payload) of the messages sent by the other workers, registered with on_message() before the fork
+_handlers = {}
+
+
+def _encode(message):
+    return json.dumps(message).encode() + b'\n'
+
+
+def _dispatch(name, payload):
+    """
+    Run the handler of a message, return its answer (None when it failed or there is no handler)
+    """
+    handler = _handlers.get(name)
+    if handler is None:
+        return None
+    try:
+        return handler(payload)
+    except Exception as e:
+        print(f'worker (pid {os.getpid()}) failed to handle {name}: {e!r}', flush=True)
+        return None
+
+
+class _Channel:
+    """
+    End of the control socket in a worker: sends the broadcasts and gathers to the master and runs the handlers of the
+    messages relayed by the master (one json object per line both ways)
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._gathers = {}  # id -> [event set when the answers arrive, answers]
+
+    def start(self):
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def send(self, message):
+        try:
+            with self._lock:
+                self.sock.sendall(_encode(message))
+            return True
+        except OSError as e:
+            print(f'worker (pid {os.getpid()}) lost its control socket: {e!r}', flush=True)
+            return False
+
+    def gather(self, name, timeout):
+        gather_id = next(self._ids)
+        pending = self._gathers[gather_id] = [threading.Event(), []]
+        try:
+            if self.send({'type': 'gather', 'id': gather_id, 'name': name}):
+                pending[0].wait(timeout)
+            return [answer for answer in pending[1] if answer is not None]
+        finally:
+            del self._gathers[gather_id]
+
+    def _read(self):
+        buffer = b''
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except OSError:
+                return
+            if not data:
+                # the master is gone
+                return
+            *lines, buffer = (buffer + data).split(b'\n')
+            for line in lines:
+                message = json.loads(line)
+                if message['type'] == 'gathered':
+                    pending = self._gathers.get(message['id'])
+                    if pending is not None:
+                        pending[1] = message['answers']
+                        pending[0].set()
+                    continue
+                answer = _dispatch(message['name'], message.get('payload'))
+                if message['type'] == 'request':
+                    self.send({'type': 'answer', 'id': message['id'], 'answer': answer})
+
+
+def on_message(name, handler):
+    """
+    Register handler(payload) for the messages of this name sent by the other workers, the value it returns (json
+    serializable) is the answer of the worker to a gather()
+    """
+    _handlers[name] = handler
+
+
+def broadcast(name, payload=None):
+    """
+    Send a message to all the other workers (the calling worker applies the change itself), nothing outside of the prefork mode
+    """
+    if _channel is not None:
+        _channel.send({'type': 'broadcast', 'name': name, 'payload': payload})
+
+
+def gather(name):
+    """
+    Return the answers of the other workers to a message, [] outside of the prefork mode
+    """
+    if _channel is None:
+        return []
+    # the master answers after GATHER_TIMEOUT at most, the extra second covers its loop
+    return _channel.gather(name, GATHER_TIMEOUT + 1)
+
+
+def _listen(host, port, backlog):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(backlog)
+    listener.set_inheritable(True)
+    # all the workers wait for the same socket: a connection wakes them all and only one gets it, the others must not
+    # block in accept() (a blocked worker would not see its shutdown), socketserver ignores their failed accept()
+    listener.setblocking(False)
+    return listener
+
+
+def _run_worker(app, host, port, listener, channel, worker_id, init, graceful_timeout):
+    """
+    Body of a worker process, never returns
+    """
+    global _channel
+    status = 1
+    try:
+        # the master decides when the workers stop, a ctrl-c in the terminal reaches it as well
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        if init is not None:
+            init(worker_id)
+        # the messages arriving during init wait in the socket, so that init does not overwrite them
+        _channel = _Channel(channel)
+        _channel.start()
+        server = make_server(host, port, app, threaded=True, fd=listener.fileno())
+        # the request threads are joined by server_close, so the requests in flight are finished before the worker exits
+        server.daemon_threads = False
+
+        def stop(signum, frame):
+            # shutdown() waits for serve_forever to return, it can not be called from the thread running it
+            threading.Thread(target=server.shutdown, daemon=True).start()
+
+        signal.signal(signal.SIGTERM, stop)
+        print(f'worker {worker_id} (pid {os.getpid()}) serving on {host}:{port}', flush=True)
+        # the serve_forever of werkzeug calls server_close (which waits for every request) once it returns,
+        # the one of socketserver leaves it to the closer below, bounded by graceful_timeout
+        super(BaseWSGIServer, server).serve_forever()
+        closer = threading.Thread(target=server.server_close, daemon=True)
+        closer.start()
+        closer.join(graceful_timeout)
+        status = 0
+    except BaseException as e:
+        print(f'worker {worker_id} (pid {os.getpid()}) failed: {e!r}', flush=True)
+    finally:
+        # leave without running the exit handlers of the master (and without waiting for the background threads)
+        os._exit(status)
+
+
+class PreforkServer:
+    """
+    Master process of the prefork serving mode, see the top of the file
+    """
+
+    def __init__(self, app, host='0.0.0.0', port=5000, workers=2, init=None, graceful_timeout=30, backlog=128):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.init = init
+        self.graceful_timeout = graceful_timeout
+        self.backlog = backlog
+        self._listener = None
+        self._children = {}  # pid -> (worker id, start time)
+        self._retiring = {}  # pid of the workers told to stop -> time after which they are killed
+        self._reload = False
+        self._stopping = False
+        self._generation = 0
+        self._channels = {}  # pid -> control socket of the worker
+        self._buffers = {}  # pid -> end of a line not received yet
+        self._messages = {}  # name -> payload of the last broadcast, sent again to the workers replacing the ones that die
+        self._gathers = {}  # id -> gather waiting for the answers of the workers
+        self._gather_ids = itertools.count()
+
+    def _worker_ids(self):
+        offset = (self._generation % 2) * self.workers
+        return range(offset, offset + self.workers)
+
+    def _spawn(self, worker_id):
+        channel, worker_channel = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            channel.close()
+            for other in self._channels.values():
+                other.close()
+            _run_worker(self.app, self.host, self.port, self._listener, worker_channel, worker_id, self.init, self.graceful_timeout)
+        worker_channel.close()
+        # a worker not reading its socket can not block the master for long, it loses its channel instead
+        channel.settimeout(1)
+        self._channels[pid] = channel
+        self._buffers[pid] = b''
+        self._children[pid] = (worker_id, time.monotonic())
+        return pid
+
+    def _send(self, pid, message):
+        try:
+            self._channels[pid].sendall(_encode(message))
+        except OSError as e:
+            print(f'lost the control socket of the worker (pid {pid}): {e!r}', flush=True)
+            self._close_channel(pid)
+
+    def _close_channel(self, pid):
+        channel = self._channels.pop(pid, None)
+        if channel is not None:
+            channel.close()
+        self._buffers.pop(pid, None)
+        for gather in self._gathers.values():
+            gather['waiting'].discard(pid)
+
+    def _poll(self, timeout):
+        """
+        Wait at most timeout seconds for the messages of the workers and handle them
+        """
+        pids = {channel: pid for pid, channel in self._channels.items()}
+        readable, _, _ = select.select(list(pids), [], [], timeout)
+        for channel in readable:
+            pid = pids[channel]
+            if pid not in self._channels:
+                continue
+            try:
+                data = channel.recv(65536)
+            except OSError:
+                data = b''
+            if not data:
+                self._close_channel(pid)
+                continue
+            *lines, self._buffers[pid] = (self._buffers[pid] + data).split(b'\n')
+            for line in lines:
+                try:
+                    self._handle(pid, json.loads(line))
+                except (ValueError, KeyError) as e:
+                    print(f'bad message from the worker (pid {pid}): {e!r}', flush=True)
+        self._finish_gathers()
+
+    def _handle(self, pid, message):
+        """
+        1- broadcast: relay the message to the other workers and keep it for the workers replacing the ones that die
+        2- gather: relay the request to the other workers, their answers are sent back by _finish_gathers
+        3- answer: answer of a worker to a relayed gather
+        """
+        others = [other for other in self._channels if other != pid]
+        if message['type'] == 'broadcast':
+            self._messages[message['name']] = message['payload']
+            for other in others:
+                self._send(other, {'type': 'message', 'name': message['name'], 'payload': message['payload']})
+        elif message['type'] == 'gather':
+            gather_id = next(self._gather_ids)
+            self._gathers[gather_id] = {'pid': pid, 'id': message['id'], 'waiting': set(others), 'answers': [],
+                                        'deadline': time.monotonic() + GATHER_TIMEOUT}
+            for other in others:
+                self._send(other, {'type': 'request', 'id': gather_id, 'name': message['name']})
+        elif message['type'] == 'answer':
+            gather = self._gathers.get(message['id'])
+            if gather is not None and pid in gather['waiting']:
+                gather['waiting'].discard(pid)
+                gather['answers'].append(message['answer'])
+
+    def _finish_gathers(self):
+        """
+        Send their answers to the workers whose gather got all of them or timed out
+        """
+        now = time.monotonic()
+        for gather_id, gather in list(self._gathers.items()):
+            if gather['waiting'] and gather['deadline'] > now:
+                continue
+            del self._gathers[gather_id]
+            if gather['pid'] in self._channels:
+                self._send(gather['pid'], {'type': 'gathered', 'id': gather['id'], 'answers': gather['answers']})
+
+    def _signal(self, pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _on_reload(self, signum, frame):
+        self._reload = True
+
+    def _on_stop(self, signum, frame):
+        self._stopping = True
+
+    def _reap(self):
+        """
+        Collect the workers that exited, return [(worker id, start time)] of the ones that were not told to stop
+        """
+        died = []
+        while self._children:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            worker = self._children.pop(pid, None)
+            self._close_channel(pid)
+            if pid in self._retiring:
+                del self._retiring[pid]
+            elif worker is not None:
+                died.append(worker)
+        return died
+
+    def _retire(self, pids):
+        # the worker stops accepting within the poll interval of serve_forever, then waits graceful_timeout for its requests
+        deadline = time.monotonic() + self.graceful_timeout + 1
+        self._retiring.update((pid, deadline) for pid in pids)
+        self._signal(pids, signal.SIGTERM)
+
+    def _kill_overdue(self):
+        """
+        Kill the retired workers still running after their grace period
+        """
+        now = time.monotonic()
+        overdue = [pid for pid, deadline in self._retiring.items() if deadline <= now and pid in self._children]
+        if overdue:
+            print(f'killing {len(overdue)} workers still running {self.graceful_timeout}s after being told to stop', flush=True)
+            self._signal(overdue, signal.SIGKILL)
+            for pid in overdue:
+                # killed once, the next loops only wait for them to be reaped
+                self._retiring[pid] = float('inf')
+
+    def serve_forever(self):
+        self._listener = _listen(self.host, self.port, self.backlog)
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        print(f'master (pid {os.getpid()}) starting {self.workers} workers on {self.host}:{self.port}', flush=True)
+        for worker_id in self._worker_ids():
+            self._spawn(worker_id)
+        while not self._stopping:
+            for worker_id, started in self._reap():
+                if self._stopping:
+                    break
+                if time.monotonic() - started < MIN_WORKER_LIFETIME:
+                    time.sleep(MIN_WORKER_LIFETIME)
+                print(f'worker {worker_id} died, starting a new one', flush=True)
+                pid = self._spawn(worker_id)
+                # the changes made at runtime by the other workers apply to this one as well
+                for name, payload in self._messages.items():
+                    self._send(pid, {'type': 'message', 'name': name, 'payload': payload})
+            if self._reload:
+                self._reload = False
+                old = [pid for pid in self._children if pid not in self._retiring]
+                print(f'reloading: starting {self.workers} new workers, stopping {len(old)} old ones', flush=True)
+                # the listening socket stays open in the master, the connections arriving before the new workers are ready wait in its backlog
+                self._generation += 1
+                self._messages.clear()
+                for worker_id in self._worker_ids():
+                    self._spawn(worker_id)
+                self._retire(old)
+            self._kill_overdue()
+            self._poll(0.2)
+        self._shutdown()
+
+    def _shutdown(self):
+        self._retire([pid for pid in self._children if pid not in self._retiring])
+        deadline = time.monotonic() + self.graceful_timeout + 1
+        while self._children and time.monotonic() < deadline:
+            self._reap()
+            # the workers finishing their requests can still gather the metrics of the others
+            self._poll(0.1)
+        # the workers still there after the grace period are killed
+        self._signal(list(self._children), signal.SIGKILL)
+        while self._children:
+            self._reap()
+            time.sleep(0.1)
+        for pid in list(self._channels):
+            self._close_channel(pid)
+        self._listener.close()
+
+
+def serve(app, host='0.0.0.0', port=5000, workers=2, init=None, graceful_timeout=30):
+    """
+    Serve a flask application with workers processes, calling init(worker_id) in each of them first
+    """
+    PreforkServer(app, host=host, port=port, workers=workers, init=init, graceful_timeout=graceful_timeout).serve_forever()
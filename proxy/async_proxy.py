@@ -0,0 +1,246 @@
+"""
+This file contains the asyncio serving mode of the proxy (python proxy.py --mode async)
+The same strategies as the flask application are served by aiohttp, and the queries go through aiomysql pools,
+so a request waiting for mysql does not hold a thread and one process can keep thousands of queries in flight
+"""
+import asyncio
+import datetime
+import decimal
+import email.utils
+import json
+import random
+import time
+import aiomysql
+import pymysql
+from aiohttp import web
+from classifier import READ, WRITE, DDL
+from metrics import aiohttp_middleware, metrics_handler
+from query_log import aiohttp_middleware as query_log_middleware
+from result_cache import cache_key
+
+
+def _json_default(value):
+    """
+    encode the values returned by mysql the same way flask jsonify does
+    """
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return email.utils.format_datetime(value, usegmt=True)
+    if isinstance(value, datetime.date):
+        return email.utils.format_datetime(datetime.datetime(value.year, value.month, value.day, tzinfo=datetime.timezone.utc), usegmt=True)
+    if isinstance(value, (decimal.Decimal, datetime.timedelta)):
+        return str(value)
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def json_response(data, status=200):
+    return web.json_response(data, status=status, dumps=lambda obj: json.dumps(obj, default=_json_default))
+
+
+class AsyncProxy:
+    """
+    asyncio version of the proxy, it shares the classifier, the latency table, the result cache and the tunnels of proxy.py
+    but owns its aiomysql pools: one per node, plus one per node tunnel when tunnels are enabled
+    the stages of the requests are timed in the given metrics and exposed on /metrics, and the query requests are appended
+    to the given query log
+    """
+
+    def __init__(self, master_config, workers_config, latency_table, classifier, result_cache=None, tunnel_manager=None, metrics=None, query_log=None,
+                 pool_min_size=1, pool_max_size=10, pool_idle_timeout=300, checkout_timeout=5, probe_interval=2):
+        self.master_config = master_config
+        self.workers_config = workers_config
+        self.nodes_config = {config['host']: config for config in [master_config] + workers_config}
+        self.latency_table = latency_table
+        self.classifier = classifier
+        self.result_cache = result_cache
+        self.tunnel_manager = tunnel_manager
+        self.metrics = metrics
+        self.query_log = query_log
+        self.pool_min_size = pool_min_size
+        self.pool_max_size = pool_max_size
+        self.pool_idle_timeout = pool_idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.probe_interval = probe_interval
+        self.pools = {}
+        self.tunnel_pools = {}
+        self._probe_tasks = []
+
+    async def _create_pool(self, config, host, port):
+        return await aiomysql.create_pool(
+            minsize=self.pool_min_size, maxsize=self.pool_max_size, pool_recycle=self.pool_idle_timeout,
+            host=host, port=port, user=config['user'], password=config['password'], db=config['database'],
+        )
+
+    async def on_startup(self, app):
+        """
+        open the pools of each node and start probing the nodes
+        """
+        for host, config in self.nodes_config.items():
+            self.pools[host] = await self._create_pool(config, host, config.get('port', 3306))
+            if self.tunnel_manager is not None:
+                local_host, local_port = self.tunnel_manager.local_address(host)
+                self.tunnel_pools[host] = await self._create_pool(config, local_host, local_port)
+        for host, config in self.nodes_config.items():
+            self._probe_tasks.append(asyncio.create_task(self._probe_loop(host, config)))
+
+    async def on_cleanup(self, app):
+        for task in self._probe_tasks:
+            task.cancel()
+        for pool in list(self.pools.values()) + list(self.tunnel_pools.values()):
+            pool.close()
+            await pool.wait_closed()
+
+    async def _probe_loop(self, host, config):
+        """
+        same measure as the threaded prober: duration of SELECT 1 through the route taken by the queries
+        """
+        if self.metrics is not None:
+            # the probes are timed apart from the requests, the labels only apply to this task
+            self.metrics.reset_labels(endpoint='probe', strategy='')
+        while True:
+            start = time.perf_counter()
+            try:
+                await asyncio.wait_for(self.execute(self.route_pool(config), 'SELECT 1'), self.probe_interval * 2)
+                self.latency_table.record(host, time.perf_counter() - start)
+            except Exception:
+                self.latency_table.record_failure(host)
+            await asyncio.sleep(self.probe_interval)
+
+    def route_pool(self, config):
+        return self.tunnel_pools.get(config['host'], self.pools[config['host']])
+
+    async def execute(self, pool, query, params=None):
+        """
+        borrow a connection from the given pool, execute and commit the query, then give the connection back
+        (or close it when the query changed its session)
+        """
+        start = time.perf_counter()
+        try:
+            connection = await asyncio.wait_for(pool.acquire(), self.checkout_timeout)
+        except asyncio.TimeoutError:
+            raise web.HTTPServiceUnavailable(text=json.dumps({'error': 'no connection available'}), content_type='application/json')
+        acquired = time.perf_counter()
+        try:
+            async with connection.cursor() as cursor:
+                await cursor.execute(query, params)
+                executed = time.perf_counter()
+                result = list(await cursor.fetchall()) if cursor.description else []
+                fetched = time.perf_counter()
+                await connection.commit()
+            if self.metrics is not None:
+                self.metrics.observe('connect', acquired - start)
+                self.metrics.observe('execute', executed - acquired)
+                self.metrics.observe('fetch', fetched - executed)
+            return result
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+            # the connection may be broken, do not give it back as it is
+            connection.close()
+            raise
+        except Exception:
+            await connection.rollback()
+            raise
+        finally:
+            if self.classifier.describe(query).changes_session or '/*!' in query:
+                # aiomysql can not reset a session: a connection whose session was changed (USE, SET, LOCK TABLES...)
+                # is closed instead of being handed to the next request
+                connection.close()
+            pool.release(connection)
+
+    async def run_query(self, pool, query, params=None):
+        """
+        execute a query going through the result cache when it is enabled, like run_query in proxy.py
+        """
+        if self.result_cache is None:
+            return await self.execute(pool, query, params)
+        info = self.classifier.describe(query)
+        if info.cacheable and self.result_cache.accepts(query, info.tables):
+            key = cache_key(query, params)
+            result = self.result_cache.get(key)
+            if result is None:
+                token = self.result_cache.token()
+                result = await self.execute(pool, query, params)
+                self.result_cache.put(key, result, info.tables, token)
+            return result
+        try:
+            return await self.execute(pool, query, params)
+        finally:
+            if info.category in (WRITE, DDL):
+                self.result_cache.invalidate_write(info.tables)
+
+    async def direct_hit(self, request):
+        """
+        direct hit strategy: the query is executed by the manager
+        """
+        data = await request.json()
+        result = await self.run_query(self.pools[self.master_config['host']], data['query'], data.get('params'))
+        return json_response({'result': result})
+
+    async def random_proxy(self, request):
+        """
+        random strategy: the query is executed through the tunnel of a random worker
+        """
+        data = await request.json()
+        selected_slave = random.choice(self.workers_config)
+        result = await self.run_query(self.route_pool(selected_slave), data.get('query'), data.get('params'))
+        return json_response({'result': result})
+
+    async def customized_proxy(self, request):
+        """
+        customized strategy: the query is executed through the tunnel of the fastest healthy node of the latency table
+        """
+        data = await request.json()
+        fastest_host = self.latency_table.fastest()
+        selected_server = self.nodes_config[fastest_host] if fastest_host is not None else self.master_config
+        result = await self.run_query(self.route_pool(selected_server), data.get('query'), data.get('params'))
+        return json_response({'result': result})
+
+    async def auto_proxy(self, request):
+        """
+        read/write splitting strategy: reads on a random healthy worker, everything else on the manager
+        """
+        data = await request.json()
+        query = data.get('query')
+        if self.classifier.classify(query) == READ:
+            healthy_workers = [worker for worker in self.workers_config if self.latency_table.is_healthy(worker['host'])]
+            pool = self.route_pool(random.choice(healthy_workers or self.workers_config))
+        else:
+            pool = self.pools[self.master_config['host']]
+        result = await self.run_query(pool, query, data.get('params'))
+        return json_response({'result': result})
+
+    async def stats(self, request):
+        def pool_stats(pool):
+            return {'open': pool.size, 'idle': pool.freesize, 'in_use': pool.size - pool.freesize,
+                    'min_size': pool.minsize, 'max_size': pool.maxsize}
+
+        return json_response({
+            'classifier': self.classifier.stats(),
+            'result_cache': self.result_cache.stats() if self.result_cache is not None else {},
+            'latency': self.latency_table.snapshot(),
+            'pools': {host: pool_stats(pool) for host, pool in self.pools.items()},
+            'tunnel_pools': {host: pool_stats(pool) for host, pool in self.tunnel_pools.items()},
+            'tunnels': self.tunnel_manager.stats() if self.tunnel_manager is not None else {},
+            'query_log': self.query_log.stats() if self.query_log is not None else {},
+        })
+
+    def make_app(self):
+        middlewares = [aiohttp_middleware(self.metrics)] if self.metrics is not None else []
+        if self.query_log is not None:
+            middlewares.append(query_log_middleware(self.query_log))
+        app = web.Application(middlewares=middlewares)
+        if self.metrics is not None:
+            app.router.add_get('/metrics', metrics_handler(self.metrics))
+        app.router.add_post('/direct_hit', self.direct_hit)
+        app.router.add_post('/random', self.random_proxy)
+        app.router.add_post('/customized', self.customized_proxy)
+        app.router.add_post('/auto', self.auto_proxy)
+        app.router.add_get('/stats', self.stats)
+        app.on_startup.append(self.on_startup)
+        app.on_cleanup.append(self.on_cleanup)
+        return app
+
+    def run(self, host='0.0.0.0', port=5000):
+        web.run_app(self.make_app(), host=host, port=port)
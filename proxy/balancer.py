@@ -0,0 +1,104 @@
+"""
+This file contains the load aware balancer of the proxy
+It counts the requests in flight on each node and smooths their latency, so that strategies can route to the least busy node
+"""
+import random
+import threading
+import time
+
+
+class LoadBalancer:
+    """
+    Tracks the load of each node and picks nodes with it
+    - track(host) wraps the execution of a query on a node: in flight count, smoothed latency and error count
+    - least_outstanding(hosts) picks the node with the fewest requests in flight (ties broken by latency)
+    - power_of_two(hosts) samples two random nodes and picks the one with the lowest cost, cost = latency * (in flight + 1)
+    nodes for which is_healthy(host) is false are skipped, unless no node is healthy
+    """
+
+    def __init__(self, hosts, is_healthy=None, alpha=0.3):
+        self.alpha = alpha
+        self.is_healthy = is_healthy if is_healthy is not None else (lambda host: True)
+        self._lock = threading.Lock()
+        self._in_flight = {host: 0 for host in hosts}
+        self._latency = {host: None for host in hosts}
+        self._counters = {host: {'requests': 0, 'errors': 0} for host in hosts}
+        self._picked = {}  # strategy -> host -> number of times the strategy picked the host
+
+    def _candidates(self, hosts):
+        healthy = [host for host in hosts if self.is_healthy(host)]
+        return healthy or list(hosts)
+
+    def _record_pick(self, strategy, host):
+        picked = self._picked.setdefault(strategy, {})
+        picked[host] = picked.get(host, 0) + 1
+
+    def _cost(self, host):
+        # a node without latency yet is assumed as fast as the fastest known one, so that it gets tried
+        known = [latency for latency in self._latency.values() if latency is not None]
+        latency = self._latency[host] if self._latency[host] is not None else min(known, default=1.0)
+        return latency * (self._in_flight[host] + 1)
+
+    def least_outstanding(self, hosts):
+        candidates = self._candidates(hosts)
+        random.shuffle(candidates)
+        with self._lock:
+            host = min(candidates, key=lambda host: (self._in_flight[host], self._latency[host] or 0.0))
+            self._record_pick('least_outstanding', host)
+        return host
+
+    def power_of_two(self, hosts):
+        candidates = self._candidates(hosts)
+        sampled = random.sample(candidates, 2) if len(candidates) >= 2 else candidates
+        with self._lock:
+            host = min(sampled, key=self._cost)
+            self._record_pick('power_of_two', host)
+        return host
+
+    def track(self, host):
+        """
+        Context manager counting a query as in flight on the given node while it runs
+        """
+        return _Tracked(self, host)
+
+    def _start(self, host):
+        with self._lock:
+            self._in_flight[host] += 1
+            self._counters[host]['requests'] += 1
+
+    def _finish(self, host, seconds, failed):
+        with self._lock:
+            self._in_flight[host] -= 1
+            if failed:
+                self._counters[host]['errors'] += 1
+            previous = self._latency[host]
+            self._latency[host] = seconds if previous is None else self.alpha * seconds + (1 - self.alpha) * previous
+
+    def stats(self):
+        with self._lock:
+            nodes = {host: dict(self._counters[host], in_flight=self._in_flight[host], latency_ewma=self._latency[host])
+                     for host in self._in_flight}
+            picked = {strategy: dict(hosts) for strategy, hosts in self._picked.items()}
+        return {'nodes': nodes, 'picked': picked}
+
+
+class _Tracked:
+    """
+    the query counts as an error of the node when an exception leaves the block, or when failed was set inside it
+    (for the errors that are caught and reported to the client)
+    """
+
+    def __init__(self, balancer, host):
+        self.balancer = balancer
+        self.host = host
+        self.start = None
+        self.failed = False
+
+    def __enter__(self):
+        self.balancer._start(self.host)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.balancer._finish(self.host, time.perf_counter() - self.start, exc_type is not None or self.failed)
+        return False
@@ -0,0 +1,214 @@
+"""
+This file contains the sql statement classifier used by the read/write splitting strategy and the result cache of the proxy
+Statements are reduced to a fingerprint (literals replaced by ?, comments and extra spaces removed, lower case)
+and the description of each fingerprint (category, tables, cacheable) is memoized, so repeated statements are only parsed once
+"""
+import re
+import threading
+from collections import OrderedDict, namedtuple
+
+
+READ = 'read'
+WRITE = 'write'
+DDL = 'ddl'
+TRANSACTION = 'transaction'
+
+# one pass tokenizer: comments are dropped, string and number literals become ?, spaces are collapsed
+# quoted identifiers are matched so that their content is left untouched
+# as in mysql, -- starts a comment only when a space (or the end of the query) follows it: x=1--1 is x=1-(-1)
+_TOKEN_RE = re.compile(r"""
+      (?P<comment>/\*.*?\*/|--(?=\s|$)[^\n]*|\#[^\n]*)
+    | (?P<identifier>`(?:[^`]|``)*`)
+    | (?P<string>'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*")
+    | (?P<number>(?<![\w.])[-+]?\d+(?:\.\d*)?(?:e[-+]?\d+)?\b)
+    | (?P<space>\s+)
+""", re.S | re.X | re.I)
+
+_FIRST_KEYWORDS = {
+    'select': READ, 'show': READ, 'describe': READ, 'desc': READ, 'explain': READ, 'help': READ,
+    'insert': WRITE, 'update': WRITE, 'delete': WRITE, 'replace': WRITE, 'load': WRITE, 'call': WRITE, 'do': WRITE, 'handler': WRITE,
+    'create': DDL, 'alter': DDL, 'drop': DDL, 'truncate': DDL, 'rename': DDL, 'grant': DDL, 'revoke': DDL, 'analyze': DDL, 'optimize': DDL,
+    'begin': TRANSACTION, 'start': TRANSACTION, 'commit': TRANSACTION, 'rollback': TRANSACTION, 'savepoint': TRANSACTION,
+    'release': TRANSACTION, 'lock': TRANSACTION, 'unlock': TRANSACTION, 'xa': TRANSACTION,
+}
+
+# a read that locks rows or writes somewhere must be executed by the manager
+_LOCKING_READ_RE = re.compile(r'\bfor update\b|\bfor share\b|\block in share mode\b|\binto (?:outfile|dumpfile|@)')
+
+# SET statements changing the transaction behaviour, other SET statements change the session state
+_SET_TRANSACTION_RE = re.compile(r'set (?:session |global |@@)?(?:autocommit|transaction)\b')
+
+# tables referenced by a statement: FROM/UPDATE take a list of tables (separated by commas or joins) that ends with the next clause,
+# INTO/TABLE/TRUNCATE take a single table
+_TABLE_LIST_RE = re.compile(r'\b(?:from|update)\s+(.*?)(?=\b(?:where|group|order|having|limit|union|for|lock|set|select|window|procedure)\b|;|$)')
+_SINGLE_TABLE_RE = re.compile(r'\b(?:into|truncate(?:\s+table)?|table)(?:\s+if(?:\s+not)?\s+exists)?\s+(`[^`]+`|[\w$.]+)')
+_TABLE_NAME_RE = re.compile(r'\s*(`[^`]+`|[\w$.]+)')
+_TABLE_KEYWORDS = {'select', 'set', 'where', 'values', 'value', 'ignore', 'low_priority', 'quick', 'table', 'lateral', 'dual',
+                   'left', 'right', 'inner', 'outer', 'cross', 'natural', 'straight_join', 'partition'}
+
+# functions and variables that make the result of a read change from one execution to another
+_NON_DETERMINISTIC_RE = re.compile(r'\b(?:now|rand|uuid|uuid_short|sysdate|curdate|curtime|current_date|current_time|current_timestamp'
+                                   r'|localtime|localtimestamp|unix_timestamp|utc_date|utc_time|utc_timestamp|last_insert_id'
+                                   r'|connection_id|found_rows|row_count|sleep|get_lock|benchmark)\b|@')
+
+# statements leaving state in the session of the connection (current database, variables, locks, temporary tables,
+# prepared statements...), the next borrower of a pooled connection must not see it
+_SESSION_RE = re.compile(r'(?:^|;)\s*(?:use|set|lock|unlock|prepare|execute|deallocate|handler|xa)\b'
+                         r'|\b(?:create|drop) temporary\b|\bget_lock\b|@')
+
+# the more a category needs the manager, the higher its rank: a multi statement query takes the highest one
+_RANK = {READ: 0, WRITE: 1, TRANSACTION: 2, DDL: 3}
+
+
+# description of a statement: its category, the tables it references, whether its result can be cached
+# and whether it changes the session state of its connection
+StatementInfo = namedtuple('StatementInfo', ['category', 'tables', 'cacheable', 'changes_session'])
+
+
+def _replace_token(match):
+    kind = match.lastgroup
+    if kind == 'comment':
+        return ' '
+    if kind == 'string' or kind == 'number':
+        return '?'
+    if kind == 'space':
+        return ' '
+    return match.group()
+
+
+def fingerprint(query):
+    """
+    Normalize a query so that statements that only differ by their literals, comments, case or spacing are equal
+    e.g. "SELECT * FROM actor WHERE actor_id=100;" -> "select * from actor where actor_id=?"
+    """
+    return _TOKEN_RE.sub(_replace_token, query).strip().rstrip(';').strip().lower()
+
+
+def _keep_literals(match):
+    kind = match.lastgroup
+    if kind == 'comment' or kind == 'space':
+        return ' '
+    return match.group()
+
+
+def normalize(query):
+    """
+    Remove comments and extra spaces of a query, unlike fingerprint() the literals and their case are kept
+    e.g. "SELECT *  FROM actor WHERE actor_id=100;" -> "SELECT * FROM actor WHERE actor_id=100"
+    """
+    return _TOKEN_RE.sub(_keep_literals, query).strip().rstrip(';').strip()
+
+
+def _table_name(item):
+    match = _TABLE_NAME_RE.match(item)
+    if match is None:
+        return None
+    name = match.group(1).strip('`').split('.')[-1].strip('`')
+    return name if name not in _TABLE_KEYWORDS else None
+
+
+def tables(fingerprinted):
+    """
+    Names of the tables referenced by an already fingerprinted query (without their database prefix)
+    the result may contain extra names for unusual statements but should not miss a table, it is used for cache invalidation
+    """
+    names = set()
+    for match in _TABLE_LIST_RE.finditer(fingerprinted):
+        for item in re.split(r',|\bjoin\b', match.group(1)):
+            names.add(_table_name(item))
+    for match in _SINGLE_TABLE_RE.finditer(fingerprinted):
+        names.add(_table_name(match.group(1)))
+    names.discard(None)
+    return frozenset(names)
+
+
+def _classify_statement(statement):
+    words = statement.lstrip('( ').split(None, 2)
+    if not words:
+        return READ
+    keyword = words[0]
+    if keyword == 'with':
+        # common table expression: a read unless the main statement is a write
+        if re.search(r'\)\s*(insert|update|delete|replace)\b', statement):
+            category = WRITE
+        else:
+            category = READ
+    elif keyword == 'set':
+        category = TRANSACTION if _SET_TRANSACTION_RE.match(statement) else WRITE
+    else:
+        # unknown statements go to the manager
+        category = _FIRST_KEYWORDS.get(keyword, WRITE)
+    if category == READ and _LOCKING_READ_RE.search(statement):
+        category = WRITE
+    return category
+
+
+def classify_fingerprint(fingerprinted):
+    """
+    Classify an already fingerprinted query as read, write, ddl or transaction control
+    """
+    category = READ
+    for statement in fingerprinted.split(';'):
+        statement = statement.strip()
+        if statement:
+            statement_category = _classify_statement(statement)
+            if _RANK[statement_category] > _RANK[category]:
+                category = statement_category
+    return category
+
+
+def describe_fingerprint(fingerprinted):
+    """
+    Describe an already fingerprinted query: category, referenced tables, whether the result of a read can be cached
+    and whether the query changes the session state
+    only plain reads referencing at least one table and without non deterministic functions are cacheable
+    """
+    category = classify_fingerprint(fingerprinted)
+    referenced = tables(fingerprinted)
+    cacheable = (category == READ and bool(referenced) and fingerprinted.lstrip('( ').startswith(('select', 'with'))
+                 and not _NON_DETERMINISTIC_RE.search(fingerprinted))
+    return StatementInfo(category, referenced, cacheable, bool(_SESSION_RE.search(fingerprinted)))
+
+
+class Classifier:
+    """
+    Memoizes the description of each query fingerprint in a bounded LRU cache
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def describe(self, query):
+        key = fingerprint(query)
+        with self._lock:
+            info = self._cache.get(key)
+            if info is not None:
+                self._cache.move_to_end(key)
+                self._hits += 1
+                return info
+            self._misses += 1
+
+        info = describe_fingerprint(key)
+        with self._lock:
+            self._cache[key] = info
+            if len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return info
+
+    def classify(self, query):
+        return self.describe(query).category
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': self._hits / lookups if lookups else 0.0,
+                'size': len(self._cache),
+                'max_size': self.max_size,
+            }
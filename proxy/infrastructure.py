@@ -104,6 +104,17 @@ upload_file_to_ec2(instance, private_key_path, os.path.join(proxy_host_path, os.
 # upload proxy.py source code to proxy ec2 machine
 upload_file_to_ec2(instance, proxy_source_code, os.path.join(proxy_host_path, os.path.basename(proxy_source_code)), private_key_path)
 
+# upload the modules imported by proxy.py, they live next to it
+proxy_modules = ['pool.py', 'tunnels.py', 'prober.py', 'classifier.py', 'result_cache.py', 'async_proxy.py', 'balancer.py', 'prepared.py']
+for module in proxy_modules:
+    upload_file_to_ec2(instance, os.path.join(os.path.dirname(proxy_source_code), module), os.path.join(proxy_host_path, module), private_key_path)
+
+# copy the modules shared with the gatekeeper applications, they live at the root of the repository
+shared_modules = ['metrics.py', 'prefork.py', 'query_log.py']
+shared_modules_dir = os.path.dirname(os.path.dirname(os.path.abspath(proxy_source_code)))
+for module in shared_modules:
+    upload_file_to_ec2(instance, os.path.join(shared_modules_dir, module), os.path.join(proxy_host_path, module), private_key_path)
+
 
 # prepare the proxy environment and launch proxy server 
 proxy_commands = [
@@ -116,8 +127,9 @@ proxy_commands = [
     'pip install sshtunnel', # install sshtunnel
     'pip install mysql-connector-python ', # install mysql-connector-python
     'pip install flask', # install flask
+    'pip install aiohttp aiomysql', # install aiohttp and aiomysql for the async serving mode
     'pip install requests', # install requests
-    'python proxy.py' # launch proxy flask application
+    'python proxy.py --workers 2' # launch proxy flask application, one worker process per vcpu of the t2.large
 ]
 # execute the commands to configure the proxy flask app
 for i in range(len(proxy_commands)):
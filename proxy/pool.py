@@ -0,0 +1,263 @@
+"""
+This file contains the connection pool used by the proxy, one pool is created per node of the mysql cluster
+so that requests reuse already authenticated connections instead of opening a new one each time
+"""
+import threading
+import time
+import mysql.connector
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no connection could be borrowed from the pool before the checkout timeout
+    """
+
+
+class ConnectionPool:
+    """
+    A thread safe pool of mysql connections to a single node
+    - min_size connections are opened upfront and are never evicted
+    - at most max_size connections are open at the same time, extra borrowers wait up to checkout_timeout
+    - connections idle for more than idle_timeout are closed (down to min_size)
+    - a connection idle for more than ping_after seconds is pinged before being handed out
+    name identifies the node behind the pool, it defaults to the host of the config
+    on_acquire, when given, is called with the seconds spent in each acquire() (wait, ping and connect included)
+    on_reset, when given, is called with each connection whose session was reset (its prepared statements are gone)
+    """
+
+    def __init__(self, config, min_size=1, max_size=10, idle_timeout=300, checkout_timeout=5, ping_after=5, name=None,
+                 on_acquire=None, on_reset=None):
+        self.config = config
+        self.name = name if name is not None else config['host']
+        self.on_acquire = on_acquire
+        self.on_reset = on_reset
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.ping_after = ping_after
+
+        self._idle = []  # (connection, time it was released), most recently used at the end
+        self._size = 0  # open connections: idle + borrowed
+        self._condition = threading.Condition()
+        self._counters = {
+            'created': 0,
+            'checkouts': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'evicted_idle': 0,
+            'discarded_broken': 0,
+            'resets': 0,
+        }
+
+        for _ in range(min_size):
+            try:
+                connection = self._open()
+            except mysql.connector.Error:
+                # the node may not be reachable yet, the pool will grow on demand
+                break
+            with self._condition:
+                self._size += 1
+                self._idle.append((connection, time.monotonic()))
+
+    def _open(self):
+        connection = mysql.connector.connect(**self.config)
+        with self._condition:
+            self._counters['created'] += 1
+        return connection
+
+    def _is_alive(self, connection, idle_for):
+        if idle_for < self.ping_after:
+            return True
+        try:
+            connection.ping(reconnect=False)
+            return True
+        except mysql.connector.Error:
+            return False
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def acquire(self):
+        """
+        Borrow a connection from the pool:
+        1- reuse the most recently released idle connection if it is still alive
+        2- otherwise open a new one if the pool is not full
+        3- otherwise wait for a connection to be released
+        """
+        if self.on_acquire is None:
+            return self._acquire()
+        start = time.perf_counter()
+        try:
+            return self._acquire()
+        finally:
+            self.on_acquire(time.perf_counter() - start)
+
+    def _acquire(self):
+        deadline = time.monotonic() + self.checkout_timeout
+        with self._condition:
+            self._counters['checkouts'] += 1
+        while True:
+            idle = None
+            with self._condition:
+                while True:
+                    if self._idle:
+                        idle = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        # reserve the slot before releasing the lock to connect
+                        self._size += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._counters['timeouts'] += 1
+                        raise PoolTimeout(f"no connection available to {self.config['host']} after {self.checkout_timeout}s")
+                    self._counters['waits'] += 1
+                    self._condition.wait(remaining)
+
+            if idle is None:
+                break
+            # the liveness check is done outside the lock, it may need a round trip to the node
+            connection, released_at = idle
+            if self._is_alive(connection, time.monotonic() - released_at):
+                return connection
+            with self._condition:
+                self._size -= 1
+                self._counters['discarded_broken'] += 1
+            self._close(connection)
+
+        try:
+            return self._open()
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+    def _reset(self, connection):
+        """
+        Clear the session state of a connection (current database, variables, locks, temporary tables, prepared statements),
+        return False when the connection could not be reset
+        """
+        try:
+            connection.reset_session()
+        except mysql.connector.Error:
+            return False
+        with self._condition:
+            self._counters['resets'] += 1
+        if self.on_reset is not None:
+            self.on_reset(connection)
+        return True
+
+    def release(self, connection, broken=False, reset=False):
+        """
+        Give a connection back to the pool, broken connections are closed instead of being reused
+        reset is given when the borrower changed the session (USE, SET, LOCK TABLES, temporary tables...):
+        the session is reset before the connection goes back, so that the next borrower does not inherit it,
+        and a connection that can not be reset is closed
+        """
+        if reset and not broken:
+            # the reset needs a round trip to the node, it is done outside the lock
+            broken = not self._reset(connection)
+        with self._condition:
+            if broken:
+                self._size -= 1
+                self._counters['discarded_broken'] += 1
+            else:
+                self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
+        if broken:
+            self._close(connection)
+
+    def connection(self, reset=False):
+        """
+        Context manager to borrow a connection and give it back once the block is done (reset as in release())
+        """
+        return _Borrowed(self, reset)
+
+    def evict_idle(self):
+        """
+        Close the connections that were idle for more than idle_timeout, keeping at least min_size open
+        """
+        now = time.monotonic()
+        to_close = []
+        with self._condition:
+            kept = []
+            # the oldest connections are at the start of the idle list
+            for connection, released_at in self._idle:
+                if now - released_at > self.idle_timeout and self._size > self.min_size:
+                    self._size -= 1
+                    self._counters['evicted_idle'] += 1
+                    to_close.append(connection)
+                else:
+                    kept.append((connection, released_at))
+            self._idle = kept
+        for connection in to_close:
+            self._close(connection)
+
+    def discard_idle(self):
+        """
+        Close every idle connection, used when the route to the node changed (e.g. a tunnel was re-opened)
+        """
+        with self._condition:
+            to_close = [connection for connection, _ in self._idle]
+            self._size -= len(to_close)
+            self._counters['discarded_broken'] += len(to_close)
+            self._idle = []
+            self._condition.notify_all()
+        for connection in to_close:
+            self._close(connection)
+
+    def stats(self):
+        with self._condition:
+            stats = dict(self._counters)
+            stats['open'] = self._size
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._size - len(self._idle)
+            stats['min_size'] = self.min_size
+            stats['max_size'] = self.max_size
+        return stats
+
+
+class _Borrowed:
+    """
+    Context manager returned by ConnectionPool.connection(), a connection that raised a mysql error is dropped
+    """
+
+    def __init__(self, pool, reset=False):
+        self.pool = pool
+        self.reset = reset
+        self.connection = None
+
+    def __enter__(self):
+        self.connection = self.pool.acquire()
+        return self.connection
+
+    def __exit__(self, exc_type, exc, tb):
+        broken = exc_type is not None and issubclass(exc_type, (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError))
+        if exc_type is not None and not broken:
+            # a failing statement (syntax error, constraint...) leaves the connection usable
+            try:
+                self.connection.rollback()
+            except Exception:
+                broken = True
+        self.pool.release(self.connection, broken=broken, reset=self.reset)
+        return False
+
+
+def start_reaper(pools, interval=30):
+    """
+    Start a daemon thread that periodically evicts idle connections of the given pools
+    """
+    def reap():
+        while True:
+            time.sleep(interval)
+            for pool in list(pools):
+                pool.evict_idle()
+
+    thread = threading.Thread(target=reap, name='pool-reaper', daemon=True)
+    thread.start()
+    return thread
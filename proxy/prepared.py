@@ -0,0 +1,229 @@
+"""
+This file contains the server side prepared statement cache of the proxy
+The literals of each query are turned into parameters, and each connection keeps a LRU of the statements it prepared,
+so a statement shape seen before is executed with the binary protocol instead of being parsed and planned again by mysql
+"""
+import contextlib
+import decimal
+import re
+import threading
+import weakref
+from collections import OrderedDict
+import mysql.connector
+
+# literals that can become parameters: strings and unsigned numbers (a sign stays in the query: x=-5 -> x=-?)
+# strings directly preceded by a word are charset introducers or hex/bit literals (_utf8'a', x'ff'), they are kept
+_LITERAL_RE = re.compile(r"""
+      (?P<comment>/\*.*?\*/|--(?=\s|$)[^\n]*|\#[^\n]*)
+    | (?P<identifier>`(?:[^`]|``)*`)
+    | (?P<string>(?<!\w)'(?:[^'\\]|\\.|'')*'|(?<!\w)"(?:[^"\\]|\\.|"")*")
+    | (?P<number>(?<![\w.])\d+(?:\.\d*)?(?:e[-+]?\d+)?\b)
+    | (?P<word>[a-z_][\w$]*)
+""", re.S | re.X | re.I)
+
+_ESCAPES = {'0': '\0', 'b': '\b', 'n': '\n', 'r': '\r', 't': '\t', 'Z': '\x1a'}
+_ESCAPE_RE = re.compile(r"\\(.)|''|\"\"", re.S)
+
+# numbers in these clauses are column positions (ORDER BY 1), they can not become parameters
+_POSITIONAL_CLAUSES = {'order', 'group'}
+_CLAUSE_KEYWORDS = {'select', 'from', 'where', 'having', 'limit', 'union', 'for', 'into', 'window', 'procedure', 'lock', 'offset'}
+
+_PREPARABLE_KEYWORDS = ('select', 'insert', 'update', 'delete', 'replace')
+
+# mysql errors of a template that can not be prepared: a statement the prepared protocol does not support (ER_UNSUPPORTED_PS)
+# and a parse error (ER_PARSE_ERROR) of a literal that can not be a parameter, the other errors are the ones of the query
+UNPREPARABLE_ERRNOS = (1295, 1064)
+
+# queries with a comment are not prepared: optimizer hints (/*+ ... */) and executable comments (/*! ... */) are read by mysql,
+# and -- is only a comment when a space follows it (x=5--1 is x=5-(-1)), parametrize() must not get any of them wrong
+_COMMENT_MARK_RE = re.compile(r'/\*|--|#')
+
+
+def _unescape(literal):
+    quote = literal[0]
+    body = literal[1:-1]
+
+    def replace(match):
+        if match.group(1) is None:
+            return quote
+        char = match.group(1)
+        # \% and \_ keep their backslash, as in mysql
+        if char in '%_':
+            return '\\' + char
+        return _ESCAPES.get(char, char)
+
+    return _ESCAPE_RE.sub(replace, body)
+
+
+def _timed(stage, name):
+    return stage(name) if stage is not None else contextlib.nullcontext()
+
+
+def _number(literal):
+    if re.fullmatch(r'\d+', literal):
+        return int(literal)
+    if 'e' in literal.lower():
+        return float(literal)
+    return decimal.Decimal(literal)
+
+
+def parametrize(query):
+    """
+    Replace the literals of a query by ? placeholders and return (template, params)
+    e.g. "select * from actor where actor_id=100 and last_name='Abbassi'" ->
+         ("select * from actor where actor_id=? and last_name=?", [100, 'Abbassi'])
+    literals after AS (aliases) and in ORDER BY / GROUP BY (column positions) are kept in the template
+    """
+    params = []
+    state = {'previous_word': None, 'positional': False}
+
+    def replace(match):
+        kind = match.lastgroup
+        text = match.group()
+        if kind == 'word':
+            word = text.lower()
+            if word == 'by' and state['previous_word'] in _POSITIONAL_CLAUSES:
+                state['positional'] = True
+            elif word in _CLAUSE_KEYWORDS:
+                state['positional'] = False
+            state['previous_word'] = word
+            return text
+        if kind == 'comment':
+            return ' '
+        previous_word = state['previous_word']
+        state['previous_word'] = None
+        if kind == 'string' and previous_word != 'as':
+            params.append(_unescape(text))
+            return '?'
+        if kind == 'number' and not state['positional']:
+            params.append(_number(text))
+            return '?'
+        return text
+
+    template = _LITERAL_RE.sub(replace, query).strip().rstrip(';').strip()
+    return template, params
+
+
+class PreparedStatementCache:
+    """
+    Executes queries as server side prepared statements
+    - each connection has its own LRU of at most max_per_connection prepared cursors, keyed by the statement template
+    - a template that mysql refuses to prepare (UNPREPARABLE_ERRNOS) is executed as plain text, and when the plain text runs
+      the template is remembered (in a LRU of max_unpreparable templates) and executed as plain text from then on
+    - only single select/insert/update/delete/replace statements are prepared, the others are executed as plain text
+    - queries with comments (or a -- that may not be one) are executed as plain text, as they were sent
+    """
+
+    def __init__(self, max_per_connection=64, max_unpreparable=1024):
+        self.max_per_connection = max_per_connection
+        self.max_unpreparable = max_unpreparable
+        self._statements = weakref.WeakKeyDictionary()  # connection -> OrderedDict(template -> prepared cursor)
+        self._unpreparable = OrderedDict()  # template -> None, least recently seen first
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'unpreparable': 0, 'plain': 0}
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def _is_unpreparable(self, template):
+        with self._lock:
+            if template not in self._unpreparable:
+                return False
+            self._unpreparable.move_to_end(template)
+            return True
+
+    def _add_unpreparable(self, template):
+        with self._lock:
+            self._unpreparable[template] = None
+            if len(self._unpreparable) > self.max_unpreparable:
+                self._unpreparable.popitem(last=False)
+            self._counters['unpreparable'] += 1
+
+    def _plain_execute(self, connection, query, params, stage):
+        self._count('plain')
+        cursor = connection.cursor()
+        try:
+            with _timed(stage, 'execute'):
+                cursor.execute(query, params)
+            with _timed(stage, 'fetch'):
+                return cursor.fetchall() if cursor.with_rows else []
+        finally:
+            cursor.close()
+
+    def execute(self, connection, query, params=None, stage=None):
+        """
+        Execute a query on the given connection and return its rows (an empty list when it returns none)
+        stage, when given, is called with 'execute' and 'fetch' and returns a context manager timing this part
+        """
+        if (not query.lstrip(' \t\n(').lower().startswith(_PREPARABLE_KEYWORDS) or isinstance(params, dict)
+                or _COMMENT_MARK_RE.search(query)):
+            # prepared statements only take positional parameters, and the comments must reach mysql untouched
+            return self._plain_execute(connection, query, params, stage)
+        if params is None:
+            template, template_params = parametrize(query)
+        else:
+            # the client already sent parameters (%s placeholders): the query is the template
+            template, template_params = query, params
+        if ';' in template or self._is_unpreparable(template):
+            return self._plain_execute(connection, query, params, stage)
+
+        with self._lock:
+            statements = self._statements.get(connection)
+            if statements is None:
+                statements = self._statements[connection] = OrderedDict()
+            cursor = statements.get(template)
+            if cursor is not None:
+                statements.move_to_end(template)
+                self._counters['hits'] += 1
+            else:
+                self._counters['misses'] += 1
+        new = cursor is None
+        if new:
+            cursor = connection.cursor(prepared=True)
+
+        try:
+            with _timed(stage, 'execute'):
+                cursor.execute(template, template_params)
+        except mysql.connector.errors.ProgrammingError as e:
+            if not new:
+                raise
+            cursor.close()
+            if e.errno not in UNPREPARABLE_ERRNOS:
+                raise
+            # mysql refused to prepare the template, once the query runs as plain text (it does not have the same error)
+            # the template is executed as plain text from now on
+            rows = self._plain_execute(connection, query, params, stage)
+            self._add_unpreparable(template)
+            return rows
+        with _timed(stage, 'fetch'):
+            rows = cursor.fetchall() if cursor.with_rows else []
+
+        if new:
+            evicted = None
+            with self._lock:
+                statements[template] = cursor
+                if len(statements) > self.max_per_connection:
+                    _, evicted = statements.popitem(last=False)
+                    self._counters['evictions'] += 1
+            if evicted is not None:
+                # closing the cursor deallocates its statement on the server
+                evicted.close()
+        return rows
+
+    def forget(self, connection):
+        """
+        Drop the statements prepared on a connection whose session was reset, mysql already deallocated them
+        """
+        with self._lock:
+            self._statements.pop(connection, None)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            lookups = stats['hits'] + stats['misses']
+            stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+            stats['connections'] = len(self._statements)
+            stats['max_per_connection'] = self.max_per_connection
+            stats['unpreparable_templates'] = len(self._unpreparable)
+        return stats
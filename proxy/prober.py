@@ -0,0 +1,109 @@
+"""
+This file contains the background latency prober used by the customized strategy of the proxy
+Nodes are measured on a fixed interval outside of the request path, requests only read the resulting table
+"""
+import threading
+import time
+import ping3
+
+
+class LatencyTable:
+    """
+    In memory table of the smoothed latency and health of each node
+    - latencies are smoothed with an exponentially weighted moving average: ewma = alpha * sample + (1 - alpha) * ewma
+    - a node is unhealthy after failure_threshold consecutive failed probes, and healthy again after one success
+    - a node that was never measured is considered healthy but is never returned by fastest()
+    """
+
+    def __init__(self, hosts, alpha=0.3, failure_threshold=3):
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self._lock = threading.Lock()
+        self._rows = {host: {'ewma': None, 'last': None, 'icmp_ewma': None, 'failures': 0, 'probes': 0, 'updated_at': None}
+                      for host in hosts}
+
+    def _smooth(self, previous, sample):
+        if previous is None:
+            return sample
+        return self.alpha * sample + (1 - self.alpha) * previous
+
+    def record(self, host, seconds):
+        with self._lock:
+            row = self._rows[host]
+            row['ewma'] = self._smooth(row['ewma'], seconds)
+            row['last'] = seconds
+            row['failures'] = 0
+            row['probes'] += 1
+            row['updated_at'] = time.time()
+
+    def record_icmp(self, host, seconds):
+        with self._lock:
+            row = self._rows[host]
+            row['icmp_ewma'] = self._smooth(row['icmp_ewma'], seconds)
+
+    def record_failure(self, host):
+        with self._lock:
+            row = self._rows[host]
+            row['failures'] += 1
+            row['probes'] += 1
+            row['updated_at'] = time.time()
+
+    def is_healthy(self, host):
+        return self._rows[host]['failures'] < self.failure_threshold
+
+    def fastest(self, hosts=None):
+        """
+        Return the healthy host with the lowest smoothed latency, None if no such host was measured yet
+        """
+        best_host, best_latency = None, float('inf')
+        with self._lock:
+            for host in hosts if hosts is not None else self._rows:
+                row = self._rows[host]
+                if row['ewma'] is None or row['failures'] >= self.failure_threshold:
+                    continue
+                if row['ewma'] < best_latency:
+                    best_host, best_latency = host, row['ewma']
+        return best_host
+
+    def snapshot(self):
+        with self._lock:
+            return {host: dict(row, healthy=row['failures'] < self.failure_threshold) for host, row in self._rows.items()}
+
+
+class LatencyProber:
+    """
+    Measures every node on a fixed interval and feeds a LatencyTable
+    probes maps each host to a function running a cheap query on the node (e.g. SELECT 1 on a pooled connection),
+    its duration is the mysql level latency of the node; an icmp ping is also recorded when icmp is enabled
+    each node has its own thread so that a node that does not answer does not delay the measure of the others
+    """
+
+    def __init__(self, table, probes, interval=2, icmp=True, icmp_timeout=1):
+        self.table = table
+        self.probes = probes
+        self.interval = interval
+        self.icmp = icmp
+        self.icmp_timeout = icmp_timeout
+        self._stopped = threading.Event()
+
+    def _probe_loop(self, host, probe):
+        while not self._stopped.is_set():
+            start = time.perf_counter()
+            try:
+                probe()
+                self.table.record(host, time.perf_counter() - start)
+            except Exception:
+                self.table.record_failure(host)
+            if self.icmp:
+                ping = ping3.ping(host, timeout=self.icmp_timeout)
+                if ping:
+                    self.table.record_icmp(host, ping)
+            self._stopped.wait(self.interval)
+
+    def start(self):
+        for host, probe in self.probes.items():
+            thread = threading.Thread(target=self._probe_loop, args=(host, probe), name=f'prober-{host}', daemon=True)
+            thread.start()
+
+    def stop(self):
+        self._stopped.set()
@@ -1,138 +1,625 @@
 """
 This file contains the code of proxy design pattern that will be hosted on the proxy ec2 machine
 """
-from flask import Flask, request, jsonify
-from sshtunnel import SSHTunnelForwarder
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask import json as flask_json
+import argparse
 import random
 import time
 import json 
 import mysql.connector
-import ping3
+import prefork
+from pool import ConnectionPool, PoolTimeout, start_reaper
+from tunnels import TunnelManager
+from prober import LatencyTable, LatencyProber
+from classifier import Classifier, READ, WRITE, DDL
+from result_cache import CACHEABLE_TABLES, ResultCache, cache_key
+from balancer import LoadBalancer
+from prepared import PreparedStatementCache
+from metrics import Metrics, instrument_flask
+from query_log import QueryLog, log_flask
 
 app = Flask(__name__)
 
-# getting the details about mysql cluster machines: workers and manager and setting up the config of database, user and password
-with open('cluster_instance_details.json') as file: 
-    cluster_data = json.load(file)
+# latency histograms of the stages of the requests (decode, connect, execute, fetch, serialize), exposed on /metrics
+# (added up over all the workers with the prefork mode)
+metrics = Metrics('proxy')
+instrument_flask(app, metrics, gather=lambda: prefork.gather('metrics'))
+prefork.on_message('metrics', lambda payload: metrics.snapshot())
 
+# config of the mysql cluster machines (manager and workers), read from cluster_instance_details.json by load_config
+master_config = None
 workers_config = []
-for data in cluster_data:
-    if data['Name'] == 'manager':
-        master_config = {
-            'host': data['PublicDNS'],
-            'user': 'root',
-            'password': '',
-            'database': 'sakila',
-        }
-    else:
-            workers_config.append(
-                {
+
+# number of rows read from mysql and written to the client at once when a result is streamed
+STREAM_CHUNK_ROWS = 1000
+
+# strategies that can be used by name (e.g. in a batch)
+STRATEGIES = ['direct_hit', 'random', 'customized', 'auto', 'least_outstanding', 'p2c']
+
+# all the cluster nodes keyed by their host, filled by load_config
+nodes_config = {}
+
+# one connection pool per cluster node (manager and workers), keyed by the node host, filled by setup_pools
+pools = {}
+# pools of the connections going through the ssh tunnel of each node, used by random and customized strategies
+tunnel_pools = {}
+tunnel_manager = None
+# smoothed latency and health of each node, created by load_config and filled in the background by the prober started in setup_prober
+latency_table = None
+# read/write classification of the queries, memoized per query fingerprint
+classifier = Classifier()
+# requests in flight and latency of each node, used by the least_outstanding and p2c strategies, created by load_config
+balancer = None
+# per connection LRU of server side prepared statements, created by setup_prepared_statements (disabled when its size is 0)
+prepared_statements = None
+# cache of the read results, created by setup_result_cache (disabled when its size is 0)
+result_cache = None
+# append-only log of the query requests, created by setup_query_log (disabled when no file is given)
+query_log = None
+
+
+def load_config(probe_alpha=0.3):
+    """
+    get the details about mysql cluster machines: workers and manager and set up the config of database, user and password,
+    then the latency table and the balancer of these nodes
+    """
+    global master_config, workers_config, nodes_config, latency_table, balancer
+    with open('cluster_instance_details.json') as file: 
+        cluster_data = json.load(file)
+    workers_config = []
+    for data in cluster_data:
+        config = {
             'host': data['PublicDNS'],
             'user': 'root',
             'password': '',
             'database': 'sakila',
         }
-            )
+        if data['Name'] == 'manager':
+            master_config = config
+        else:
+            workers_config.append(config)
+    nodes_config = {config['host']: config for config in [master_config] + workers_config}
+    latency_table = LatencyTable(nodes_config, alpha=probe_alpha)
+    balancer = LoadBalancer(nodes_config, is_healthy=latency_table.is_healthy)
+
+
+def setup_worker(args, worker_id=0):
+    """
+    set up a flask serving process: config, tunnels, cache, prepared statements, pools and prober
+    with the prefork mode it runs once in each worker, whose tunnels listen on their own range of local ports
+    """
+    load_config(args.probe_alpha)
+    if not args.no_tunnels:
+        setup_tunnels(args.ssh_pkey, args.tunnel_base_port + worker_id * len(nodes_config))
+    setup_result_cache(args.result_cache_bytes, args.result_cache_ttl, args.result_cache_tables)
+    if setup_query_log(args.query_log) is not None:
+        log_flask(app, query_log)
+    setup_prepared_statements(args.prepared_statements)
+    setup_pools(args.pool_min_size, args.pool_max_size, args.pool_idle_timeout, args.pool_checkout_timeout)
+    setup_prober(args.probe_interval)
+
+
+def setup_pools(min_size, max_size, idle_timeout, checkout_timeout):
+    """
+    create the connection pool of each cluster node and start the thread evicting idle connections
+    """
+    for config in [master_config] + workers_config:
+        pools[config['host']] = ConnectionPool(config, min_size=min_size, max_size=max_size,
+                                               idle_timeout=idle_timeout, checkout_timeout=checkout_timeout,
+                                               on_acquire=record_connect, on_reset=forget_prepared_statements)
+        if tunnel_manager is not None:
+            local_host, local_port = tunnel_manager.local_address(config['host'])
+            tunnel_config = dict(config, host=local_host, port=local_port)
+            tunnel_pools[config['host']] = ConnectionPool(tunnel_config, min_size=min_size, max_size=max_size,
+                                                          idle_timeout=idle_timeout, checkout_timeout=checkout_timeout,
+                                                          name=config['host'], on_acquire=record_connect,
+                                                          on_reset=forget_prepared_statements)
+    start_reaper(list(pools.values()) + list(tunnel_pools.values()))
+
+
+def record_connect(seconds):
+    """
+    time spent borrowing a connection from a pool (waiting for it, pinging it or opening it)
+    """
+    metrics.observe('connect', seconds)
+
+
+def setup_tunnels(ssh_pkey, base_port):
+    """
+    open one persistent ssh tunnel per cluster node, a tunnel that is re-opened drops the idle connections of its pool
+    """
+    global tunnel_manager
+    hosts = [config['host'] for config in [master_config] + workers_config]
+    tunnel_manager = TunnelManager(master_config['host'], hosts, ssh_pkey, base_port=base_port,
+                                   on_reconnect=drop_tunnel_connections)
+    tunnel_manager.start()
+
+
+def drop_tunnel_connections(host):
+    """
+    called when the tunnel of a node is re-opened: the idle connections opened through the old tunnel are dead
+    """
+    if host in tunnel_pools:
+        tunnel_pools[host].discard_idle()
 
 
+def setup_prober(interval):
+    """
+    start measuring the mysql latency of each node (SELECT 1 through the same route the queries take) in the background
+    """
+    def probe(config):
+        # the probes are timed apart from the requests
+        metrics.reset_labels(endpoint='probe', strategy='')
+        return execute_query(route_pool(config), 'SELECT 1')
+
+    probes = {host: (lambda config=config: probe(config)) for host, config in nodes_config.items()}
+    LatencyProber(latency_table, probes, interval=interval).start()
+
+
+def setup_result_cache(max_bytes, ttl, tables):
+    """
+    create the read result cache, shared by all the strategies since all the nodes serve the same data
+    its entries expire after ttl seconds and only the reads of the given tables are cached
+    """
+    global result_cache
+    if max_bytes > 0:
+        result_cache = ResultCache(max_bytes, ttl=ttl, tables=tables)
+
+
+def setup_query_log(path):
+    """
+    append every query request (time, strategy, query, latency, status) to the file at path, to replay it later
+    """
+    global query_log
+    if path:
+        query_log = QueryLog(path)
+    return query_log
+
+
+def setup_prepared_statements(max_per_connection):
+    """
+    execute the queries as server side prepared statements, each connection keeping at most max_per_connection of them
+    """
+    global prepared_statements
+    if max_per_connection > 0:
+        prepared_statements = PreparedStatementCache(max_per_connection)
+
+
+def forget_prepared_statements(connection):
+    """
+    the session of a pooled connection was reset, the statements it had prepared do not exist anymore
+    """
+    if prepared_statements is not None:
+        prepared_statements.forget(connection)
+
+
+def changes_session(query):
+    """
+    whether a query leaves state in the session of its connection (USE, SET, LOCK TABLES, temporary tables, variables...),
+    its connection is then reset before going back to the pool
+    executable comments (/*! ... */) are dropped by the classifier, they may hide such a statement
+    """
+    return classifier.describe(query).changes_session or '/*!' in query
+
+
+def route_pool(config):
+    """
+    pool used to reach a node with the random and customized strategies: through its tunnel when tunnels are enabled
+    """
+    return tunnel_pools.get(config['host'], pools[config['host']])
+
+
+def select_pool(strategy, read_only=False):
+    """
+    pool of the node chosen by a strategy
+    - direct_hit: the manager
+    - random: a random worker, through its tunnel
+    - customized: the fastest healthy node of the latency table through its tunnel (the manager if none was measured yet)
+    - auto: a random healthy worker through its tunnel for read only queries, the manager otherwise
+    - least_outstanding: the healthy worker with the fewest requests in flight, through its tunnel
+    - p2c: the least loaded of two random healthy workers, through its tunnel
+    """
+    metrics.set_labels(strategy=strategy)
+    worker_hosts = [worker['host'] for worker in workers_config]
+    if strategy == 'least_outstanding':
+        return route_pool(nodes_config[balancer.least_outstanding(worker_hosts)])
+    if strategy == 'p2c':
+        return route_pool(nodes_config[balancer.power_of_two(worker_hosts)])
+    if strategy == 'random':
+        return route_pool(random.choice(workers_config))
+    if strategy == 'customized':
+        fastest_host = latency_table.fastest()
+        return route_pool(nodes_config[fastest_host] if fastest_host is not None else master_config)
+    if strategy == 'auto' and read_only:
+        healthy_workers = [worker for worker in workers_config if latency_table.is_healthy(worker['host'])]
+        return route_pool(random.choice(healthy_workers or workers_config))
+    return pools[master_config['host']]
+
+
+def execute_on_connection(connection, query, params=None):
+    """
+    execute a query on a connection and return its rows, as a prepared statement when they are enabled
+    """
+    if prepared_statements is not None:
+        return prepared_statements.execute(connection, query, params, stage=metrics.stage)
+    cursor = connection.cursor()
+    try:
+        with metrics.stage('execute'):
+            cursor.execute(query, params)
+        with metrics.stage('fetch'):
+            return cursor.fetchall() if cursor.with_rows else []
+    finally:
+        cursor.close()
+
+
+def execute_query(pool, query, params=None):
+    """
+    borrow a connection from the given pool, execute and commit the query
+    the connection is given back to the pool once the result is fetched
+    """
+    with pool.connection(reset=changes_session(query)) as connection:
+        result = execute_on_connection(connection, query, params)
+        connection.commit()
+    return result
+
+
+def stream_query(pool, query, params=None):
+    """
+    execute a query and stream its rows to the client as NDJSON (one JSON array per row) instead of building one payload
+    1- the query is executed on an unbuffered cursor: rows stay on the mysql side until they are fetched
+    2- rows are fetched STREAM_CHUNK_ROWS at a time and written to the response, so memory stays bounded whatever the result size
+    3- the connection is given back to the pool once the last row is sent (and dropped if the client went away before)
+    an error happening after the first rows were sent is reported as a last {"error": ...} line
+    """
+    reset = changes_session(query)
+
+    def generate():
+        connection = pool.acquire()
+        cursor = connection.cursor(buffered=False)
+        executed = done = False
+        # fetch and serialize times are summed over the chunks, the time spent sending them to the client is left out
+        fetch_seconds = serialize_seconds = 0.0
+        # the query counts as in flight on its node until the last row is sent
+        with balancer.track(pool.name) as tracked:
+            try:
+                with metrics.stage('execute'):
+                    cursor.execute(query, params)
+                executed = True
+                # the query was accepted, the response can start
+                yield None
+                if cursor.with_rows:
+                    while True:
+                        start = time.perf_counter()
+                        rows = cursor.fetchmany(STREAM_CHUNK_ROWS)
+                        fetched = time.perf_counter()
+                        fetch_seconds += fetched - start
+                        if not rows:
+                            break
+                        chunk = ''.join(flask_json.dumps(row) + '\n' for row in rows)
+                        serialize_seconds += time.perf_counter() - fetched
+                        yield chunk
+                connection.commit()
+                done = True
+            except mysql.connector.Error as e:
+                if not executed:
+                    # a query refused by mysql (syntax error, unknown table...) leaves the connection usable
+                    done = isinstance(e, mysql.connector.errors.ProgrammingError)
+                    raise
+                tracked.failed = True
+                yield flask_json.dumps({'error': str(e)}) + '\n'
+            finally:
+                if executed:
+                    metrics.observe('fetch', fetch_seconds)
+                    metrics.observe('serialize', serialize_seconds)
+                cursor.close()
+                # rows left unread make the connection unusable, it is dropped
+                pool.release(connection, broken=not done, reset=reset)
+        if result_cache is not None:
+            info = classifier.describe(query)
+            if info.category in (WRITE, DDL):
+                result_cache.invalidate_write(info.tables)
+
+    chunks = generate()
+    # run the query before the response starts, so that its errors get their own status code
+    next(chunks)
+    response = Response(stream_with_context(chunks), mimetype='application/x-ndjson')
+    # the generator is not resumed at all if the client goes away before the first chunk, closing it gives the connection back
+    response.call_on_close(chunks.close)
+    return response
+
+
+def tracked_execute(pool, query, params=None):
+    """
+    execute a query while the balancer counts it as in flight on the node of the pool
+    """
+    with balancer.track(pool.name):
+        return execute_query(pool, query, params)
+
+
+def serialize(payload):
+    """
+    json response of a route, timed as the serialize stage
+    """
+    with metrics.stage('serialize'):
+        return jsonify(payload)
+
+
+def run_query(pool, query, params=None):
+    """
+    execute a query going through the result cache when it is enabled
+    1- cacheable reads of cacheable tables are answered from the cache when possible, otherwise executed and their result is stored
+    2- writes and ddl drop the cached reads of the tables they touch (all of them when the tables are not known)
+    """
+    if result_cache is None:
+        return tracked_execute(pool, query, params)
+    info = classifier.describe(query)
+    if info.cacheable and result_cache.accepts(query, info.tables):
+        key = cache_key(query, params)
+        result = result_cache.get(key)
+        if result is None:
+            token = result_cache.token()
+            result = tracked_execute(pool, query, params)
+            result_cache.put(key, result, info.tables, token)
+        return result
+    try:
+        return tracked_execute(pool, query, params)
+    finally:
+        # invalidate once the write is done: reads that started before it will not be stored
+        if info.category in (WRITE, DDL):
+            result_cache.invalidate_write(info.tables)
+
 
 @app.route('/direct_hit', methods=['POST'])
 def direct_hit_endpoint():
     """
     Here the implemenation of proxy direct hit startegry: use master node
-    1- establish a connection to the manager node of mysql cluster
+    1- borrow a connection to the manager node of mysql cluster from its pool
     2- execute and commit the query
     """
-    master_connection = mysql.connector.connect(**master_config)
-    master_cursor = master_connection.cursor()
     query = request.json['query']
-    master_cursor.execute(query)
-    try:
-         master_connection.commit() 
-    except Exception as e:
-        pass
-    result = master_cursor.fetchall()
-    return jsonify({'result': result})
+    params = request.json.get('params')
+    if request.json.get('stream'):
+        return stream_query(select_pool('direct_hit'), query, params)
+    result = run_query(select_pool('direct_hit'), query, params)
+    return serialize({'result': result})
 
 
 @app.route('/random', methods=['POST'])
 def random_proxy():
     """
     Here the implemenation of random strategy choose a random woker node
-    1- establish a tunnel from the random worker to the manager (in order to be able to send sql queries using worker nodes)
-    2- establish a connection to the worker node of mysql cluster
+    1- use the tunnel from the random worker to the manager (opened at startup, in order to be able to send sql queries using worker nodes)
+    2- borrow a connection going through this tunnel from its pool
     3- execute and commit the query
     """
-    selected_slave = random.choice(workers_config)
-    tunnel = SSHTunnelForwarder(
-        (master_config['host'], 3306), 
-    ssh_username ='ubuntu', ssh_pkey="/home/ubuntu/my_key_pair.pem", 
-    remote_bind_address =(selected_slave['host'], 3306)
-        )
-    connection = mysql.connector.connect(
-        host= selected_slave['host'], 
-        user='root', 
-    password= '',
-    database= 'sakila'
-    )
-    cursor = connection.cursor()
     data = request.json
     query = data.get('query')
-
-    cursor.execute(query)
-    try:
-         connection.commit() 
-    except Exception as e:
-        pass
-    result = cursor.fetchall()
-    return jsonify({'result': result})
+    params = data.get('params')
+    if data.get('stream'):
+        return stream_query(select_pool('random'), query, params)
+    result = run_query(select_pool('random'), query, params)
+    return serialize({'result': result})
 
 @app.route('/customized', methods=['POST'])
 def customized_proxy():
     """
     Here the implemenation of customized proxy: choose the node bases on the fasted ping time
-    1- ping all cluster machines and define the fastest one
-    1- establish a tunnel from the fastest machie to the manager (in order to be able to send sql queries using all nodes)
-    2- establish a connection to the fastest node of mysql cluster
+    1- look up the fastest healthy node in the latency table kept up to date by the background prober (the manager if none was measured yet)
+    1- use the tunnel from the fastest machie to the manager (opened at startup, in order to be able to send sql queries using all nodes)
+    2- borrow a connection going through this tunnel from its pool
     2- execute and commit the query
     """
-    lowest_ping_time = float('inf')
-    for worker in workers_config:
-        ping = ping3.ping(worker['host'])
-        if ping is not None and ping < lowest_ping_time:
-            lowest_ping_time = ping
-            selected_server = worker
-
-    ping =ping3.ping(master_config['host'])
-    if ping is not None and ping < lowest_ping_time:
-        lowest_ping_time = ping
-        selected_server = master_config
-
-    tunnel = SSHTunnelForwarder(
-        (master_config['host'], 3306), 
-    ssh_username ='ubuntu', ssh_pkey="/home/ubuntu/my_key_pair.pem", 
-    remote_bind_address =(selected_server['host'], 3306)
-        )
-    connection = mysql.connector.connect(
-        host= selected_server['host'], 
-        user='root', 
-    password= '',
-    database= 'sakila'
-    )
-    cursor = connection.cursor()
     data = request.json
     query = data.get('query')
+    params = data.get('params')
+    if data.get('stream'):
+        return stream_query(select_pool('customized'), query, params)
+    result = run_query(select_pool('customized'), query, params)
+    return serialize({'result': result})
 
-    cursor.execute(query)
-    try:
-         connection.commit() 
-    except Exception as e:
-        pass
 
-    result = cursor.fetchall()
-    return jsonify({'result': result})
+@app.route('/auto', methods=['POST'])
+def auto_proxy():
+    """
+    Here the implemenation of read/write splitting strategy: choose the node based on the type of the query
+    1- classify the query as read, write, ddl or transaction control (memoized per query fingerprint)
+    2- reads are spread randomly across the healthy workers through their tunnels
+    3- writes, ddl and transaction control are sent to the manager
+    4- execute and commit the query
+    """
+    data = request.json
+    query = data.get('query')
+    params = data.get('params')
+    pool = select_pool('auto', read_only=classifier.classify(query) == READ)
+    if data.get('stream'):
+        return stream_query(pool, query, params)
+    result = run_query(pool, query, params)
+    return serialize({'result': result})
+
+
+@app.route('/least_outstanding', methods=['POST'])
+def least_outstanding_proxy():
+    """
+    Here the implemenation of least outstanding requests strategy: choose the least busy worker
+    1- skip the workers marked unhealthy by the prober
+    2- choose the worker with the fewest requests in flight (ties broken by its recent latency)
+    3- borrow a connection going through its tunnel from its pool
+    4- execute and commit the query
+    """
+    data = request.json
+    query = data.get('query')
+    params = data.get('params')
+    if data.get('stream'):
+        return stream_query(select_pool('least_outstanding'), query, params)
+    result = run_query(select_pool('least_outstanding'), query, params)
+    return serialize({'result': result})
+
+
+@app.route('/p2c', methods=['POST'])
+def power_of_two_proxy():
+    """
+    Here the implemenation of power of two random choices strategy: choose the least busy of two random workers
+    1- skip the workers marked unhealthy by the prober
+    2- sample two workers and keep the one with the lowest recent latency * (requests in flight + 1)
+    3- borrow a connection going through its tunnel from its pool
+    4- execute and commit the query
+    """
+    data = request.json
+    query = data.get('query')
+    params = data.get('params')
+    if data.get('stream'):
+        return stream_query(select_pool('p2c'), query, params)
+    result = run_query(select_pool('p2c'), query, params)
+    return serialize({'result': result})
+
+
+@app.route('/batch', methods=['POST'])
+def batch_endpoint():
+    """
+    Here the implemenation of batches: run an ordered list of queries on a single connection
+    body: {'queries': [query or {'query': ..., 'params': ...}, ...], 'strategy': 'direct_hit', 'transaction': false}
+    1- choose the node with the given strategy (auto sends the batch to a worker only when all its queries are reads)
+    2- borrow one connection from the pool of this node
+    3- without transaction each query is committed on its own and an error does not stop the batch,
+       in a transaction the first error rolls back the whole batch and the next queries are not executed
+    4- return the result or the error of each query, in order
+    """
+    data = request.json
+    strategy = data.get('strategy', 'direct_hit')
+    transaction = bool(data.get('transaction', False))
+    if strategy not in STRATEGIES:
+        return jsonify({'error': f'unknown strategy {strategy}'}), 400
+    queries = data.get('queries', [])
+    if not isinstance(queries, list):
+        return jsonify({'error': 'queries must be a list'}), 400
+    statements = []
+    for i, item in enumerate(queries):
+        if isinstance(item, str):
+            statements.append((item, None))
+        elif isinstance(item, dict) and isinstance(item.get('query'), str) and isinstance(item.get('params'), (list, dict, type(None))):
+            statements.append((item['query'], item.get('params')))
+        else:
+            return jsonify({'error': f'queries[{i}] must be a query or an object with a query and optional params'}), 400
+    infos = [classifier.describe(query) for query, _ in statements]
+    pool = select_pool(strategy, read_only=all(info.category == READ for info in infos))
+    reset = any(changes_session(query) for query, _ in statements)
+
+    results = []
+    failed = False
+    broken = False
+    committed = False
+    connection = pool.acquire()
+    with balancer.track(pool.name) as tracked:
+        try:
+            if transaction:
+                connection.start_transaction()
+            for query, params in statements:
+                try:
+                    results.append({'result': execute_on_connection(connection, query, params)})
+                    if not transaction:
+                        connection.commit()
+                except mysql.connector.Error as e:
+                    results.append({'error': str(e)})
+                    failed = True
+                    broken = isinstance(e, (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError))
+                    if transaction or broken:
+                        break
+                    connection.rollback()
+            if transaction and not broken:
+                if failed:
+                    connection.rollback()
+                else:
+                    connection.commit()
+                    committed = True
+        except mysql.connector.Error:
+            # the connection failed outside of a query (start of transaction, commit...)
+            broken = True
+            raise
+        finally:
+            pool.release(connection, broken=broken, reset=reset)
+            # the errors reported in the results count as errors of the node too
+            tracked.failed = failed
+            # the writes of the batch may have changed some tables, even when rolled back invalidating is harmless
+            if result_cache is not None:
+                for info in infos:
+                    if info.category in (WRITE, DDL):
+                        result_cache.invalidate_write(info.tables)
+
+    for _ in range(len(statements) - len(results)):
+        results.append({'error': 'not executed: the batch stopped on a previous error'})
+    response = {'results': results}
+    if transaction:
+        response['committed'] = committed
+    return serialize(response)
+
+
+@app.errorhandler(PoolTimeout)
+def pool_timeout_handler(error):
+    """
+    All the connections of the selected node are busy: answer quickly instead of queuing forever
+    """
+    return jsonify({'error': str(error)}), 503
+
+
+@app.route('/stats', methods=['GET'])
+def stats_endpoint():
+    """
+    Return the statistics of the proxy: usage of each node connection pool, state of the tunnels, latency of the nodes,
+    hit rate of the query classifier, of the result cache and of the prepared statements, load and routing counters of each node
+    """
+    return jsonify({
+        'prepared_statements': prepared_statements.stats() if prepared_statements is not None else {},
+        'balancer': balancer.stats(),
+        'classifier': classifier.stats(),
+        'result_cache': result_cache.stats() if result_cache is not None else {},
+        'latency': latency_table.snapshot(),
+        'pools': {host: pool.stats() for host, pool in pools.items()},
+        'tunnel_pools': {host: pool.stats() for host, pool in tunnel_pools.items()},
+        'tunnels': tunnel_manager.stats() if tunnel_manager is not None else {},
+        'query_log': query_log.stats() if query_log is not None else {},
+    })
 
     
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', default='flask', choices=['flask', 'async']) # flask application or asyncio serving mode
+    parser.add_argument('--pool-min-size', default=1, type=int) # connections opened upfront to each node
+    parser.add_argument('--pool-max-size', default=10, type=int) # maximum open connections to each node
+    parser.add_argument('--pool-idle-timeout', default=300, type=float) # seconds before an idle connection is closed
+    parser.add_argument('--pool-checkout-timeout', default=5, type=float) # seconds to wait for a free connection
+    parser.add_argument('--ssh-pkey', default='/home/ubuntu/my_key_pair.pem') # key used to open the tunnels
+    parser.add_argument('--tunnel-base-port', default=13306, type=int) # local port of the first tunnel, next ones follow
+    parser.add_argument('--no-tunnels', action='store_true') # connect the random and customized strategies directly
+    parser.add_argument('--probe-interval', default=2, type=float) # seconds between two latency probes of a node
+    parser.add_argument('--probe-alpha', default=0.3, type=float) # weight of the newest probe in the latency average
+    parser.add_argument('--stream-chunk-rows', default=STREAM_CHUNK_ROWS, type=int) # rows fetched at once when a result is streamed
+    parser.add_argument('--prepared-statements', default=64, type=int) # prepared statements kept per connection, 0 to disable them
+    parser.add_argument('--result-cache-bytes', default=0, type=int) # size of the read result cache (e.g. 67108864), 0 (default) to disable it
+    parser.add_argument('--result-cache-ttl', default=5, type=float) # seconds a cached result is served, the writes of other processes show up after it
+    parser.add_argument('--result-cache-tables', nargs='+', default=sorted(CACHEABLE_TABLES)) # tables whose reads are cached, views and tables written by triggers must be left out
+    parser.add_argument('--query-log', default=None) # file where every query request is appended (see query_log.py), none by default
+    parser.add_argument('--workers', default=0, type=int) # flask serving processes (prefork, SIGHUP reloads them), 0 for the single process server
+    args = parser.parse_args()
+    if args.mode == 'async' and args.workers:
+        parser.error('--workers is only supported by the flask mode')
+
+    STREAM_CHUNK_ROWS = args.stream_chunk_rows
+
+    if args.mode == 'async':
+        # the async mode has its own non blocking pools and prober, the rest (tunnels, classifier, cache) is shared
+        from async_proxy import AsyncProxy
+        load_config(args.probe_alpha)
+        if not args.no_tunnels:
+            setup_tunnels(args.ssh_pkey, args.tunnel_base_port)
+        setup_result_cache(args.result_cache_bytes, args.result_cache_ttl, args.result_cache_tables)
+        setup_query_log(args.query_log)
+        AsyncProxy(master_config, workers_config, latency_table, classifier, result_cache, tunnel_manager, metrics, query_log,
+                   pool_min_size=args.pool_min_size, pool_max_size=args.pool_max_size, pool_idle_timeout=args.pool_idle_timeout,
+                   checkout_timeout=args.pool_checkout_timeout, probe_interval=args.probe_interval).run(host='0.0.0.0', port=5000)
+    elif args.workers:
+        prefork.serve(app, host='0.0.0.0', port=5000, workers=args.workers, init=lambda worker_id: setup_worker(args, worker_id))
+    else:
+        setup_worker(args)
+        app.run(host='0.0.0.0', port=5000)
 
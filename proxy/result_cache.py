@@ -0,0 +1,170 @@
+"""
+This file contains the read result cache of the proxy (disabled by default, see --result-cache-bytes)
+Results of reads are kept in memory, tagged with the tables they read, and dropped as soon as the proxy handles a write on one of these tables
+The cache only sees the writes going through its own process: the writes of the other prefork workers, of the gatekeeper
+or of sysbench, and the rows changed by triggers, are only picked up once the entries expire (after ttl seconds)
+"""
+import json
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+# tables of the sakila database whose reads can be cached: its base tables, without the views (actor_info, film_list...)
+# whose rows come from other tables, and without film_text which is written by the triggers of film
+CACHEABLE_TABLES = frozenset([
+    'actor', 'address', 'category', 'city', 'country', 'customer', 'film', 'film_actor', 'film_category',
+    'inventory', 'language', 'payment', 'rental', 'staff', 'store',
+])
+
+# text the classifier does not see through, the reads containing it are never cached: executable comments and optimizer hints
+# (/*! ... */, /*+ ... */) are run by mysql but dropped by the classifier, and a -- followed by no space is an operator (x=1--1)
+_UNCACHEABLE_TEXT_RE = re.compile(r'/\*[!+]|--(?!\s|$)')
+
+
+def estimate_size(rows):
+    """
+    Approximate memory used by a result (list of tuples), in bytes
+    """
+    size = sys.getsizeof(rows)
+    for row in rows:
+        size += sys.getsizeof(row)
+        for value in row:
+            size += sys.getsizeof(value)
+    return size
+
+
+def cache_key(query, params):
+    """
+    Key of the result of a query: its text as sent (only the spaces around it are dropped) and its parameters
+    the text is not normalized: two queries differing only by a comment may not return the same rows
+    """
+    return query.strip(), json.dumps(params, sort_keys=True, default=str)
+
+
+class ResultCache:
+    """
+    Byte bounded LRU cache of read results
+    - keys are built by the caller from the query text and its parameters (cache_key)
+    - each entry is tagged with the tables it reads, invalidate(tables) drops all the entries reading one of them
+    - a result bigger than max_entry_bytes is not cached so that one big read does not flush the whole cache
+    - an entry expires ttl seconds after it was stored
+    - only the reads of the given tables are cached (accepts()), the other tables may be changed behind the back of the cache,
+      and the reads with executable comments, hints or -- operators are not cached
+    a read that started before an invalidation of one of its tables is not stored, its result may be stale:
+    callers take a token() before executing the read and give it back to put()
+    """
+
+    def __init__(self, max_bytes, max_entry_bytes=None, ttl=5, tables=CACHEABLE_TABLES):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes if max_entry_bytes is not None else max_bytes // 10
+        self.ttl = ttl
+        self.tables = frozenset(table.lower() for table in tables)
+        self._entries = OrderedDict()  # key -> (rows, size, tables, expiry time)
+        self._keys_by_table = {}  # table -> keys of the entries reading it
+        self._invalidated_at = {}  # table -> generation of its last invalidation
+        self._generation = 0
+        self._cleared_at = 0  # generation of the last clear()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0, 'rejected_too_big': 0,
+                          'rejected_stale': 0}
+
+    def accepts(self, query, tables):
+        """
+        Whether the result of a read of these tables can be cached: all of them are cacheable tables
+        and the query has no text hidden from the classifier
+        """
+        return bool(tables) and tables <= self.tables and not _UNCACHEABLE_TEXT_RE.search(query)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[3] <= time.monotonic():
+                self._remove(key)
+                self._counters['expirations'] += 1
+                entry = None
+            if entry is None:
+                self._counters['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+            return entry[0]
+
+    def token(self):
+        return self._generation
+
+    def put(self, key, rows, tables, token):
+        size = estimate_size(rows)
+        with self._lock:
+            if size > self.max_entry_bytes:
+                self._counters['rejected_too_big'] += 1
+                return
+            if self._cleared_at > token or any(self._invalidated_at.get(table, 0) > token for table in tables):
+                self._counters['rejected_stale'] += 1
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (rows, size, tables, time.monotonic() + self.ttl)
+            self._bytes += size
+            for table in tables:
+                self._keys_by_table.setdefault(table, set()).add(key)
+            while self._bytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self._counters['evictions'] += 1
+
+    def _remove(self, key):
+        _, size, tables, _ = self._entries.pop(key)
+        self._bytes -= size
+        for table in tables:
+            keys = self._keys_by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_table[table]
+
+    def invalidate(self, tables):
+        """
+        Drop the entries reading one of the given tables
+        """
+        with self._lock:
+            self._generation += 1
+            for table in tables:
+                self._invalidated_at[table] = self._generation
+                for key in list(self._keys_by_table.get(table, ())):
+                    self._remove(key)
+                    self._counters['invalidations'] += 1
+
+    def invalidate_write(self, tables):
+        """
+        Called after a write: drop the entries of the tables it touched, or every entry when they are not known
+        """
+        if tables:
+            self.invalidate(tables)
+        else:
+            self.clear()
+
+    def clear(self):
+        """
+        Drop every entry, used for writes whose tables are not known
+        """
+        with self._lock:
+            self._generation += 1
+            self._cleared_at = self._generation
+            self._counters['invalidations'] += len(self._entries)
+            self._entries.clear()
+            self._keys_by_table.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            lookups = stats['hits'] + stats['misses']
+            stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+            stats['max_bytes'] = self.max_bytes
+            stats['ttl'] = self.ttl
+        return stats
@@ -21,7 +21,7 @@ with open(proxy_details) as file:
 
 
 
-def send_request(query, host=proxy_detail[0]['PublicIP'], uri='direct_hit'):
+def send_request(query, host=proxy_detail[0]['PublicIP'], uri='direct_hit', stream=False):
     """
     INput:  query (SQL qery)
             stategy: proxy strategy
@@ -29,8 +29,29 @@ def send_request(query, host=proxy_detail[0]['PublicIP'], uri='direct_hit'):
 
     """
     headers = {'Content-Type': 'application/json'} 
-    data = {'query': query}
+    data = {'query': query, 'stream': stream}
     url = url_template.format(host, port,uri)
+    response = requests.post(url, json=data,headers=headers, stream=stream)
+    print(response)
+    if stream:
+        # rows are printed as they arrive, one JSON array per line
+        for line in response.iter_lines():
+            print(line.decode('utf-8'))
+        return ''
+    return response.text
+
+
+def send_batch(queries, strategy='direct_hit', transaction=False, host=proxy_detail[0]['PublicIP']):
+    """
+    INput:  queries (list of SQL queries, or of {'query': ..., 'params': ...})
+            strategy: proxy strategy used to choose the node running the whole batch
+            transaction: run the batch in a single transaction (rolled back on the first error)
+    method to send all the queries in a single post request, they are executed in order on one connection of the proxy
+
+    """
+    headers = {'Content-Type': 'application/json'} 
+    data = {'queries': queries, 'strategy': strategy, 'transaction': transaction}
+    url = url_template.format(host, port, 'batch')
     response = requests.post(url, json=data,headers=headers)
     print(response)
     return response.text
@@ -46,7 +67,10 @@ if __name__== "__main__":
     
     parser = argparse.ArgumentParser()
     parser.add_argument('--query', default='read', type=str) 
+    parser.add_argument('--stream', action='store_true') # receive the rows as a stream instead of a single payload
     parser.add_argument('--strategy', default='customized')
+    parser.add_argument('--batch', default=None, type=str) # file with one query per line, sent as a single batch
+    parser.add_argument('--transaction', action='store_true') # run the batch in a single transaction
     args = parser.parse_args()
 
     if args.query == 'read':
@@ -54,6 +78,11 @@ if __name__== "__main__":
     else:
         query = write_query
     
-    assert args.strategy in ['random', 'direct_hit', 'customized']
-    response = send_request(query, uri=args.strategy)
+    assert args.strategy in ['random', 'direct_hit', 'customized', 'auto', 'least_outstanding', 'p2c']
+    if args.batch is not None:
+        with open(args.batch) as file:
+            queries = [line.strip() for line in file if line.strip()]
+        response = send_batch(queries, strategy=args.strategy, transaction=args.transaction)
+    else:
+        response = send_request(query, uri=args.strategy, stream=args.stream)
     print(response)
@@ -0,0 +1,102 @@
+"""
+Tests of the parametrization of the prepared statement cache (python -m pytest proxy)
+"""
+import pytest
+
+mysql_connector = pytest.importorskip('mysql.connector')
+from prepared import PreparedStatementCache, parametrize
+
+
+def programming_error(errno):
+    error = mysql_connector.errors.ProgrammingError('refused')
+    error.errno = errno
+    return error
+
+
+class FakeCursor:
+
+    def __init__(self, connection, prepared):
+        self.connection = connection
+        self.prepared = prepared
+        self.with_rows = False
+
+    def execute(self, query, params=None):
+        self.connection.executed.append((self.prepared, query, params))
+        if self.prepared and self.connection.prepare_error is not None:
+            raise self.connection.prepare_error
+
+    def fetchall(self):
+        return []
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+
+    def __init__(self, prepare_error=None):
+        self.executed = []
+        self.prepare_error = prepare_error
+
+    def cursor(self, prepared=False):
+        return FakeCursor(self, prepared)
+
+
+def test_parametrize_literals():
+    assert parametrize("select * from actor where actor_id=100 and last_name='Abbassi'") == \
+        ('select * from actor where actor_id=? and last_name=?', [100, 'Abbassi'])
+
+
+def test_double_dash_without_space_is_not_a_comment():
+    # mysql runs actor_id=5--1 as actor_id = 5 - (-1)
+    assert parametrize("UPDATE actor SET last_name='x' WHERE actor_id=5--1") == \
+        ('UPDATE actor SET last_name=? WHERE actor_id=?--?', ['x', 5, 1])
+
+
+def test_double_dash_with_space_is_a_comment():
+    assert parametrize('select * from actor where actor_id=5 -- comment') == ('select * from actor where actor_id=?', [5])
+
+
+@pytest.mark.parametrize('query', [
+    "UPDATE actor SET last_name='x' WHERE actor_id=1--1",
+    'SELECT /*+ MAX_EXECUTION_TIME(1000) */ * FROM actor WHERE actor_id=1',
+    'SELECT * FROM actor WHERE actor_id=1 /*!50000 OR 1=1 */',
+    'SELECT * FROM actor WHERE actor_id=1 # comment',
+])
+def test_queries_with_comments_are_sent_as_plain_text(query):
+    connection = FakeConnection()
+    PreparedStatementCache().execute(connection, query)
+    assert connection.executed == [(False, query, None)]
+
+
+def test_plain_query_is_prepared():
+    connection = FakeConnection()
+    PreparedStatementCache().execute(connection, 'select * from actor where actor_id=1')
+    assert connection.executed == [(True, 'select * from actor where actor_id=?', [1])]
+
+
+def test_unpreparable_template_is_remembered():
+    connection = FakeConnection(programming_error(1295))
+    cache = PreparedStatementCache()
+    cache.execute(connection, 'select * from actor where actor_id=1')
+    cache.execute(connection, 'select * from actor where actor_id=2')
+    assert connection.executed == [(True, 'select * from actor where actor_id=?', [1]),
+                                   (False, 'select * from actor where actor_id=1', None),
+                                   (False, 'select * from actor where actor_id=2', None)]
+
+
+def test_other_errors_are_raised_and_not_remembered():
+    # e.g. ER_NO_SUCH_TABLE, the query itself is wrong
+    connection = FakeConnection(programming_error(1146))
+    cache = PreparedStatementCache()
+    with pytest.raises(mysql_connector.errors.ProgrammingError):
+        cache.execute(connection, 'select * from actors where actor_id=1')
+    assert cache.stats()['unpreparable_templates'] == 0
+
+
+def test_unpreparable_templates_are_bounded():
+    connection = FakeConnection(programming_error(1295))
+    cache = PreparedStatementCache(max_unpreparable=2)
+    for table in ('actor', 'film', 'city'):
+        cache.execute(connection, f'select * from {table} where id=1')
+    assert cache.stats()['unpreparable_templates'] == 2
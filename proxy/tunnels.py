@@ -0,0 +1,106 @@
+"""
+This file contains the ssh tunnel manager used by the random and customized strategies of the proxy
+A tunnel is opened once per cluster node at startup and kept open, instead of doing an ssh handshake per request
+"""
+import threading
+from sshtunnel import SSHTunnelForwarder, BaseSSHTunnelForwarderError
+
+
+class TunnelManager:
+    """
+    Keeps one persistent ssh tunnel per cluster node:
+    - each tunnel goes through the node (ssh) to the sql node of the cluster, like the original per request tunnels
+    - each tunnel listens on a stable local port: base_port, base_port + 1, ... in the order of the nodes
+    - a watcher thread checks the tunnels every check_interval seconds and re-opens the ones that dropped,
+      on_reconnect(host) is then called so that connections opened through the old tunnel can be dropped
+    """
+
+    def __init__(self, sql_host, hosts, ssh_pkey, ssh_username='ubuntu', sql_port=3306, base_port=13306,
+                 check_interval=5, keepalive=10, on_reconnect=None):
+        self.sql_host = sql_host
+        self.sql_port = sql_port
+        self.ssh_pkey = ssh_pkey
+        self.ssh_username = ssh_username
+        self.check_interval = check_interval
+        self.keepalive = keepalive
+        self.on_reconnect = on_reconnect
+        self.ports = {host: base_port + i for i, host in enumerate(hosts)}
+
+        self._forwarders = {}
+        self._counters = {host: {'opened': 0, 'reconnects': 0, 'failures': 0} for host in hosts}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def _open(self, host):
+        forwarder = SSHTunnelForwarder(
+            host,
+            ssh_username=self.ssh_username,
+            ssh_pkey=self.ssh_pkey,
+            remote_bind_address=(self.sql_host, self.sql_port),
+            local_bind_address=('127.0.0.1', self.ports[host]),
+            set_keepalive=self.keepalive,
+        )
+        forwarder.start()
+        self._counters[host]['opened'] += 1
+        return forwarder
+
+    def _is_up(self, forwarder):
+        if not forwarder.is_active:
+            return False
+        forwarder.check_tunnels()
+        return all(forwarder.tunnel_is_up.values())
+
+    def start(self):
+        """
+        Open all the tunnels and start the watcher thread
+        a node that can not be reached now is retried by the watcher
+        """
+        for host in self.ports:
+            try:
+                self._forwarders[host] = self._open(host)
+            except BaseSSHTunnelForwarderError as e:
+                self._counters[host]['failures'] += 1
+                print(f"could not open tunnel to {host}: {e}")
+        thread = threading.Thread(target=self._watch, name='tunnel-watcher', daemon=True)
+        thread.start()
+        return thread
+
+    def _watch(self):
+        while not self._stopped.wait(self.check_interval):
+            for host in self.ports:
+                forwarder = self._forwarders.get(host)
+                if forwarder is not None and self._is_up(forwarder):
+                    continue
+                if forwarder is not None:
+                    forwarder.stop()
+                try:
+                    forwarder = self._open(host)
+                except BaseSSHTunnelForwarderError as e:
+                    self._counters[host]['failures'] += 1
+                    print(f"could not re-open tunnel to {host}: {e}")
+                    continue
+                with self._lock:
+                    self._forwarders[host] = forwarder
+                    self._counters[host]['reconnects'] += 1
+                if self.on_reconnect is not None:
+                    self.on_reconnect(host)
+
+    def local_address(self, host):
+        """
+        The (host, port) to connect to in order to reach the sql node through the tunnel of the given node
+        """
+        return '127.0.0.1', self.ports[host]
+
+    def stop(self):
+        self._stopped.set()
+        for forwarder in self._forwarders.values():
+            forwarder.stop()
+
+    def stats(self):
+        stats = {}
+        with self._lock:
+            for host, port in self.ports.items():
+                forwarder = self._forwarders.get(host)
+                stats[host] = dict(self._counters[host], local_port=port,
+                                   active=forwarder is not None and forwarder.is_active)
+        return stats
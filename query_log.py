@@ -0,0 +1,157 @@
+"""
+This file contains the query log shared by the proxy and the gatekeeper (copied next to each application)
+When it is enabled, every query request is appended to a log file as one compact json line:
+    {"t": arrival time (unix seconds), "s": strategy, "q": query, "l": latency (seconds), "c": http status}
+plus "p": the params of the query and "x": true for a streamed result, when the request has them
+the strategy is the route of the request (direct_hit, random, ...) and "gatekeeper" for the gatekeeper root
+a batch of the proxy is logged with "s": "batch", its list of queries in "q" and its strategy and transaction in "o"
+The file is only appended to, and can be replayed against any endpoint with benchmarking/replay.py
+
+The requests do not wait for the disk: a line is put in a bounded queue and a background thread writes the queued lines
+in batches, the lines that do not fit in the queue are dropped (and counted). Each batch is a single write on a file
+opened in append mode, so the workers of the prefork mode can share the same file
+"""
+import json
+import os
+import threading
+import time
+from collections import deque
+
+
+class QueryLog:
+    """
+    Append-only log of the query requests
+    - append(arrival, strategy, query, latency, status, **fields) queues a line, it never blocks
+      fields are the optional keys of the line (p, x, o), a field left to None is not written
+    - the lines are written every flush_interval seconds, at most max_queued lines wait to be written
+    """
+
+    def __init__(self, path, flush_interval=1, max_queued=100000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_queued = max_queued
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._counters = {'logged': 0, 'dropped': 0, 'written_bytes': 0}
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._write_loop, name='query-log-writer', daemon=True)
+        self._thread.start()
+
+    def append(self, arrival, strategy, query, latency, status, **fields):
+        entry = {'t': round(arrival, 6), 's': strategy, 'q': query, 'l': round(latency, 6), 'c': status}
+        entry.update((key, value) for key, value in fields.items() if value is not None)
+        line = json.dumps(entry, separators=(',', ':'))
+        with self._lock:
+            if len(self._queue) >= self.max_queued:
+                self._counters['dropped'] += 1
+                return
+            self._queue.append(line)
+            self._counters['logged'] += 1
+
+    def flush(self):
+        with self._lock:
+            lines = list(self._queue)
+            self._queue.clear()
+        if not lines:
+            return
+        data = ('\n'.join(lines) + '\n').encode('utf-8')
+        os.write(self._fd, data)
+        with self._lock:
+            self._counters['written_bytes'] += len(data)
+
+    def _write_loop(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except OSError as e:
+                print(f'query log: could not write to {self.path}: {e}')
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+        self.flush()
+        os.close(self._fd)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['queued'] = len(self._queue)
+        stats['path'] = self.path
+        return stats
+
+
+def _strategy(path, default):
+    return path.strip('/') or default
+
+
+def _logged_fields(data):
+    """
+    What is logged of the json body of a request: (query, optional fields), or None when it is not a query request
+    a single query keeps its params and stream flag, a batch its list of queries and its options
+    """
+    if not isinstance(data, dict):
+        return None
+    if isinstance(data.get('query'), str):
+        return data['query'], {'p': data.get('params'), 'x': True if data.get('stream') else None}
+    if isinstance(data.get('queries'), list):
+        options = {key: data[key] for key in ('strategy', 'transaction') if key in data}
+        return data['queries'], {'o': options or None}
+    return None
+
+
+def log_flask(app, query_log, default_strategy='gatekeeper'):
+    """
+    Log the query requests of a flask application (the requests whose json body has a query, or the queries of a batch)
+    the latency of a streamed response is the time until its first bytes are ready
+    """
+    from flask import g, request
+
+    @app.before_request
+    def start_query_log():
+        g.query_log_arrival = time.time()
+        g.query_log_start = time.perf_counter()
+
+    @app.after_request
+    def append_query_log(response):
+        start = g.pop('query_log_start', None)
+        logged = _logged_fields(request.get_json(silent=True)) if start is not None and request.is_json else None
+        if logged is not None:
+            query, fields = logged
+            query_log.append(g.pop('query_log_arrival'), _strategy(request.path, default_strategy), query,
+                             time.perf_counter() - start, response.status_code, **fields)
+        return response
+
+
+def aiohttp_middleware(query_log, default_strategy='gatekeeper'):
+    """
+    Same logging as log_flask for an aiohttp application
+    """
+    from aiohttp import web
+
+    @web.middleware
+    async def middleware(request, handler):
+        arrival = time.time()
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            if request.method == 'POST' and request.content_type == 'application/json' and request.body_exists:
+                try:
+                    # the body was already read by the handler, aiohttp keeps it
+                    data = await request.json()
+                except ValueError:
+                    data = None
+                logged = _logged_fields(data)
+                if logged is not None:
+                    query, fields = logged
+                    query_log.append(arrival, _strategy(request.path, default_strategy), query,
+                                     time.perf_counter() - start, status, **fields)
+
+    return middleware